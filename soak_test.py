@@ -0,0 +1,324 @@
+"""
+长时间运行（soak）基准：在离线模拟行情下以加速的刷新频率驱动命令行或图形界面的刷新路径，
+定期采样进程内存 (RSS)、线程数、打开的套接字、Python 对象数以及 Tk 控件数，
+任一指标在预热之后仍持续增长即判定为泄漏，以非零退出码结束
+
+运行时使用临时目录作为用户主目录，不会改动真实的 ~/.stock_quote，结束时删除该目录
+"""
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+# 必须在导入 stock / stock_cli 之前设置：两者在导入时就会确定用户目录下各数据文件的路径
+SOAK_HOME = tempfile.mkdtemp(prefix="stock_soak_")
+os.environ["HOME"] = SOAK_HOME
+os.environ["USERPROFILE"] = SOAK_HOME
+# 先注册的后执行：日志监听线程等在之后注册的清理完成后再删除目录
+atexit.register(shutil.rmtree, SOAK_HOME, ignore_errors=True)
+
+import csv
+import gc
+import json
+import statistics
+import threading
+import time
+import contextlib
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+EXIT_OK = 0
+EXIT_LEAK = 1
+EXIT_USAGE = 2
+
+DEFAULT_DURATION = 600        # 秒
+DEFAULT_INTERVAL = 0.2        # 两次刷新之间的间隔（秒）
+DEFAULT_SYMBOLS = 200
+DEFAULT_SAMPLE_INTERVAL = 5   # 采样间隔（秒）
+REAL_REFRESH_INTERVAL = 30    # 换算成实际运行时长时使用的正常刷新间隔（秒）
+MIN_SAMPLES = 8
+
+# 各指标允许的增长：(绝对容差, 相对容差)，比较预热后第二个四分之一与最后四分之一采样的中位数
+LEAK_TOLERANCES = {
+    "rss_mb": (5.0, 0.05),
+    "threads": (2, 0.0),
+    "sockets": (4, 0.0),
+    "objects": (2000, 0.05),
+    "widgets": (10, 0.0),
+}
+METRICS = ["rss_mb", "threads", "sockets", "objects", "widgets"]
+
+
+def display_help():
+    print("""
+用法: python soak_test.py [选项]
+
+以离线模拟行情加速驱动刷新路径，检查内存、线程、套接字、对象和控件数量是否无界增长
+
+选项:
+  --target <cli|gui>   驱动的程序，默认 cli；gui 需要图形环境（Linux 上可用 xvfb-run）
+  --duration <秒>      运行时长，默认 600
+  --interval <秒>      两次刷新之间的间隔，默认 0.2
+  --symbols <数量>     模拟的代码数量，默认 200
+  --sample <秒>        采样间隔，默认 5
+  --output <文件>      将采样结果写入 CSV 文件
+  -h, --help           显示此帮助信息并退出
+
+退出码: 0 未发现泄漏，1 有指标持续增长，2 参数错误
+
+示例:
+  python soak_test.py --duration 1800 --interval 0.05 --symbols 500
+  xvfb-run python soak_test.py --target gui --duration 3600 --output gui_soak.csv
+""")
+
+
+def read_rss_mb():
+    """当前进程的常驻内存（MB），无法获取时返回 None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / 2 ** 20
+    return None
+
+
+def count_sockets():
+    """当前进程打开的套接字数量，无法获取时返回 None"""
+    if psutil is not None:
+        process = psutil.Process()
+        connections = getattr(process, "net_connections", None) or process.connections
+        return len(connections(kind="all"))
+    try:
+        fd_dir = "/proc/self/fd"
+        count = 0
+        for fd in os.listdir(fd_dir):
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                    count += 1
+            except OSError:
+                continue
+        return count
+    except OSError:
+        return None
+
+
+def count_widgets(widget):
+    """递归统计 Tk 控件数量（包括自身）"""
+    return 1 + sum(count_widgets(child) for child in widget.winfo_children())
+
+
+def make_symbols(count):
+    """生成一组覆盖沪深港美的模拟代码"""
+    prefixes = ["SH60", "SZ00", "HK0", "US"]
+    return [f"{prefixes[i % len(prefixes)]}{i:04d}" for i in range(count)]
+
+
+class SoakSampler:
+    """按采样间隔记录各项资源指标"""
+    def __init__(self, sample_interval, widget_root=None):
+        self.sample_interval = sample_interval
+        self.widget_root = widget_root
+        self.start = time.monotonic()
+        self.next_sample = self.start
+        self.samples = []
+
+    def maybe_sample(self, refreshes):
+        now = time.monotonic()
+        if now < self.next_sample:
+            return
+        self.next_sample = now + self.sample_interval
+        gc.collect()
+        sample = {
+            "elapsed": round(now - self.start, 1),
+            "refreshes": refreshes,
+            "rss_mb": read_rss_mb(),
+            "threads": threading.active_count(),
+            "sockets": count_sockets(),
+            "objects": len(gc.get_objects()),
+            "widgets": count_widgets(self.widget_root) if self.widget_root is not None else None,
+        }
+        self.samples.append(sample)
+        cells = "  ".join(f"{name}={sample[name]:.1f}" if isinstance(sample[name], float) else f"{name}={sample[name]}"
+                          for name in METRICS if sample[name] is not None)
+        print(f"[{sample['elapsed']:>7.1f}s] 刷新 {refreshes:>6}  {cells}", file=sys.stderr)
+
+
+def find_leaks(samples):
+    """
+    比较预热后第二个四分之一与最后四分之一采样的中位数，返回超出容差的指标说明
+    前四分之一视为预热（缓存、连接池、线程池逐步填满），不参与比较
+    """
+    count = len(samples)
+    early = samples[count // 4:count // 2]
+    late = samples[count * 3 // 4:]
+    leaks = []
+    for metric in METRICS:
+        early_values = [s[metric] for s in early if s[metric] is not None]
+        late_values = [s[metric] for s in late if s[metric] is not None]
+        if not early_values or not late_values:
+            continue
+        base = statistics.median(early_values)
+        final = statistics.median(late_values)
+        absolute, relative = LEAK_TOLERANCES[metric]
+        if final - base > absolute + relative * base:
+            leaks.append(f"{metric}: {base:.1f} -> {final:.1f}")
+    return leaks
+
+
+def run_cli_soak(symbols, duration, interval, sampler):
+    """驱动命令行的交互刷新路径（获取、排序、筛选、渲染表格）和批处理的增量输出路径"""
+    import requests
+    import stock_cli as app
+
+    app.setup_logging()
+    app.use_stub_provider()
+    session = requests.Session()
+    headers = {}
+    tracker = app.ChangeTracker()
+    quote_cache = {}
+    refreshes = 0
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        writer = app.BatchWriter("ndjson", out=devnull)
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            cycle_start = time.monotonic()
+            with contextlib.redirect_stdout(devnull):
+                stock_data = app.collect_quotes(session, headers, symbols)
+                stock_data = [s for s in stock_data if s.get('Status') != "CLOSED"]
+                app.display_stock_table(stock_data, show_ext_data=True)
+            app.run_batch_cycle(session, headers, symbols, writer, tracker=tracker, quote_cache=quote_cache)
+            refreshes += 1
+            sampler.maybe_sample(refreshes)
+            time.sleep(max(0.0, interval - (time.monotonic() - cycle_start)))
+    return refreshes
+
+
+def run_gui_soak(symbols, duration, interval, sampler):
+    """驱动图形界面：按刷新间隔整表刷新并重绘当前列表"""
+    app_dir = os.path.join(SOAK_HOME, ".stock_quote")
+    os.makedirs(app_dir, exist_ok=True)
+    with open(os.path.join(app_dir, "favorites.json"), "w", encoding="utf-8") as f:
+        json.dump({"stocks": symbols}, f)
+
+    import stock as app
+
+    app.setup_logging()
+    app.use_stub_provider()
+    root = app.tk.Tk()
+    gui = app.StockQuoteGUI(root)
+    gui.stub_var.set(True)
+    gui.update_title()
+    sampler.widget_root = root
+    refreshes = 0
+    deadline = time.monotonic() + duration
+
+    def tick():
+        nonlocal refreshes
+        if time.monotonic() >= deadline:
+            root.quit()
+            return
+        gui.trigger_data_load()
+        refreshes += 1
+        sampler.maybe_sample(refreshes)
+        root.after(max(1, int(interval * 1000)), tick)
+
+    root.after(0, tick)
+    root.mainloop()
+    gui.refresh_active = False
+    root.destroy()
+    return refreshes
+
+
+def main(argv):
+    if "-h" in argv or "--help" in argv:
+        display_help()
+        return EXIT_OK
+
+    target = "cli"
+    duration = DEFAULT_DURATION
+    interval = DEFAULT_INTERVAL
+    symbol_count = DEFAULT_SYMBOLS
+    sample_interval = DEFAULT_SAMPLE_INTERVAL
+    output_path = None
+
+    i = 0
+    try:
+        while i < len(argv):
+            if argv[i] == "--target" and i + 1 < len(argv) and argv[i + 1] in ("cli", "gui"):
+                target = argv[i + 1]
+            elif argv[i] == "--duration" and i + 1 < len(argv):
+                duration = float(argv[i + 1])
+            elif argv[i] == "--interval" and i + 1 < len(argv):
+                interval = float(argv[i + 1])
+            elif argv[i] == "--symbols" and i + 1 < len(argv):
+                symbol_count = int(argv[i + 1])
+            elif argv[i] == "--sample" and i + 1 < len(argv):
+                sample_interval = float(argv[i + 1])
+            elif argv[i] == "--output" and i + 1 < len(argv):
+                output_path = argv[i + 1]
+            else:
+                print(f"错误: 未知参数 '{argv[i]}'", file=sys.stderr)
+                display_help()
+                return EXIT_USAGE
+            i += 2
+    except ValueError:
+        print(f"错误: {argv[i]} 参数需要一个数值", file=sys.stderr)
+        return EXIT_USAGE
+    if min(duration, interval, sample_interval) <= 0 or symbol_count <= 0:
+        print("错误: 时长、间隔和代码数量必须为正数", file=sys.stderr)
+        return EXIT_USAGE
+
+    symbols = make_symbols(symbol_count)
+    sampler = SoakSampler(sample_interval)
+    print(f"soak 测试: {target}，{symbol_count} 个代码，每 {interval:g} 秒刷新一次，持续 {duration:g} 秒"
+          f"（用户目录 {SOAK_HOME}）", file=sys.stderr)
+    run = run_gui_soak if target == "gui" else run_cli_soak
+    refreshes = run(symbols, duration, interval, sampler)
+    sampler.next_sample = 0
+    sampler.maybe_sample(refreshes)
+
+    if output_path:
+        with open(output_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["elapsed", "refreshes"] + METRICS)
+            writer.writeheader()
+            writer.writerows(sampler.samples)
+
+    hours = refreshes * REAL_REFRESH_INTERVAL / 3600
+    print(f"共刷新 {refreshes} 次，相当于以 {REAL_REFRESH_INTERVAL} 秒间隔运行约 {hours:.1f} 小时", file=sys.stderr)
+    if len(sampler.samples) < MIN_SAMPLES:
+        print(f"警告: 只有 {len(sampler.samples)} 个采样，不足以判断是否泄漏，请延长 --duration 或缩短 --sample", file=sys.stderr)
+        return EXIT_OK
+    leaks = find_leaks(sampler.samples)
+    if leaks:
+        print("发现持续增长的指标:\n  " + "\n  ".join(leaks), file=sys.stderr)
+        return EXIT_LEAK
+    print("未发现持续增长的指标", file=sys.stderr)
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -5,51 +5,136 @@ import threading
 import time
 import platform
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, simpledialog, filedialog
 import os
-import re
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import logging
 import pystray
 from PIL import Image, ImageTk
-import sys
-from datetime import datetime, time as dt_time
+from datetime import datetime
 import shutil
+import copy
+import stock_common
+from stock_common import (
+    BAR_PERIODS, ChangeTracker, DEFAULT_SCAN_MARKETS, MAX_FETCH_WORKERS,
+    OPTIONAL_FIELDS, QUARANTINE_LABELS, RefreshScheduler, SCAN_MARKETS,
+    SCAN_REDRAW_INTERVAL, SHARED_QUOTE_MAX_AGE, TENCENT_BATCH_SIZE, atomic_write_json,
+    bar_aggregator, batches_asset, fetch_from_providers, forex_code_map,
+    format_provider_stats, format_scan_lines, format_shared_cache_lines,
+    format_traffic_lines, get_app_data_dir, get_crypto_info, get_forex_info,
+    get_priority_interval, get_quote_region, get_recordings_dir, get_resource_path,
+    get_shared_quote_cache, get_tencent_market_symbol, get_traces_dir, is_crypto_symbol,
+    is_forex_symbol, log_error, note_exchange_time, rate_limiter, scan_market,
+    setup_logging, start_recording, start_replay, start_tracing, stop_recording,
+    stop_replay, stop_tracing, stub_provider_active, symbol_directory, symbol_metadata,
+    symbol_quarantine, tencent_wire_format, trace_span, use_stub_provider,
+)
 
 # Suppress only the InsecureRequestWarning from urllib3 needed for this script
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-# --- 配置和路径管理 ---
-
-def get_app_data_dir():
-    """获取用户特定的应用数据目录，并确保它存在"""
-    home = os.path.expanduser("~")
-    app_data_dir = os.path.join(home, ".stock_quote")
-    os.makedirs(app_data_dir, exist_ok=True)
-    return app_data_dir
-
-def get_resource_path(relative_path):
-    """获取资源的绝对路径，无论是在开发环境还是在PyInstaller打包后"""
-    if hasattr(sys, '_MEIPASS'):
-        # PyInstaller创建的临时文件夹
-        base_path = sys._MEIPASS
-    else:
-        # 正常开发环境
-        base_path = os.path.abspath(os.path.dirname(__file__))
-    return os.path.join(base_path, relative_path)
-
-# 配置日志
-log_file = os.path.join(get_app_data_dir(), 'stock_quote.log')
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename=log_file,
-    filemode='a'
-)
+# --- 列表文件存储 ---
+
+class WatchlistStore:
+    """
+    列表文件的内存缓存
+    读取时只有文件的修改时间或大小变化后才重新解析；保存时合并短时间内的多次修改，
+    由后台定时线程一次性原子写入，界面线程不会等待磁盘
+    """
+    def __init__(self, filename, key, fallback, resource=None, debounce=1.0):
+        self.path = os.path.join(get_app_data_dir(), filename)
+        self.key = key
+        self.fallback = fallback
+        self.resource = resource
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.data = None
+        self.signature = None
+        self.timer = None
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
 
-def log_error(symbol, data, error_message):
-    """记录错误到日志文件"""
-    logging.error(f"Error fetching data for {symbol}. Data: {data}. Error: {error_message}")
+    def _read(self):
+        # 文件不存在时从程序包中复制默认配置
+        if not os.path.exists(self.path) and self.resource:
+            try:
+                shutil.copy2(get_resource_path(self.resource), self.path)
+            except Exception as e:
+                log_error(self.key.upper(), "", f"Failed to copy default {self.resource}: {e}")
+                atomic_write_json(self.path, {self.key: self.fallback})
+        self.signature = self._stat_signature()
+        if self.signature is None:
+            self.data = copy.deepcopy(self.fallback)
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f).get(self.key, copy.deepcopy(self.fallback))
+        except Exception as e:
+            log_error(self.key.upper(), "", f"Error loading {os.path.basename(self.path)}: {e}")
+            self.data = copy.deepcopy(self.fallback)
+
+    def load(self):
+        """返回缓存的内容，文件被修改过时重新读取；有未写入的修改时以内存为准"""
+        with self.lock:
+            if self.data is None or (self.timer is None and self._stat_signature() != self.signature):
+                self._read()
+            return self.data
+
+    def poll(self):
+        """检查文件是否被外部修改，是则重新加载并返回 True"""
+        with self.lock:
+            if self.data is None or self.timer is not None:
+                return False
+            if self._stat_signature() == self.signature:
+                return False
+            self._read()
+            return True
+
+    def save(self, data):
+        """更新内存中的内容，并在 debounce 秒后于后台线程写入文件"""
+        with self.lock:
+            self.data = data
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """立即写入尚未保存的修改"""
+        with self.write_lock:
+            with self.lock:
+                if self.timer is None:
+                    return
+                self.timer.cancel()
+                self.timer = None
+                snapshot = copy.deepcopy(self.data)
+            try:
+                atomic_write_json(self.path, {self.key: snapshot})
+            except Exception as e:
+                log_error(self.key.upper(), "", f"Error saving {os.path.basename(self.path)}: {e}")
+                return
+            with self.lock:
+                if self.timer is None:
+                    self.signature = self._stat_signature()
+
+
+# --- 变化检测 ---
+
+# 变化字段对应需要高亮的表格列
+FLASH_COLUMNS = {
+    "Price": ("Price",),
+    "Change": ("Change", "Percent"),
+    "extPrice": ("extPrice",),
+    "extChange": ("extChange", "extPercent"),
+}
+# 高亮持续时间（毫秒）
+FLASH_DURATION_MS = 1500
 
 
 class StockQuoteGUI:
@@ -67,27 +152,76 @@ class StockQuoteGUI:
         # 创建菜单栏
         self.create_menu()
         
-        # 从文件加载自选股
-        self.default_stocks = self.load_favorites()
-        self.default_indexes = self.load_indexes()
+        # 列表文件存储：内存缓存 + 合并写入 + 外部修改检测
+        self.favorites_store = WatchlistStore('favorites.json', 'stocks',
+                                              ["SH513100", "SH513500", "SH513180", "IBIT"],
+                                              resource='favorites.json')
+        self.indexes_store = WatchlistStore('indexes.json', 'indexes', [
+            "SH000001", "SZ399001", "SZ399006", "SH000688",
+            "SH000016", "BJ899050", "HKHSI", "HKHSTECH",
+            ".DJI", ".IXIC", ".INX"
+        ], resource='indexes.json')
+        self.watchlists_store = WatchlistStore('watchlists.json', 'watchlists', {})
+        
+        self.settings_store = WatchlistStore('settings.json', 'settings', {})
+        
+        # 从文件加载自选股、指数以及其他命名列表
+        self.watchlists = self.load_watchlists()
         
-        # 当前股票列表
-        self.current_stocks = self.default_stocks.copy()
-        self.current_mode = 'favorites'  # 'favorites' or 'indexes'
+        # 当前股票列表，current_mode 为当前列表的名称
+        self.current_mode = 'favorites'
+        self.current_stocks = self.watchlists['favorites']['symbols']
+        
+        # 所有列表共享的行情缓存，切换列表时直接从缓存渲染
+        self.quote_cache = {}
+        self.cache_lock = threading.Lock()
+
+        # 同一时间只有一个加载线程；加载期间到期的代码合并到待加载集合，由该线程在本次加载后继续获取
+        self.load_lock = threading.Lock()
+        self.load_pending = set()
+        self.load_pending_full = False
+        self.loader_running = False
+        
+        # 逐代码的刷新调度器，每个代码的间隔由所在列表和优先级决定
+        self.symbol_base_intervals = {}
+        self.visible_symbols = set()
+        self.scheduler = RefreshScheduler(self.get_symbol_interval)
+        self.sync_scheduler()
         
         # 盘前盘后数据开关
         self.show_extended_data = tk.BooleanVar(value=False)
         self.show_trading_only = tk.BooleanVar(value=True)
         self.last_stock_data = []
         
-        # 刷新间隔（秒）
-        self.refresh_interval = 30
+        # 刷新之间的变化检测，用于高亮发生变化的单元格
+        self.change_tracker = ChangeTracker()
+        self.pending_changes = {}
+        
+        # 刷新间隔（秒），跟随当前列表
+        self.refresh_interval = self.watchlists['favorites']['interval']
         
         # 控制刷新的标志
         self.refresh_active = False
         self.last_refresh_time = time.time()
         
-        # 系统托盘相关
+        # 统计窗口
+        self.stats_window = None
+        
+        # 全市场扫描窗口
+        self.scan_window = None
+        self.scan_running = False
+        self.scan_markets = list(DEFAULT_SCAN_MARKETS)
+        
+        # 系统托盘相关：隐藏到托盘后只按较低频率刷新固定显示的几个代码
+        settings = self.settings_store.load()
+        self.tray_refresh_interval = settings.get('tray_refresh_interval', self.DEFAULT_TRAY_REFRESH_INTERVAL)
+        self.pinned_symbols = settings.get('pinned_symbols') or self.watchlists['favorites']['symbols'][:3]
+        self.tray_last_refresh = 0
+        self.extra_columns = [c for c in settings.get('extra_columns', []) if c in OPTIONAL_FIELDS]
+        for label, fields in self.OPTIONAL_COLUMN_GROUPS:
+            self.column_vars[label].set(all(f in self.extra_columns for f in fields))
+        tencent_wire_format.configure(self.show_extended_data.get(), self.extra_columns)
+        self.bar_period_var.set(settings.get('bar_period') if settings.get('bar_period') in BAR_PERIODS else "")
         self.icon = None
         self.is_minimized_to_tray = False
         self.setup_tray_icon()
@@ -99,6 +233,13 @@ class StockQuoteGUI:
         if platform.system() == "Windows":
             self.root.bind('<Control-Alt-z>', lambda event: self.minimize_to_tray())
         
+        # 在后台加载本地代码目录，供添加代码时自动补全和验证
+        threading.Thread(target=self.load_symbol_directory, daemon=True).start()
+        
+        # 联网之前先用代码元数据缓存显示各代码的名称，行情到达后再填入价格
+        self.last_stock_data = self.get_cached_stock_data(self.current_stocks)
+        self.render_stock_table()
+        
         # 获取初始数据
         self.trigger_data_load()
         
@@ -119,15 +260,47 @@ class StockQuoteGUI:
         self.refresh_menu_item_label.set("停止刷新")
         action_menu.add_command(label=self.refresh_menu_item_label.get(), command=self.toggle_refresh)
         action_menu.add_separator()
+        action_menu.add_command(label="新建列表...", command=self.create_watchlist)
+        action_menu.add_command(label="删除当前列表", command=self.delete_watchlist)
+        action_menu.add_separator()
+        # 附加列：来自同一次请求的其他字段，勾选后才解码显示
+        columns_menu = tk.Menu(action_menu, tearoff=0)
+        action_menu.add_cascade(label="附加列", menu=columns_menu)
+        self.column_vars = {}
+        for label, fields in self.OPTIONAL_COLUMN_GROUPS:
+            self.column_vars[label] = tk.BooleanVar(value=False)
+            columns_menu.add_checkbutton(label=label, variable=self.column_vars[label],
+                                         command=self.update_extra_columns)
+        # 走势：由每次刷新的行情在本地聚合的 K 线，不额外请求
+        bars_menu = tk.Menu(action_menu, tearoff=0)
+        action_menu.add_cascade(label="走势", menu=bars_menu)
+        self.bar_period_var = tk.StringVar(value="")
+        for label, period in self.BAR_PERIOD_OPTIONS:
+            bars_menu.add_radiobutton(label=label, value=period, variable=self.bar_period_var,
+                                      command=self.update_bar_period)
+        action_menu.add_command(label="全市场扫描", command=self.show_scanner)
+        action_menu.add_separator()
+        # 录制与回放：录制上游原始响应，或从录制文件离线回放
+        self.record_var = tk.BooleanVar(value=False)
+        action_menu.add_checkbutton(label="录制上游响应", variable=self.record_var, command=self.toggle_recording)
+        action_menu.add_command(label="回放录制...", command=self.open_replay)
+        action_menu.add_command(label="停止回放", command=self.close_replay)
+        self.stub_var = tk.BooleanVar(value=False)
+        action_menu.add_checkbutton(label="离线模拟行情", variable=self.stub_var, command=self.toggle_stub_provider)
+        self.trace_var = tk.BooleanVar(value=False)
+        action_menu.add_checkbutton(label="记录刷新跟踪", variable=self.trace_var, command=self.toggle_tracing)
+        action_menu.add_separator()
         # 仅在 Windows 平台显示"隐藏到托盘"选项
         if platform.system() == "Windows":
             action_menu.add_command(label="隐藏到托盘 Ctrl+Alt+Z", command=self.minimize_to_tray)
+            action_menu.add_command(label="托盘设置...", command=self.configure_tray)
             action_menu.add_separator()
         action_menu.add_command(label="退出", command=self.on_closing)
         
         # 创建帮助菜单
         help_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="帮助", menu=help_menu)
+        help_menu.add_command(label="连接统计", command=self.show_stats)
         help_menu.add_command(label="关于", command=self.show_about)
     
     def show_about(self):
@@ -146,83 +319,263 @@ class StockQuoteGUI:
 """
         messagebox.showinfo("关于", about_text)
     
+    def get_stats_lines(self):
+        """
+        汇总统计视图中显示的内容
+        """
+        lines = [f"[上游限流] 更新于 {time.strftime('%H:%M:%S')}"]
+        lines.extend(rate_limiter.format_stats())
+        lines.append("")
+        lines.append("[延迟与对冲请求]")
+        lines.extend(rate_limiter.format_latency_stats())
+        lines.append("")
+        lines.append("[行情提供方]")
+        lines.extend(format_provider_stats())
+        lines.append("")
+        lines.append("[隔离的失效代码]")
+        lines.extend(symbol_quarantine.format_lines())
+        lines.append("")
+        lines.append("[录制与回放]")
+        lines.extend(format_traffic_lines())
+        lines.append("")
+        lines.append("[共享行情缓存]")
+        lines.extend(format_shared_cache_lines())
+        lines.append("")
+        lines.append("[腾讯行情格式]")
+        lines.extend(tencent_wire_format.format_lines())
+        lines.append("")
+        lines.append("[K线聚合]")
+        lines.extend(bar_aggregator.format_lines())
+        return lines
+
+    def show_stats(self):
+        """
+        显示连接统计窗口，窗口打开期间每秒刷新
+        """
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.lift()
+            return
+        self.stats_window = tk.Toplevel(self.root)
+        self.stats_window.title("连接统计")
+        self.stats_window.geometry("760x420")
+        self.stats_text = scrolledtext.ScrolledText(self.stats_window, font=("Courier", 10), wrap=tk.NONE)
+        self.stats_text.pack(fill=tk.BOTH, expand=True)
+        self.update_stats_window()
+
+    def update_stats_window(self):
+        if self.stats_window is None or not self.stats_window.winfo_exists():
+            self.stats_window = None
+            return
+        self.stats_text.delete('1.0', tk.END)
+        self.stats_text.insert(tk.END, "\n".join(self.get_stats_lines()))
+        self.root.after(1000, self.update_stats_window)
+    
+    def show_scanner(self):
+        """
+        显示全市场扫描窗口，窗口打开期间在后台循环扫描
+        """
+        if self.scan_window is not None and self.scan_window.winfo_exists():
+            self.scan_window.lift()
+            return
+        self.scan_window = tk.Toplevel(self.root)
+        self.scan_window.title("全市场扫描")
+        self.scan_window.geometry("640x720")
+        market_frame = ttk.Frame(self.scan_window)
+        market_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(market_frame, text="市场:").pack(side=tk.LEFT)
+        self.scan_market_vars = {}
+        for market in SCAN_MARKETS:
+            var = tk.BooleanVar(value=market in self.scan_markets)
+            self.scan_market_vars[market] = var
+            ttk.Checkbutton(market_frame, text=market, variable=var,
+                            command=self.update_scan_markets).pack(side=tk.LEFT, padx=(5, 0))
+        self.scan_text = scrolledtext.ScrolledText(self.scan_window, font=("Courier", 10), wrap=tk.NONE)
+        self.scan_text.pack(fill=tk.BOTH, expand=True)
+        self.scan_text.insert(tk.END, "正在扫描...")
+        self.scan_window.protocol("WM_DELETE_WINDOW", self.close_scanner)
+        self.scan_running = True
+        threading.Thread(target=self.scan_worker, daemon=True).start()
+
+    def update_scan_markets(self):
+        """
+        下一轮扫描使用勾选的市场
+        """
+        self.scan_markets = [m for m, var in self.scan_market_vars.items() if var.get()]
+
+    def close_scanner(self):
+        self.scan_running = False
+        if self.scan_window is not None:
+            self.scan_window.destroy()
+        self.scan_window = None
+
+    # 全市场扫描每轮之间的间隔（秒）
+    SCAN_REFRESH_INTERVAL = 30
+
+    def scan_worker(self):
+        """
+        循环扫描全市场（在后台线程中运行），扫描过程中每隔 SCAN_REDRAW_INTERVAL 秒在主线程重绘排行
+        """
+        while self.scan_running:
+            start_time = time.time()
+            last_draw = [0.0]
+
+            def on_update(scan):
+                now = time.monotonic()
+                if now - last_draw[0] >= SCAN_REDRAW_INTERVAL:
+                    last_draw[0] = now
+                    self.root.after(0, lambda: self.render_scan(scan))
+
+            # 隐藏到托盘时暂停扫描
+            if not self.is_minimized_to_tray and self.scan_markets:
+                scan = scan_market(self.session, list(self.scan_markets), on_update=on_update)
+                try:
+                    self.root.after(0, lambda: self.render_scan(scan))
+                except tk.TclError:
+                    return
+            while self.scan_running and time.time() - start_time < self.SCAN_REFRESH_INTERVAL:
+                time.sleep(0.5)
+
+    def render_scan(self, scan):
+        if self.scan_window is None or not self.scan_window.winfo_exists():
+            return
+        self.scan_text.delete('1.0', tk.END)
+        self.scan_text.insert(tk.END, "\n".join(format_scan_lines(scan)))
+
     def load_favorites(self):
         """
         从用户配置目录加载自选股列表。如果不存在，则从程序包中复制默认配置。
+        文件内容缓存在内存中，只有文件被修改后才重新解析。
         """
-        user_favorites_path = os.path.join(get_app_data_dir(), 'favorites.json')
-        
-        if not os.path.exists(user_favorites_path):
-            try:
-                default_favorites_path = get_resource_path('favorites.json')
-                shutil.copy2(default_favorites_path, user_favorites_path)
-            except Exception as e:
-                log_error("FAVORITES", "", f"Failed to copy default favorites: {e}")
-                # 如果复制失败，使用一个硬编码的默认列表
-                default_favorites = ["SH513100", "SH513500", "SH513180", "IBIT"]
-                self.save_favorites(default_favorites)
-                return default_favorites
-
-        try:
-            with open(user_favorites_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('stocks', [])
-        except Exception as e:
-            log_error("FAVORITES", "", f"Error loading user favorites file: {e}")
-            return ["SH513100", "SH513500", "SH513180", "IBIT"]
+        return list(self.favorites_store.load())
 
     def save_favorites(self, favorites):
         """
-        将自选股列表保存到用户配置目录。
+        将自选股列表保存到用户配置目录（合并连续修改，在后台线程原子写入）。
         """
-        favorites_file = os.path.join(get_app_data_dir(), 'favorites.json')
-        try:
-            with open(favorites_file, 'w', encoding='utf-8') as f:
-                json.dump({'stocks': favorites}, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            log_error("FAVORITES", "", f"Error saving favorites file: {e}")
+        self.favorites_store.save(list(favorites))
 
     def load_indexes(self):
         """
         从用户配置目录加载指数列表。如果不存在，则从程序包中复制默认配置。
         """
-        user_indexes_path = os.path.join(get_app_data_dir(), 'indexes.json')
-
-        if not os.path.exists(user_indexes_path):
-            try:
-                default_indexes_path = get_resource_path('indexes.json')
-                shutil.copy2(default_indexes_path, user_indexes_path)
-            except Exception as e:
-                log_error("INDEXES", "", f"Failed to copy default indexes: {e}")
-                # 如果复制失败，使用一个硬编码的默认列表
-                default_indexes = [
-                    "SH000001", "SZ399001", "SZ399006", "SH000688",
-                    "SH000016", "BJ899050", "HKHSI", "HKHSTECH",
-                    ".DJI", ".IXIC", ".INX"
-                ]
-                self.save_indexes(default_indexes)
-                return default_indexes
-
-        try:
-            with open(user_indexes_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('indexes', [])
-        except Exception as e:
-            log_error("INDEXES", "", f"Error loading user indexes file: {e}")
-            return []
+        return list(self.indexes_store.load())
 
     def save_indexes(self, indexes):
         """
-        将指数列表保存到用户配置目录。
+        将指数列表保存到用户配置目录（合并连续修改，在后台线程原子写入）。
         """
-        indexes_file = os.path.join(get_app_data_dir(), 'indexes.json')
-        try:
-            with open(indexes_file, 'w', encoding='utf-8') as f:
-                json.dump({'indexes': indexes}, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            log_error("INDEXES", "", f"Error saving indexes file: {e}")
+        self.indexes_store.save(list(indexes))
     
+    # 内置列表的名称和显示名
+    BUILTIN_WATCHLISTS = {'favorites': "自选股", 'indexes': "指数"}
+    DEFAULT_WATCHLIST_INTERVAL = 30
+
+    def load_watchlists(self):
+        """
+        加载所有列表：自选股和指数来自各自的文件，其他命名列表及各列表的刷新间隔来自 watchlists.json
+        返回 {名称: {'symbols': [...], 'interval': 秒数}}
+        """
+        stored = self.watchlists_store.load()
+        watchlists = {
+            'favorites': {'symbols': self.load_favorites()},
+            'indexes': {'symbols': self.load_indexes()},
+        }
+        for name, entry in stored.items():
+            if name not in watchlists:
+                watchlists[name] = {'symbols': [s.upper() for s in entry.get('symbols', [])]}
+        for name, entry in watchlists.items():
+            entry['interval'] = stored.get(name, {}).get('interval', self.DEFAULT_WATCHLIST_INTERVAL)
+        return watchlists
+
+    def save_watchlists(self):
+        """
+        保存命名列表及所有列表的刷新间隔到 watchlists.json（内置列表的代码仍保存在各自的文件中）
+        """
+        data = {}
+        for name, entry in self.watchlists.items():
+            if name in self.BUILTIN_WATCHLISTS:
+                data[name] = {'interval': entry['interval']}
+            else:
+                data[name] = {'symbols': entry['symbols'], 'interval': entry['interval']}
+        self.watchlists_store.save(data)
+
+    def save_current_list(self):
+        """
+        根据当前模式保存到对应的文件
+        """
+        self.watchlists[self.current_mode]['symbols'] = self.current_stocks
+        self.sync_scheduler()
+        if self.current_mode == 'favorites':
+            self.save_favorites(self.current_stocks)
+        elif self.current_mode == 'indexes':
+            self.save_indexes(self.current_stocks)
+        else:
+            self.save_watchlists()
+
+    def check_watchlist_files(self):
+        """
+        检测列表文件是否被外部修改（比较修改时间），有变化时更新列表并重绘
+        """
+        changed = False
+        if self.favorites_store.poll():
+            self.watchlists['favorites']['symbols'] = self.load_favorites()
+            changed = True
+        if self.indexes_store.poll():
+            self.watchlists['indexes']['symbols'] = self.load_indexes()
+            changed = True
+        if self.watchlists_store.poll():
+            self.watchlists = self.load_watchlists()
+            changed = True
+        if changed:
+            if self.current_mode not in self.watchlists:
+                self.current_mode = 'favorites'
+            self.update_watchlist_combo()
+            self.show_watchlist(self.current_mode)
+
+    def flush_watchlist_stores(self):
+        """
+        退出前写入尚未保存的列表修改
+        """
+        for store in (self.favorites_store, self.indexes_store, self.watchlists_store, self.settings_store):
+            store.flush()
+
+    def sync_scheduler(self):
+        """
+        根据所有列表更新调度器：每个代码的基础间隔取所在列表中最短的刷新间隔
+        """
+        base_intervals = {}
+        for entry in self.watchlists.values():
+            for symbol in entry['symbols']:
+                base_intervals[symbol] = min(entry['interval'], base_intervals.get(symbol, entry['interval']))
+        self.symbol_base_intervals = base_intervals
+        self.visible_symbols = set(self.current_stocks)
+        self.scheduler.sync(base_intervals)
+
+    def get_symbol_interval(self, symbol):
+        """
+        按优先级计算代码的刷新间隔：当前列表中的代码、交易中的代码和大幅波动的代码刷新得更频繁
+        """
+        with self.cache_lock:
+            stock_info = self.quote_cache.get(symbol)
+        base = self.symbol_base_intervals.get(symbol, self.DEFAULT_WATCHLIST_INTERVAL)
+        return get_priority_interval(base, stock_info, symbol in self.visible_symbols)
+
+    def get_all_symbols(self):
+        """
+        返回所有列表中去重后的代码
+        """
+        return list(dict.fromkeys(s for entry in self.watchlists.values() for s in entry['symbols']))
+
+    def get_watchlist_label(self, name):
+        return self.BUILTIN_WATCHLISTS.get(name, name)
+
     def create_widgets(self):
+        # 变化单元格的高亮样式（红涨绿跌）
+        style = ttk.Style(self.root)
+        style.configure("Rise.TLabel", background="#ffd6d6")
+        style.configure("Fall.TLabel", background="#d6f5d6")
+        style.configure("Flash.TLabel", background="#fff3c4")
+        
         # 创建主框架
         main_frame = ttk.Frame(self.root)
         main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -244,6 +597,13 @@ class StockQuoteGUI:
         self.indexes_button = ttk.Button(control_frame, text="显示指数", command=self.show_indexes)
         self.indexes_button.pack(side=tk.LEFT, padx=(0, 5))
         
+        # 命名列表选择
+        self.watchlist_var = tk.StringVar(value=self.get_watchlist_label(self.current_mode))
+        self.watchlist_combo = ttk.Combobox(control_frame, textvariable=self.watchlist_var, state="readonly", width=8)
+        self.watchlist_combo.pack(side=tk.LEFT, padx=(0, 5))
+        self.watchlist_combo.bind('<<ComboboxSelected>>', self.on_watchlist_selected)
+        self.update_watchlist_combo()
+        
         # 编辑按钮
         self.edit_button = ttk.Button(control_frame, text="管理股票", command=self.toggle_edit_frame)
         self.edit_button.pack(side=tk.LEFT, padx=(0, 10))
@@ -251,7 +611,7 @@ class StockQuoteGUI:
         # 盘前盘后数据开关
         self.ext_data_button = ttk.Checkbutton(control_frame, text="显示盘前/盘后", 
                                               variable=self.show_extended_data, 
-                                              command=self.update_gui_with_data)
+                                              command=self.update_wire_format)
         self.ext_data_button.pack(side=tk.LEFT, padx=(10, 0))
         
         # 仅显示交易中开关
@@ -283,6 +643,15 @@ class StockQuoteGUI:
         ttk.Label(self.edit_frame, text="股票代码:").pack(side=tk.LEFT)
         self.stock_entry = ttk.Entry(self.edit_frame, width=30)
         self.stock_entry.pack(side=tk.LEFT, padx=(5, 10))
+        # 输入时在本地代码目录中按代码、名称或拼音首字母检索，在输入框下方列出候选
+        self.suggestion_popup = None
+        self.suggestion_listbox = None
+        self.suggestion_matches = []
+        self.stock_entry.bind('<KeyRelease>', self.update_suggestions)
+        self.stock_entry.bind('<Down>', self.focus_suggestions)
+        self.stock_entry.bind('<Return>', lambda event: self.add_stock())
+        self.stock_entry.bind('<Escape>', lambda event: self.hide_suggestions())
+        self.stock_entry.bind('<FocusOut>', lambda event: self.root.after(150, self.hide_suggestions_if_unfocused))
         
         # 添加按钮
         add_button = ttk.Button(self.edit_frame, text="添加", command=self.add_stock)
@@ -367,6 +736,7 @@ class StockQuoteGUI:
         切换编辑框架的显示和隐藏
         """
         if self.edit_frame_visible:
+            self.hide_suggestions()
             self.edit_frame.pack_forget()
             self.list_frame.pack_forget()
             self.edit_button.config(text="管理股票")
@@ -377,441 +747,234 @@ class StockQuoteGUI:
             self.edit_button.config(text="隐藏编辑")
             self.edit_frame_visible = True
 
-    # 外汇代码映射表
-    forex_code_map = {
-        "JPYUSD": {"secid": "119.JPYUSD", "name": "日元/美元"},
-        "USDCNH": {"secid": "133.USDCNH", "name": "美元/人民币"},
-        "EURUSD": {"secid": "119.EURUSD", "name": "欧元/美元"},
-        "GBPUSD": {"secid": "119.GBPUSD", "name": "英镑/美元"},
-        "AUDUSD": {"secid": "119.AUDUSD", "name": "澳元/美元"},
-        "USDJPY": {"secid": "119.USDJPY", "name": "美元/日元"},
-        "USDCHF": {"secid": "119.USDCHF", "name": "美元/瑞郎"},
-        "USDCAD": {"secid": "119.USDCAD", "name": "美元/加元"},
-        "USDHKD": {"secid": "119.USDHKD", "name": "美元/港币"},
-        "EURJPY": {"secid": "119.EURJPY", "name": "欧元/日元"},
-        "GBPJPY": {"secid": "119.GBPJPY", "name": "英镑/日元"}
-    }
-    
-    def is_forex_symbol(self, symbol):
+    def load_symbol_directory(self):
         """
-        判断是否为外汇符号
-        外汇符号格式如: USDCNH, USDJPY, EURUSD 等
+        加载本地代码目录（在后台线程中运行），没有缓存或已过期时重新下载；回放和模拟行情时不联网
         """
-        # 首先检查是否在映射表中
-        if symbol.upper() in self.forex_code_map:
-            return True
-        # 外汇代码通常是6个字母组成，前3个是基础货币，后3个是报价货币
-        return bool(re.match(r'^[A-Z]{6}$', symbol)) and symbol != "SH513100" and symbol != "SH513500" and symbol != "SH513180" and symbol != "IBIT"
-    
-    def is_crypto_symbol(self, symbol):
+        loaded = symbol_directory.load()
+        if (not loaded or symbol_directory.is_stale()) and stock_common.traffic_replayer is None and not stub_provider_active():
+            local_entries = [(symbol, entry['name'], "FX") for symbol, entry in forex_code_map.items()]
+            symbol_directory.download(self.session, local_entries)
+
+    def update_suggestions(self, event=None):
         """
-        判断是否为加密货币符号
+        按输入框中的内容在代码目录中检索，在输入框下方的弹出列表中显示候选
         """
-        crypto_symbols = ['BTC', 'ETH', 'XRP', 'USDT', 'BNB', 'SOL', 'USDC', 'DOGE', 'ADA', 'SHIB']
-        return symbol.upper() in crypto_symbols
+        if event is not None and event.keysym in ("Down", "Up", "Return", "Escape", "Tab"):
+            return
+        matches = symbol_directory.search(self.stock_entry.get())
+        if not matches:
+            self.hide_suggestions()
+            return
+        if self.suggestion_popup is None:
+            # 弹出窗口只创建一次，之后只更新内容和位置
+            self.suggestion_popup = tk.Toplevel(self.root)
+            self.suggestion_popup.overrideredirect(True)
+            self.suggestion_listbox = tk.Listbox(self.suggestion_popup, activestyle="dotbox", exportselection=False)
+            self.suggestion_listbox.pack(fill=tk.BOTH, expand=True)
+            self.suggestion_listbox.bind('<ButtonRelease-1>', self.choose_suggestion)
+            self.suggestion_listbox.bind('<Return>', self.choose_suggestion)
+            self.suggestion_listbox.bind('<Escape>', lambda event: self.hide_suggestions(refocus=True))
+            self.suggestion_listbox.bind('<FocusOut>', lambda event: self.root.after(150, self.hide_suggestions_if_unfocused))
+        self.suggestion_matches = matches
+        self.suggestion_listbox.delete(0, tk.END)
+        for symbol, name, market in matches:
+            self.suggestion_listbox.insert(tk.END, f"{symbol}  {name}  [{market}]")
+        self.suggestion_listbox.configure(height=len(matches))
+        x = self.stock_entry.winfo_rootx()
+        y = self.stock_entry.winfo_rooty() + self.stock_entry.winfo_height()
+        self.suggestion_popup.geometry(f"{max(self.stock_entry.winfo_width(), 280)}x{self.suggestion_listbox.winfo_reqheight()}+{x}+{y}")
+        self.suggestion_popup.deiconify()
+        self.suggestion_popup.lift()
 
-    def get_crypto_info(self, symbol):
+    def focus_suggestions(self, event=None):
         """
-        从528btc网站获取加密货币信息
+        按下方向键时把焦点移到候选列表
         """
-        symbol = symbol.upper()
-        
-        # 定义加密货币映射
-        crypto_mapping = {
-            'BTC': {'name': 'Bitcoin', 'id': 3008},
-            'ETH': {'name': 'Ethereum', 'id': 3007},
-            'XRP': {'name': 'Ripple', 'id': 3006},
-            'USDT': {'name': 'Tether', 'id': 32675},
-            'BNB': {'name': 'Binance Coin', 'id': 3155},
-            'SOL': {'name': 'Solana', 'id': 10114},
-            'USDC': {'name': 'USD Coin', 'id': 8249},
-            'DOGE': {'name': 'Dogecoin', 'id': 2993},
-            'ADA': {'name': 'Cardano', 'id': 3010},
-            'SHIB': {'name': 'Shiba Inu', 'id': 10547},
-        }
-        
-        if symbol not in crypto_mapping:
-            return None
-        
-        html_content = ""
-        try:
-            url = f"https://www.528btc.com/coin/{crypto_mapping[symbol]['id']}/kline-24h"
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Referer": "https://www.528btc.com/"
-            }
-            
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            
-            # 解析HTML内容
-            html_content = response.text
-            
-            # 提取价格信息
-            price_match = re.search(r'<i class="price_num word(Rise|Fall)">\$?([0-9,]+\.?[0-9]*)</i>', html_content)
-            change_match = re.search(r'<span id="rise_fall_amount"[^>]*class="word(Rise|Fall)">([+-])\$?([0-9,]+\.?[0-9]*)</span>', html_content)
-            percent_match = re.search(r'<div id="rise_fall_percent"[^>]*>([+-]?)(?:\s*)([0-9]+\.?[0-9]*)\s*%', html_content)
-            
-            if not price_match:
-                log_error(symbol, html_content, "Could not parse price information")
-                return None
-            
-            # 处理价格中的逗号
-            price_str = price_match.group(2)
-            price = float(price_str.replace(',', ''))
-            
-            change = 0.0
-            percent = 0.0
-            
-            if change_match:
-                # 获取符号和数值
-                sign = change_match.group(2)  # '+' 或 '-'
-                change_str = change_match.group(3)  # 数值部分
-                change_value = float(change_str.replace(',', ''))
-                # 应用符号
-                if sign == '-':
-                    change = -change_value
-                else:
-                    change = change_value
-            
-            if percent_match:
-                # 正确处理正负号
-                sign = percent_match.group(1)  # '+' 或 '-'
-                percent_value = float(percent_match.group(2))
-                if sign == '-':
-                    percent = -percent_value
-                else:
-                    percent = percent_value
-                
-            crypto_info = {
-                "Region": "CRYPTO",
-                "Status": "-", 
-                "Name": crypto_mapping[symbol]['name'],
-                "Symbol": symbol,
-                "Price": price,
-                "Change": change,
-                "Percent": f"{percent:.2f}%"
-            }
-            
-            return crypto_info
-            
-        except requests.exceptions.RequestException as e:
-            log_error(symbol, "", f"Request error: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            log_error(symbol, "", f"JSON parsing error: {e}")
-            return None
-        except Exception as e:
-            log_error(symbol, "", f"Unknown error: {e}")
-            return None
+        if self.suggestion_popup is not None and self.suggestion_popup.winfo_viewable():
+            self.suggestion_listbox.focus_set()
+            self.suggestion_listbox.selection_clear(0, tk.END)
+            self.suggestion_listbox.selection_set(0)
+            self.suggestion_listbox.activate(0)
 
-    def get_eastmoney_forex_info(self, symbol):
+    def choose_suggestion(self, event=None):
         """
-        从东方财富网获取外汇信息
-        支持映射表中的外汇代码和通用的6位外汇代码
+        用选中的候选代码替换输入框中的内容
         """
-        try:
-            symbol = symbol.upper()
-            
-            # 获取对应的secid
-            if symbol in self.forex_code_map:
-                # 使用预定义的secid
-                secid = self.forex_code_map[symbol]['secid']
-                name = self.forex_code_map[symbol]['name']
-            else:
-                # 对于不在映射表中的外汇代码，尝试构造通用的secid
-                # 大多数外汇使用119作为市场代码
-                secid = f"119.{symbol}"
-                # 构造一个通用的名称
-                if len(symbol) == 6:
-                    base_currency = symbol[:3]
-                    quote_currency = symbol[3:]
-                    name = f"{base_currency}/{quote_currency}"
-                else:
-                    name = symbol
-            
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-                'Referer': f'https://quote.eastmoney.com/forex/{symbol}.html'
-            }
-            
-            # 请求东方财富网外汇API
-            api_url = f"https://push2.eastmoney.com/api/qt/stock/get?secid={secid}&fields=f43,f44,f45,f46,f47,f48,f49,f50,f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61,f170,f171,f168"
-            
-            response = requests.get(api_url, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            # 解析JSON数据
-            data = response.json()
-            
-            if data and 'data' in data and data['data'] is not None:
-                api_data = data['data']
-                
-                # 提取名称，如果API返回了名称则使用API的名称
-                if 'f58' in api_data and api_data['f58']:
-                    name = api_data.get('f58')
-                
-                # 提取当前价格 (f43)
-                current_price = None
-                if 'f43' in api_data and api_data['f43']:
-                    current_price = api_data['f43'] / 10000
-                
-                # 计算涨跌额 (f43 - f60)
-                change_amount = None
-                if 'f43' in api_data and 'f60' in api_data and api_data['f43'] and api_data['f60']:
-                    change_amount = (api_data['f43'] - api_data['f60']) / 10000
-                
-                # 提取涨跌幅 (f170)
-                change_percent = None
-                if 'f170' in api_data and api_data['f170']:
-                    change_percent = api_data['f170'] / 100  # 转换为百分比
-                
-                forex_info = {
-                    "Region": "FX",
-                    "Status": "-",
-                    "Name": name,
-                    "Symbol": symbol,
-                    "Price": current_price,
-                    "Change": change_amount,
-                    "Percent": f"{change_percent:.2f}%" if change_percent is not None else "0.00%"
-                }
-                
-                return forex_info
-            else:
-                # 如果不在映射表中且东方财富网没有数据，返回错误
-                error_message = f"未能获取到有效的数据: {symbol}"
-                log_error(symbol, str(data), error_message)
-                return None
-                
-        except requests.exceptions.RequestException as e:
-            error_message = f"网络连接失败: {e}"
-            log_error(symbol, "", error_message)
-            return None
-        except json.JSONDecodeError as e:
-            error_message = f"解析JSON数据失败: {e}"
-            log_error(symbol, "", error_message)
-            return None
-        except Exception as e:
-            error_message = f"发生未知错误: {e}"
-            log_error(symbol, "", error_message)
-            return None
+        selection = self.suggestion_listbox.curselection()
+        if not selection:
+            return
+        symbol = self.suggestion_matches[selection[0]][0]
+        self.stock_entry.delete(0, tk.END)
+        self.stock_entry.insert(0, symbol)
+        self.hide_suggestions(refocus=True)
 
-    def get_forex_info(self, symbol):
+    def hide_suggestions(self, refocus=False):
+        if self.suggestion_popup is not None:
+            self.suggestion_popup.withdraw()
+        if refocus:
+            self.stock_entry.focus_set()
+
+    def hide_suggestions_if_unfocused(self):
         """
-        获取外汇信息，使用东方财富网API
+        焦点离开输入框和候选列表后关闭候选列表
         """
-        return self.get_eastmoney_forex_info(symbol)
-    
-    def get_stock_info(self, symbol):
-        """
-        从腾讯获取股票信息
-        """
-        # 判断是否为加密货币
-        if self.is_crypto_symbol(symbol):
-            return self.get_crypto_info(symbol)
-        
-        # 判断是否为外汇
-        if self.is_forex_symbol(symbol):
-            return self.get_forex_info(symbol)
-
-        # 格式化 symbol
-        symbol_lower = symbol.lower()
-        market_symbol = ""
-        market_type = ""
-        if symbol_lower.startswith(('sh', 'sz')):
-            market_symbol = symbol_lower
-            market_type = "A-Share"
-        elif symbol_lower.startswith('.'): # 指数
-            market_symbol = f"s_us{symbol_lower}"
-            market_type = "Index"
-        elif symbol_lower.startswith('hkhsi'):
-            market_symbol = "s_hkHSI"
-            market_type = "HK-Index"
-        elif symbol_lower.startswith('hkhstech'):
-            market_symbol = "s_hkHSTECH"
-            market_type = "HK-Index"
-        elif symbol_lower.startswith(('hk')):
-            market_symbol = f"hk{symbol_lower[2:]}"
-            market_type = "HK-Share"
-        else: # 默认美股
-            market_symbol = f"us{symbol.upper()}"
-            market_type = "US-Share"
-
-        url = f"https://qt.gtimg.cn/q={market_symbol}"
-        response_text = ""
         try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
-                "Referer": "https://gu.qq.com/"
-            }
-            response = self.session.get(url, headers=headers, verify=False)
-            response_text = response.text
-            response.raise_for_status()
-
-            # 解析返回的字符串
-            data_part = response_text.split('=')[1].strip('"\n;')
-            if not data_part or "none" in data_part:
-                log_error(symbol, response_text, f"No data found for symbol: {symbol}")
-                return None
-
-            if not data_part or "none" in data_part:
-                log_error(symbol, response_text, f"No data found for symbol: {symbol}")
-                return None
-
-            parts = data_part.split('~')
-            
-            stock_info = {}
-            if market_type in ["Index", "HK-Index"]:
-                stock_info = {
-                    "Region": "INDEX",
-                    "Status": "-",
-                    "Name": parts[1],
-                    "Symbol": symbol,
-                    "Price": float(parts[3]),
-                    "Change": float(parts[4]),
-                    "Percent": f"{float(parts[5]):.2f}%"
-                }
-            elif market_type == "US-Share":
-                status = self.get_market_status("US")
-                stock_info = {
-                    "Region": "US",
-                    "Status": status,
-                    "Name": parts[1],
-                    "Symbol": symbol,
-                    "Price": float(parts[3]),
-                    "Change": float(parts[31]),
-                    "Percent": f"{float(parts[32]):.2f}%",
-                    "extPrice": float(parts[22]),
-                    "extChange": float(parts[23]),
-                    "extPercent": f"{float(parts[24]):.2f}%"
-                }
-            else: # A-Share / HK-Share
-                region = "SH" if symbol.startswith("SH") else "SZ" if symbol.startswith("SZ") else "HK"
-                status = self.get_market_status(region)
-                stock_info = {
-                    "Region": region,
-                    "Status": status,
-                    "Name": parts[1],
-                    "Symbol": symbol,
-                    "Price": float(parts[3]),
-                    "Change": float(parts[31]),
-                    "Percent": f"{float(parts[32]):.2f}%"
-                }
-            
-            return stock_info
+            focus = self.root.focus_get()
+        except (KeyError, tk.TclError):
+            focus = None
+        if focus not in (self.stock_entry, self.suggestion_listbox):
+            self.hide_suggestions()
 
-        except requests.exceptions.RequestException as e:
-            log_error(symbol, "", f"Request error: {e}")
-            return None
-        except (IndexError, ValueError) as e:
-            log_error(symbol, response_text, f"Parsing error: {e}")
-            return None
-        except Exception as e:
-            log_error(symbol, response_text, f"Unknown error: {e}")
-            return None
-    
-    def get_market_status(self, market):
-        """
-        根据当前时间判断市场状态
-        """
-        now = datetime.now()
-        weekday = now.weekday()  # Monday is 0 and Sunday is 6
-        
-        # Weekend
-        if weekday >= 5:
-            return "CLOSED"
-        
-        current_time = now.time()
-        
-        if market in ["SH", "SZ"]:  # A股市场
-            # A股交易时间:
-            # 上午: 9:30 - 11:30
-            # 下午: 13:00 - 15:00
-            morning_open = dt_time(9, 30)
-            morning_close = dt_time(11, 30)
-            afternoon_open = dt_time(13, 0)
-            afternoon_close = dt_time(15, 0)
-            
-            if (morning_open <= current_time <= morning_close) or \
-               (afternoon_open <= current_time <= afternoon_close):
-                return "OPEN"
-            else:
-                return "CLOSED"
-                
-        elif market == "HK":  # 港股市场
-            # 港股交易时间:
-            # 上午: 9:30 - 12:00
-            # 下午: 13:00 - 16:00
-            morning_open = dt_time(9, 30)
-            morning_close = dt_time(12, 0)
-            afternoon_open = dt_time(13, 0)
-            afternoon_close = dt_time(16, 0)
-            
-            if (morning_open <= current_time <= morning_close) or \
-               (afternoon_open <= current_time <= afternoon_close):
-                return "OPEN"
-            else:
-                return "CLOSED"
-        
-        elif market == "US": # 美股市场
-            # 美股夏令时交易时间 (北京时间):
-            # 晚上: 21:30 - 凌晨 4:00
-            # 美股冬令时交易时间 (北京时间):
-            # 晚上: 22:30 - 凌晨 5:00
-            
-            # 简单处理，不区分冬夏令时，按夏令时计算
-            trading_open_evening = dt_time(21, 30)
-            trading_close_evening = dt_time(23, 59, 59)
-            trading_open_morning = dt_time(0, 0)
-            trading_close_morning = dt_time(4, 0)
-
-            if (trading_open_evening <= current_time <= trading_close_evening) or \
-               (trading_open_morning <= current_time <= trading_close_morning):
-                return "OPEN"
-            else:
-                return "CLOSED"
+    # 腾讯行情请求头
+    tencent_headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+        "Referer": "https://gu.qq.com/"
+    }
 
-        # Default case
-        return "-"
-    
-    def trigger_data_load(self):
+    def fetch_quotes(self, symbols, skip_quarantined=True):
+        """
+        并发获取一组代码的行情，返回 {symbol: stock_info} 字典（只包含成功的结果）
+        股票合并为批量请求，外汇和加密货币在首选提供方不支持批量时单独请求；仍在隔离期内的失效代码默认跳过
+        """
+        if skip_quarantined:
+            symbols, _ = symbol_quarantine.split_due(symbols)
+        results = {}
+        # 共享缓存只保存核心字段，显示附加列时自行获取
+        shared_cache = None if self.extra_columns else get_shared_quote_cache()
+        if shared_cache is not None:
+            missing = []
+            for symbol in symbols:
+                stock_info = shared_cache.get(symbol, SHARED_QUOTE_MAX_AGE)
+                if stock_info is None or not tencent_wire_format.covers(stock_info, get_tencent_market_symbol(symbol)[1]):
+                    missing.append(symbol)
+                else:
+                    results[symbol] = stock_info
+            symbols = missing
+        batched = {}
+        with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+            future_to_symbols = {}
+            for symbol in symbols:
+                asset = "crypto" if is_crypto_symbol(symbol) else "forex" if is_forex_symbol(symbol) else "equity"
+                if asset == "equity" or batches_asset(asset):
+                    batched.setdefault(asset, []).append(symbol)
+                elif asset == "crypto":
+                    future_to_symbols[executor.submit(get_crypto_info, symbol)] = (False, [symbol])
+                else:
+                    future_to_symbols[executor.submit(get_forex_info, symbol)] = (False, [symbol])
+
+            for asset, asset_symbols in batched.items():
+                for i in range(0, len(asset_symbols), TENCENT_BATCH_SIZE):
+                    chunk = asset_symbols[i:i + TENCENT_BATCH_SIZE]
+                    future = executor.submit(fetch_from_providers, self.session, chunk, self.tencent_headers, asset)
+                    future_to_symbols[future] = (True, chunk)
+
+            for future in as_completed(future_to_symbols):
+                is_batch, chunk = future_to_symbols[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    for symbol in chunk:
+                        log_error(symbol, "", f"Error getting data for {symbol}: {e}")
+                    continue
+                if is_batch:
+                    fetched = {s: info for s, info in result.items() if info}
+                elif result and not result.get("error"):
+                    fetched = {chunk[0]: result}
+                else:
+                    error = result.get("error") if result else None
+                    state = "INVALID" if error == "InvalidSymbol" else "FAILING"
+                    symbol_quarantine.record_failure(chunk[0], state, (result or {}).get("message", "no data"))
+                    continue
+                if shared_cache is not None:
+                    shared_cache.put_many(fetched.values())
+                results.update(fetched)
+        for symbol, stock_info in results.items():
+            symbol_quarantine.record_success(symbol)
+            if "Region" not in stock_info:
+                # 模拟行情的数据没有地区字段
+                stock_info["Region"] = get_quote_region(symbol)
+        symbol_metadata.save_if_dirty()
+        return results
+
+    def trigger_data_load(self, symbols=None):
         """
-        在后台线程中触发数据加载
+        在后台加载线程中获取数据，默认刷新当前列表；已有加载在进行时合并到待加载的代码中
         """
-        self.status_var.set("正在获取数据...")
+        if symbols is None:
+            self.last_refresh_time = time.time()
+            self.status_var.set("正在获取数据...")
+        with self.load_lock:
+            if symbols is None:
+                self.load_pending_full = True
+            else:
+                self.load_pending.update(symbols)
+            if self.loader_running:
+                return
+            self.loader_running = True
         # 使用线程以避免阻塞GUI
-        threading.Thread(target=self.load_stock_data, daemon=True).start()
+        threading.Thread(target=self.loader_worker, daemon=True).start()
 
-    def load_stock_data(self):
-        """
-        加载并显示股票数据（在后台线程中运行）
-        """
-        if not self.current_stocks:
-            self.last_stock_data = []
-            # 在主线程中更新GUI
-            self.root.after(0, self.update_gui_with_data)
+    def loader_worker(self):
+        """
+        加载线程：依次处理待加载的代码，直到没有新的请求；获取、变化检测和发布都只在这个线程中进行
+        """
+        while True:
+            with self.load_lock:
+                if not self.load_pending_full and not self.load_pending:
+                    self.loader_running = False
+                    return
+                full = self.load_pending_full
+                if full:
+                    # 整表刷新会获取当前列表，不在列表中的代码（如托盘固定显示的代码）留到下一轮
+                    symbols = None
+                    self.load_pending -= set(self.current_stocks)
+                else:
+                    symbols = list(self.load_pending)
+                    self.load_pending = set()
+                self.load_pending_full = False
+            try:
+                self.load_stock_data(symbols)
+            except Exception as e:
+                log_error("LOADER", "", f"Error loading stock data: {e}")
+
+    def load_stock_data(self, symbols=None):
+        """
+        获取行情并写入共享缓存，然后用缓存重绘当前列表（在加载线程中运行）
+        只刷新部分代码时，若当前列表没有任何变化则跳过重绘
+        """
+        force_render = symbols is None
+        if symbols is None:
+            symbols = list(self.current_stocks)
+        
+        if symbols:
+            with trace_span("fetch", symbols=len(symbols)):
+                quotes = self.fetch_quotes(symbols)
+            with self.cache_lock:
+                for symbol, stock_info in quotes.items():
+                    note_exchange_time(self.quote_cache.get(symbol), stock_info)
+                self.quote_cache.update(quotes)
+            # 隐藏到托盘时也继续聚合 K 线
+            for stock_info in quotes.values():
+                bar_aggregator.update(stock_info)
+            bar_aggregator.flush()
+
+        # 隐藏到托盘时不渲染表格，只更新托盘提示
+        if self.is_minimized_to_tray:
+            self.update_tray_summary()
             return
-        
-        all_stock_info = []
-        # 使用线程池并发获取数据
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            # 创建一个从 future 到 symbol 的映射
-            future_to_symbol = {executor.submit(self.get_stock_info, symbol): symbol for symbol in self.current_stocks}
-            
-            for future in as_completed(future_to_symbol):
-                try:
-                    stock_info = future.result()
-                    if stock_info:
-                        all_stock_info.append(stock_info)
-                except Exception as e:
-                    symbol = future_to_symbol[future]
-                    log_error(symbol, "", f"Error getting data for {symbol}: {e}")
 
-        # 按原始顺序排序结果
-        symbol_order = {symbol: i for i, symbol in enumerate(self.current_stocks)}
-        all_stock_info.sort(key=lambda x: symbol_order.get(x['Symbol'], float('inf')))
+        # 本次获取的代码都不在当前列表中时无需重绘
+        if not force_render and not self.visible_symbols.intersection(symbols):
+            return
 
-        # 保存最新数据
+        # 按当前列表的顺序从缓存生成数据，并记录与上一次相比发生变化的行
+        with trace_span("sort", rows=len(self.current_stocks)):
+            all_stock_info = self.get_cached_stock_data(self.current_stocks)
+            changes = self.change_tracker.diff(all_stock_info)
+        if not force_render and not changes and len(all_stock_info) == len(self.last_stock_data):
+            return
+        self.pending_changes = changes
         self.last_stock_data = all_stock_info
         # 在主线程中更新GUI
         try:
@@ -821,15 +984,57 @@ class StockQuoteGUI:
             # 避免在窗口销毁后调用 after 导致的错误
             pass
 
+    def get_cached_stock_data(self, symbols):
+        """
+        按给定顺序从共享缓存中取出行情
+        没有缓存的被隔离代码生成一个占位行，在表格中显示其隔离状态；
+        尚未获取到行情的代码用元数据缓存中的名称生成占位行
+        """
+        stock_data = []
+        with self.cache_lock:
+            for symbol in symbols:
+                if symbol in self.quote_cache:
+                    stock_data.append(self.quote_cache[symbol])
+                    continue
+                entry = symbol_quarantine.get(symbol)
+                meta = symbol_metadata.get(symbol)
+                if entry:
+                    stock_data.append({"Symbol": symbol, "Status": entry["state"],
+                                       "Name": QUARANTINE_LABELS[entry["state"]]})
+                elif meta:
+                    stock_data.append({"Symbol": symbol, "Status": "-", "Name": meta["name"],
+                                       "Region": meta["region"] or "-"})
+        return stock_data
+
+    def prune_quote_cache(self):
+        """
+        从缓存中删除不属于任何列表的代码
+        """
+        active = set(self.get_all_symbols()) | set(self.pinned_symbols)
+        with self.cache_lock:
+            for symbol in [s for s in self.quote_cache if s not in active]:
+                del self.quote_cache[symbol]
+
     def update_gui_with_data(self):
         """
         用获取到的数据更新GUI（在主线程中运行）
         """
+        with trace_span("render", rows=len(self.last_stock_data)):
+            self.render_stock_table()
+
+    def render_stock_table(self):
+        """
+        按最近一次的数据重建表格控件
+        """
         all_stock_info = self.last_stock_data
+        # 变化高亮只在数据刷新后的第一次重绘时显示
+        changes = self.pending_changes
+        self.pending_changes = {}
         
         # 如果选中，则只显示交易中的数据
         if self.show_trading_only.get():
-            all_stock_info = [stock for stock in all_stock_info if stock.get('Status') != "CLOSED"]
+            with trace_span("filter", rows=len(all_stock_info)):
+                all_stock_info = [stock for stock in all_stock_info if stock.get('Status') != "CLOSED"]
             
         # 清除现有内容
         for widget in self.scrollable_frame.winfo_children():
@@ -869,6 +1074,12 @@ class StockQuoteGUI:
                         {"name": "extPercent", "weight": 1, "minsize": 80},
                     ]
                     column_config = column_config[:name_index+1] + ext_columns + column_config[name_index+1:]
+            column_config += [{"name": name, "weight": 1, "minsize": 140 if name == "QuoteTime" else 80}
+                              for name in self.extra_columns]
+            bar_period = self.bar_period_var.get()
+            if bar_period:
+                column_config += [{"name": "Trend", "weight": 2, "minsize": 160},
+                                  {"name": "Range", "weight": 1, "minsize": 120}]
 
             
             # 创建表头
@@ -879,6 +1090,7 @@ class StockQuoteGUI:
                 label.grid(row=0, column=col, sticky="ew")
             
             # 添加数据行
+            flashed_labels = []
             for row, stock in enumerate(all_stock_info, start=1):
                 # 根据状态设置显示的文字
                 status_text = stock.get('Status', '')
@@ -891,11 +1103,31 @@ class StockQuoteGUI:
                 
                 # 显示每列数据
                 data_values = [stock.get(col['name'], '-') for col in column_config]
+                if bar_period:
+                    data_values[-2:] = bar_aggregator.summary(stock.get('Symbol'), bar_period) or ('-', '-')
+                
+                # 计算需要高亮的列（首次出现的代码不高亮）
+                change = changes.get(stock.get('Symbol'))
+                flash_columns = set()
+                flash_style = "TLabel"
+                if change:
+                    mask, direction = change
+                    for field in ChangeTracker.changed_fields(mask):
+                        flash_columns.update(FLASH_COLUMNS[field])
+                    # 红涨绿跌，价格未变时用中性色
+                    flash_style = "Rise.TLabel" if direction > 0 else "Fall.TLabel" if direction < 0 else "Flash.TLabel"
                 
                 for col, value in enumerate(data_values):
-                    label = ttk.Label(table_frame, text=str(value), 
+                    column_name = column_config[col]['name']
+                    style = flash_style if column_name in flash_columns else "TLabel"
+                    label = ttk.Label(table_frame, text=str(value), style=style,
                                      borderwidth=1, relief="solid", padding=(5, 2))
                     label.grid(row=row, column=col, sticky="ew")
+                    if style != "TLabel":
+                        flashed_labels.append(label)
+            
+            if flashed_labels:
+                self.root.after(FLASH_DURATION_MS, lambda labels=flashed_labels: self.clear_flash(labels))
             
             # 配置列权重和最小尺寸
             for i, config in enumerate(column_config):
@@ -905,9 +1137,75 @@ class StockQuoteGUI:
             label = ttk.Label(self.scrollable_frame, text="未能获取任何股票数据")
             label.pack()
         
+        self.update_listbox_states()
+        
         # 更新状态栏
         self.status_var.set(f"上次更新: {time.strftime('%H:%M:%S')} - 刷新间隔: {self.refresh_interval}秒")
-        self.last_refresh_time = time.time()
+    
+    def update_listbox_states(self):
+        """
+        在管理列表中用灰色标出被隔离的失效代码
+        """
+        for index, symbol in enumerate(self.stock_listbox.get(0, tk.END)):
+            entry = symbol_quarantine.get(symbol)
+            self.stock_listbox.itemconfig(index, foreground="gray" if entry else "")
+    
+    # 附加列菜单中的选项及其对应的字段
+    OPTIONAL_COLUMN_GROUPS = [
+        ("开盘价", ["Open"]),
+        ("昨收", ["PrevClose"]),
+        ("最高/最低", ["High", "Low"]),
+        ("成交量", ["Volume"]),
+        ("成交额", ["Turnover"]),
+        ("行情时间", ["QuoteTime"]),
+        ("买一/卖一", ["Bid1", "BidVol1", "Ask1", "AskVol1"]),
+    ]
+
+    def update_extra_columns(self):
+        """
+        根据附加列菜单的勾选状态更新显示的列，并保存到 settings.json
+        """
+        self.extra_columns = [field for label, fields in self.OPTIONAL_COLUMN_GROUPS
+                              if self.column_vars[label].get() for field in fields]
+        self.settings_store.save(dict(self.settings_store.load(), extra_columns=self.extra_columns))
+        self.update_wire_format()
+
+    # 走势菜单中的选项及其对应的 K 线周期
+    BAR_PERIOD_OPTIONS = [
+        ("不显示", ""),
+        ("1 分钟", "1m"),
+        ("5 分钟", "5m"),
+        ("15 分钟", "15m"),
+        ("1 小时", "1h"),
+    ]
+
+    def update_bar_period(self):
+        """
+        按走势菜单的选择显示或隐藏走势和区间列，并保存到 settings.json
+        """
+        self.settings_store.save(dict(self.settings_store.load(), bar_period=self.bar_period_var.get()))
+        self.update_gui_with_data()
+
+    def update_wire_format(self):
+        """
+        按显示的列（盘前盘后数据、附加列）选择腾讯行情格式并重绘；
+        新显示的列需要简要行情没有的数据时立即重新获取当前列表
+        """
+        richer = tencent_wire_format.configure(self.show_extended_data.get(), self.extra_columns)
+        self.update_gui_with_data()
+        if richer:
+            self.trigger_data_load()
+
+    def clear_flash(self, labels):
+        """
+        取消变化单元格的高亮
+        """
+        for label in labels:
+            try:
+                if label.winfo_exists():
+                    label.configure(style="TLabel")
+            except tk.TclError:
+                pass
     
     def add_stock(self):
         """
@@ -917,20 +1215,62 @@ class StockQuoteGUI:
         if not stock_code:
             messagebox.showwarning("输入错误", "请输入股票代码")
             return
+        self.hide_suggestions()
+        
+        # 名称、拼音首字母或不带市场前缀的数字代码在本地代码目录中唯一对应一个代码时直接使用该代码；
+        # 目录中没有的代码（指数、外汇、加密货币除外）先询问是否仍要联网验证
+        resolved = symbol_directory.resolve(stock_code)
+        if resolved:
+            stock_code = resolved
+        elif (symbol_directory.available() and not is_forex_symbol(stock_code)
+              and not is_crypto_symbol(stock_code)
+              and get_tencent_market_symbol(stock_code)[1] not in ["Index", "HK-Index"]):
+            if not messagebox.askyesno("未知代码", f"本地代码目录中没有 {stock_code}，仍要获取一次行情进行验证吗？"):
+                return
         
         if stock_code in self.current_stocks:
             messagebox.showwarning("重复添加", f"股票 {stock_code} 已存在")
             return
         
+        # 已确认无效的代码直接拒绝，其他代码先试探性获取一次行情
+        entry = symbol_quarantine.get(stock_code)
+        if entry and entry["state"] == "INVALID":
+            messagebox.showwarning("无效代码", f"无法获取 {stock_code} 的行情: {symbol_quarantine.describe(stock_code)}")
+            return
+        
+        self.stock_entry.delete(0, tk.END)
+        self.status_var.set(f"正在验证 {stock_code}...")
+        threading.Thread(target=self.probe_new_stock, args=(stock_code,), daemon=True).start()
+    
+    def probe_new_stock(self, stock_code):
+        """
+        在后台获取一次新代码的行情（在后台线程中运行），结果交给主线程处理
+        """
+        stock_info = self.fetch_quotes([stock_code], skip_quarantined=False).get(stock_code)
+        try:
+            self.root.after(0, lambda: self.finish_add_stock(stock_code, stock_info))
+        except tk.TclError:
+            pass
+    
+    def finish_add_stock(self, stock_code, stock_info):
+        """
+        试探获取成功后才把代码加入当前列表
+        """
+        if stock_info is None:
+            reason = symbol_quarantine.describe(stock_code) or "未获取到数据"
+            messagebox.showwarning("无效代码", f"无法获取 {stock_code} 的行情: {reason}")
+            self.update_status_bar()
+            return
+        if stock_code in self.current_stocks:
+            return
+        
+        with self.cache_lock:
+            self.quote_cache[stock_code] = stock_info
         self.current_stocks.append(stock_code)
         self.stock_listbox.insert(tk.END, stock_code)
-        self.stock_entry.delete(0, tk.END)
-        self.trigger_data_load()
-        # 根据当前模式保存到对应的文件
-        if self.current_mode == 'favorites':
-            self.save_favorites(self.current_stocks)
-        else:
-            self.save_indexes(self.current_stocks)
+        self.save_current_list()
+        self.last_stock_data = self.get_cached_stock_data(self.current_stocks)
+        self.update_gui_with_data()
     
     def remove_stock(self):
         """
@@ -945,12 +1285,11 @@ class StockQuoteGUI:
         stock_code = self.stock_listbox.get(index)
         self.current_stocks.remove(stock_code)
         self.stock_listbox.delete(index)
-        self.trigger_data_load()
-        # 根据当前模式保存到对应的文件
-        if self.current_mode == 'favorites':
-            self.save_favorites(self.current_stocks)
-        else:
-            self.save_indexes(self.current_stocks)
+        self.save_current_list()
+        self.prune_quote_cache()
+        # 直接用缓存重绘，无需重新获取
+        self.last_stock_data = self.get_cached_stock_data(self.current_stocks)
+        self.update_gui_with_data()
     
     def update_interval(self):
         """
@@ -960,6 +1299,11 @@ class StockQuoteGUI:
             new_interval = int(self.interval_var.get())
             if 5 <= new_interval <= 300:
                 self.refresh_interval = new_interval
+                self.watchlists[self.current_mode]['interval'] = new_interval
+                self.save_watchlists()
+                self.sync_scheduler()
+                for symbol in self.current_stocks:
+                    self.scheduler.reschedule(symbol)
                 self.status_var.set(f"刷新间隔已更新为 {self.refresh_interval}秒")
             else:
                 messagebox.showwarning("输入错误", "刷新间隔必须在5-300秒之间")
@@ -979,7 +1323,8 @@ class StockQuoteGUI:
             # 重启刷新工作线程
             self.root.after(1000, self.refresh_worker)
             # 初始化倒计时显示
-            remaining = int(self.refresh_interval - (time.time() - self.last_refresh_time))
+            next_due = self.scheduler.next_due()
+            remaining = max(0, int(next_due - time.time())) if next_due else self.refresh_interval
             self.remaining_time_var.set(f"下次刷新: {remaining}秒")
         else:
             self.refresh_menu_item_label.set("开始刷新")
@@ -995,62 +1340,130 @@ class StockQuoteGUI:
         """
         显示指数
         """
-        self.current_mode = 'indexes'
-        
-        # 禁用编辑功能
-        self.edit_button.config(state=tk.DISABLED)
-        if self.edit_frame_visible:
-            self.toggle_edit_frame()
-            
-        # 从文件加载指数列表
-        self.current_stocks = self.load_indexes()
-        
-        # 更新列表框
-        self.stock_listbox.delete(0, tk.END)
-        for stock in self.current_stocks:
-            self.stock_listbox.insert(tk.END, stock)
-        
-        # 加载数据
-        self.trigger_data_load()
-        
-        # 更新状态栏
-        self.update_status_bar("已加载指数列表")
+        self.show_watchlist('indexes')
     
     def show_favorites(self):
         """
         显示自选股
         """
-        self.current_mode = 'favorites'
-        
-        # 启用编辑功能
-        self.edit_button.config(state=tk.NORMAL)
+        self.show_watchlist('favorites')
+    
+    def show_watchlist(self, name):
+        """
+        切换到指定列表，直接用共享缓存渲染，只获取缓存中没有的代码
+        """
+        self.current_mode = name
+        self.current_stocks = self.watchlists[name]['symbols']
         
-        # 从文件重新加载自选股，以确保获取最新列表
-        self.current_stocks = self.load_favorites()
+        # 指数列表不可编辑
+        if name == 'indexes':
+            self.edit_button.config(state=tk.DISABLED)
+            if self.edit_frame_visible:
+                self.toggle_edit_frame()
+        else:
+            self.edit_button.config(state=tk.NORMAL)
         
         # 更新列表框
         self.stock_listbox.delete(0, tk.END)
         for stock in self.current_stocks:
             self.stock_listbox.insert(tk.END, stock)
         
-        # 加载数据
-        self.trigger_data_load()
+        # 刷新间隔跟随列表
+        self.refresh_interval = self.watchlists[name]['interval']
+        self.interval_var.set(str(self.refresh_interval))
+        self.watchlist_var.set(self.get_watchlist_label(name))
+        
+        # 当前列表的代码优先刷新
+        self.sync_scheduler()
+        for symbol in self.current_stocks:
+            self.scheduler.reschedule(symbol)
+        
+        # 从缓存立即渲染
+        self.pending_changes = {}
+        self.last_stock_data = self.get_cached_stock_data(self.current_stocks)
+        self.update_gui_with_data()
+        
+        with self.cache_lock:
+            missing = [s for s in self.current_stocks if s not in self.quote_cache]
+        if missing:
+            self.trigger_data_load(missing)
         
         # 更新状态栏
-        self.update_status_bar("已加载自选股列表")
+        self.update_status_bar(f"已加载{self.get_watchlist_label(name)}列表")
+    
+    def update_watchlist_combo(self):
+        """
+        更新列表选择框的选项
+        """
+        self.watchlist_combo['values'] = [self.get_watchlist_label(name) for name in self.watchlists]
+    
+    def on_watchlist_selected(self, event=None):
+        """
+        从选择框切换列表
+        """
+        label = self.watchlist_var.get()
+        for name in self.watchlists:
+            if self.get_watchlist_label(name) == label:
+                self.show_watchlist(name)
+                break
+    
+    def create_watchlist(self):
+        """
+        新建命名列表
+        """
+        name = simpledialog.askstring("新建列表", "列表名称:", parent=self.root)
+        if not name:
+            return
+        name = name.strip()
+        if not name or name in self.watchlists or name in self.BUILTIN_WATCHLISTS.values():
+            messagebox.showwarning("输入错误", f"列表 {name} 已存在或名称无效")
+            return
+        self.watchlists[name] = {'symbols': [], 'interval': self.DEFAULT_WATCHLIST_INTERVAL}
+        self.save_watchlists()
+        self.update_watchlist_combo()
+        self.show_watchlist(name)
+    
+    def delete_watchlist(self):
+        """
+        删除当前命名列表（内置列表不可删除）
+        """
+        name = self.current_mode
+        if name in self.BUILTIN_WATCHLISTS:
+            messagebox.showwarning("操作错误", "自选股和指数列表不能删除")
+            return
+        if not messagebox.askyesno("删除列表", f"确定删除列表 {name} 吗？"):
+            return
+        del self.watchlists[name]
+        self.save_watchlists()
+        self.update_watchlist_combo()
+        self.prune_quote_cache()
+        self.show_watchlist('favorites')
     
     def refresh_worker(self):
         """
-        刷新工作函数
+        刷新工作函数：每秒从调度器取出到期的代码并获取
         """
         if self.refresh_active:
-            current_time = time.time()
-            if current_time - self.last_refresh_time >= self.refresh_interval:
-                self.trigger_data_load()
-                # last_refresh_time will be updated in update_gui_with_data
-            else:
-                remaining = int(self.refresh_interval - (current_time - self.last_refresh_time))
-                self.remaining_time_var.set(f"下次刷新: {remaining}秒")
+            if self.is_minimized_to_tray:
+                # 后台模式：按托盘刷新间隔只获取固定显示的代码，不检查文件也不渲染
+                current_time = time.time()
+                if self.pinned_symbols and current_time - self.tray_last_refresh >= self.tray_refresh_interval:
+                    self.tray_last_refresh = current_time
+                    self.trigger_data_load(list(self.pinned_symbols))
+                self.root.after(self.TRAY_TICK_MS, self.refresh_worker)
+                return
+            
+            self.check_watchlist_files()
+            
+            # 取出到期的代码合并为一次获取，请求随调度均匀分散
+            with trace_span("schedule"):
+                due_symbols = self.scheduler.pop_due()
+            if due_symbols:
+                self.trigger_data_load(due_symbols)
+            
+            next_due = self.scheduler.next_due()
+            remaining = max(0, int(next_due - time.time())) if next_due else self.refresh_interval
+            self.remaining_time_var.set(f"下次刷新: {remaining}秒")
             
             # 每秒调用一次
             self.root.after(1000, self.refresh_worker)
@@ -1083,11 +1496,13 @@ class StockQuoteGUI:
                 # 如果没有图标文件，创建一个简单的图标
                 image = Image.new('RGB', (64, 64), color = (73, 109, 137))
             
-            # 创建托盘图标菜单
-            menu = (
+            # 创建托盘图标菜单，固定显示的代码的行情排在最前面
+            menu = pystray.Menu(lambda: (
+                *(pystray.MenuItem(line, None, enabled=False) for line in self.get_pinned_quote_lines()),
+                pystray.Menu.SEPARATOR,
                 pystray.MenuItem('显示', self.show_window),
                 pystray.MenuItem('退出', self.quit_app)
-            )
+            ))
             
             # 创建托盘图标
             self.icon = pystray.Icon("stock_quote", image, "带薪看盘", menu)
@@ -1098,20 +1513,177 @@ class StockQuoteGUI:
         except Exception as e:
             log_error("TRAY_ICON", "", f"Error setting up tray icon: {e}")
     
+    # 托盘后台模式的默认刷新间隔（秒）和检查周期（毫秒）
+    DEFAULT_TRAY_REFRESH_INTERVAL = 120
+    TRAY_TICK_MS = 5000
+
+    def get_pinned_quote_lines(self):
+        """
+        返回托盘中显示的固定代码行情
+        """
+        lines = []
+        with self.cache_lock:
+            for symbol in self.pinned_symbols:
+                stock = self.quote_cache.get(symbol)
+                if stock:
+                    lines.append(f"{symbol} {stock.get('Price', '-')} {stock.get('Percent', '-')}")
+                else:
+                    lines.append(f"{symbol} -")
+        return lines
+
+    def update_tray_summary(self):
+        """
+        用固定代码的最新行情更新托盘提示和菜单
+        """
+        if not self.icon:
+            return
+        try:
+            # Windows 托盘提示最长 127 个字符
+            self.icon.title = "\n".join(["带薪看盘"] + self.get_pinned_quote_lines())[:127]
+            self.icon.update_menu()
+        except Exception as e:
+            log_error("TRAY_ICON", "", f"Error updating tray icon: {e}")
+
+    def configure_tray(self):
+        """
+        设置托盘后台模式的刷新间隔和固定显示的代码
+        """
+        interval = simpledialog.askinteger("托盘设置", "隐藏到托盘时的刷新间隔(秒):",
+                                           initialvalue=self.tray_refresh_interval,
+                                           minvalue=10, maxvalue=3600, parent=self.root)
+        if interval is None:
+            return
+        pinned = simpledialog.askstring("托盘设置", "托盘中显示的代码（逗号分隔）:",
+                                        initialvalue=",".join(self.pinned_symbols), parent=self.root)
+        if pinned is None:
+            return
+        self.tray_refresh_interval = interval
+        self.pinned_symbols = [s.strip().upper() for s in pinned.split(',') if s.strip()]
+        self.settings_store.save(dict(self.settings_store.load(),
+                                      tray_refresh_interval=interval,
+                                      pinned_symbols=self.pinned_symbols))
+
+    def update_title(self):
+        """
+        在窗口标题中标出录制或回放状态
+        """
+        title = "带薪看盘 v1.2"
+        if stock_common.traffic_recorder is not None:
+            title += " [录制中]"
+        if stock_common.traffic_replayer is not None:
+            title += f" [回放 ×{stock_common.traffic_replayer.speed:g}]"
+        if stub_provider_active():
+            title += " [模拟行情]"
+        self.root.title(title)
+
+    def toggle_recording(self):
+        """
+        开始或停止录制上游原始响应
+        """
+        if self.record_var.get():
+            if stock_common.traffic_replayer is not None:
+                messagebox.showwarning("录制", "回放时不能录制")
+                self.record_var.set(False)
+                return
+            path = start_recording("stock")
+            messagebox.showinfo("录制", f"上游响应将录制到:\n{path}")
+        else:
+            stop_recording()
+        self.update_title()
+
+    def open_replay(self):
+        """
+        选择录制文件和回放速度，之后的刷新都从录制文件获取，不访问网络
+        """
+        path = filedialog.askopenfilename(title="选择录制文件", initialdir=get_recordings_dir(),
+                                          filetypes=[("录制文件", "*.ndjson.gz")], parent=self.root)
+        if not path:
+            return
+        speed = simpledialog.askfloat("回放速度", "回放倍速（例如 10 表示 10 倍速）:",
+                                      initialvalue=1.0, minvalue=0.1, maxvalue=1000, parent=self.root)
+        if speed is None:
+            return
+        stop_recording()
+        self.record_var.set(False)
+        try:
+            start_replay(path, speed)
+        except (OSError, ValueError) as e:
+            messagebox.showwarning("回放", f"无法读取录制文件: {e}")
+            return
+        bar_aggregator.reset()
+        self.update_title()
+        self.trigger_data_load()
+
+    def toggle_stub_provider(self):
+        """
+        切换离线模拟行情：所有代码由本地随机游走生成，不访问网络
+        """
+        use_stub_provider(self.stub_var.get())
+        bar_aggregator.reset()
+        self.update_title()
+        self.trigger_data_load()
+
+    def toggle_tracing(self):
+        """
+        开始记录刷新各阶段的耗时，再次点击时停止并保存为 Chrome trace-event JSON
+        """
+        if self.trace_var.get():
+            start_tracing()
+            return
+        path = self.save_trace()
+        if path:
+            messagebox.showinfo("刷新跟踪", f"跟踪已保存到:\n{path}\n\n可在 chrome://tracing 或 Perfetto 中打开")
+
+    def save_trace(self):
+        """
+        停止跟踪并保存到 traces 目录，返回文件路径
+        """
+        if stock_common.tracer is None:
+            return None
+        path = os.path.join(get_traces_dir(), datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+        try:
+            stop_tracing(path)
+        except OSError as e:
+            log_error("TRACE", "", f"Failed to save trace: {e}")
+            return None
+        return path
+
+    def close_replay(self):
+        """
+        停止回放，恢复访问网络
+        """
+        if stock_common.traffic_replayer is None:
+            return
+        stop_replay()
+        bar_aggregator.reset()
+        self.update_title()
+        self.trigger_data_load()
+
     def minimize_to_tray(self):
         """
-        最小化到系统托盘
+        最小化到系统托盘，进入后台模式
         """
         self.root.withdraw()  # 隐藏窗口
         self.is_minimized_to_tray = True
+        self.tray_last_refresh = time.time()
+        self.update_tray_summary()
     
     def show_window(self, icon=None, item=None):
         """
-        从系统托盘恢复窗口
+        从系统托盘恢复窗口，并立即用缓存重绘、刷新当前列表
         """
         self.root.deiconify()  # 显示窗口
         self.root.lift()  # 将窗口提升到顶层
         self.is_minimized_to_tray = False
+        self.root.after(0, self.catch_up_after_restore)
+    
+    def catch_up_after_restore(self):
+        """
+        恢复窗口后先显示缓存中的数据，再立即获取当前列表的最新行情
+        """
+        self.last_stock_data = self.get_cached_stock_data(self.current_stocks)
+        self.update_gui_with_data()
+        self.trigger_data_load()
     
     def quit_app(self, icon=None, item=None):
         """
@@ -1120,6 +1692,7 @@ class StockQuoteGUI:
         if self.icon:
             self.icon.stop()
         self.refresh_active = False
+        self.flush_watchlist_stores()
         self.root.destroy()
     
     def on_closing(self):
@@ -1129,6 +1702,8 @@ class StockQuoteGUI:
         self.refresh_active = False
         if self.icon:
             self.icon.stop()
+        self.flush_watchlist_stores()
+        self.save_trace()
         self.root.destroy()
     
     def on_drag_start(self, event):
@@ -1178,15 +1753,11 @@ class StockQuoteGUI:
         
         # 更新 current_stocks 列表
         self.current_stocks = list(self.stock_listbox.get(0, tk.END))
+        self.save_current_list()
         
-        # 根据当前模式保存到对应的文件
-        if self.current_mode == 'favorites':
-            self.save_favorites(self.current_stocks)
-        else:
-            self.save_indexes(self.current_stocks)
-        
-        # 重新加载主视图以反映顺序
-        self.trigger_data_load()
+        # 用缓存按新顺序重绘主视图
+        self.last_stock_data = self.get_cached_stock_data(self.current_stocks)
+        self.update_gui_with_data()
         
         # 重置拖动索引
         self.drag_start_index = None
@@ -1220,6 +1791,7 @@ class StockQuoteGUI:
 
 
 def main():
+    setup_logging()
     root = tk.Tk()
     app = StockQuoteGUI(root)
     root.mainloop()
@@ -2,6 +2,7 @@ import requests
 import json
 import os
 import sys
+import csv
 import time
 import tabulate
 import select
@@ -9,48 +10,39 @@ import sys
 import threading
 import queue
 import platform
-import re
+import math
 import urllib3
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import logging
+import logging.handlers
+import atexit
 import shutil
-from datetime import datetime, time as dt_time
+import bisect
+import struct
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+import stock_common
+from stock_common import (
+    BAR_PERIODS, ChangeTracker, DEFAULT_SCAN_MARKETS, DEFAULT_SCAN_TOP, DELTA_FIELDS,
+    EASTMONEY_HEADERS, MAX_FETCH_WORKERS, OPTIONAL_FIELDS, RefreshScheduler,
+    SCAN_MARKETS, SCAN_REDRAW_INTERVAL, SHARED_QUOTE_MAX_AGE, STUB_DEFAULT_RATE,
+    TENCENT_BATCH_SIZE, atomic_write_json, bar_aggregator, batches_asset,
+    disable_shared_quote_cache, epoch_to_exchange_local, exchange_local_to_epoch,
+    fetch_from_providers, forex_code_map, format_provider_stats, format_scan_lines,
+    format_shared_cache_lines, format_traffic_lines, get_app_data_dir, get_crypto_info,
+    get_forex_info, get_priority_interval, get_resource_path, get_shared_quote_cache,
+    get_tencent_market_symbol, http_get, is_crypto_symbol, is_forex_symbol, log_error,
+    logger, note_exchange_time, rate_limiter, scan_market, secid_map, setup_logging,
+    start_recording, start_replay, start_tracing, stop_tracing, stub_provider_active,
+    symbol_directory, symbol_metadata, symbol_quarantine, tencent_wire_format,
+    trace_span, use_stub_provider,
+)
 
 # 禁用 InsecureRequestWarning
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# --- 配置和路径管理 ---
-
-def get_app_data_dir():
-    """获取用户特定的应用数据目录，并确保它存在"""
-    home = os.path.expanduser("~")
-    app_data_dir = os.path.join(home, ".stock_quote")
-    os.makedirs(app_data_dir, exist_ok=True)
-    return app_data_dir
-
-def get_resource_path(relative_path):
-    """获取资源的绝对路径，无论是在开发环境还是在PyInstaller打包后"""
-    if hasattr(sys, '_MEIPASS'):
-        # PyInstaller创建的临时文件夹
-        base_path = sys._MEIPASS
-    else:
-        # 正常开发环境
-        base_path = os.path.abspath(os.path.dirname(__file__))
-    return os.path.join(base_path, relative_path)
-
-# 配置日志
-log_file = os.path.join(get_app_data_dir(), 'stock_quote.log')
-logging.basicConfig(
-    level=logging.ERROR,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename=log_file,
-    filemode='a'
-)
-
-def log_error(symbol, data, error_message):
-    """记录错误到日志文件"""
-    logging.error(f"Error fetching data for {symbol}. Data: {data}. Error: {error_message}")
-
 
 class KeyboardInput:
     def __init__(self):
@@ -106,6 +98,17 @@ class KeyboardInput:
         return self.input_queue.get_nowait()
 
 
+def finish_tracing(path):
+    """
+    退出时保存跟踪结果
+    """
+    try:
+        count = stop_tracing(path)
+        print(f"已将 {count} 个跟踪事件写入 {path}", file=sys.stderr)
+    except OSError as e:
+        print(f"错误: 无法写入跟踪文件: {e}", file=sys.stderr)
+
+
 def display_help():
     """
     显示程序帮助信息
@@ -117,10 +120,44 @@ def display_help():
   -i <秒数>        指定刷新间隔秒数，默认为30秒
   -idx, --indexes  显示指数列表而不是自选股
   -e, --ext-data   显示美股盘前盘后价格
+  -w, --watchlist <名称> 显示指定的命名列表 (watchlists.json)，未指定 -i 时使用列表的刷新间隔
   -t, --trading-only 仅显示正在交易中的市场行情
+  --columns <列,...> 追加显示附加列（逗号分隔）: Open, PrevClose, High, Low, Volume, Turnover,
+                   QuoteTime, Bid1~5, BidVol1~5, Ask1~5, AskVol1~5（来自同一次请求，不额外请求）
+  --stats          显示统计信息（各上游主机的限流、并发与退避状态）；批处理模式下写到标准错误
+  --record         将所有上游原始响应及耗时录制到 ~/.stock_quote/recordings 下的压缩文件
+  --replay <文件>  从录制文件回放行情，不访问网络；批处理 --watch 模式在录制结束后退出
+  --replay-speed <倍数> 回放速度，默认 1；例如 10 表示录制中的 10 秒在 1 秒内回放完
+  --stub           使用离线模拟行情（随机游走），不访问网络，任何代码都有行情，用于负载测试
+  --stub-rate <次/秒> 模拟行情中每个代码每秒的价格变动次数，默认 1
+  --bars <周期>    追加走势 (Trend) 和区间 (Range) 列，由每次刷新的行情在本地聚合成 K 线得到，不额外请求；
+                   周期: 1m, 5m, 15m, 1h，显示最近 20 根 K 线
+  --history <周期> 下载代码列表（命令行、-f、-w 或自选股）的历史 K 线到本地列式缓存后退出，
+                   周期: 1d, 1h, 15m, 5m, 1m；只获取缓存中缺少的部分，中断后再次运行从中断处继续
+  --since <日期>   与 --history 一起使用：首次下载的起始日期 (YYYY-MM-DD)，默认 5 年前
+  --search <关键字> 按代码、名称或拼音首字母在本地代码目录中检索（没有目录或已过期时先下载），输出匹配的代码后退出
+  --trace <文件>   记录每次刷新各阶段（调度、连接、请求、解析、排序、筛选、渲染）的耗时，
+                   退出时以 Chrome trace-event JSON 格式写入文件，可在 chrome://tracing 或 Perfetto 中查看
   -h, --help       显示此帮助信息并退出
   -v, --version    显示版本信息
 
+批处理选项 (非交互，结果输出到标准输出):
+  --once           获取一次后退出
+  --watch          按刷新间隔持续输出，直到 Ctrl+C
+  -f, --file <文件> 从文件读取代码列表，'-' 表示标准输入
+  --format <格式>  输出格式: csv (默认)、json、ndjson
+  --delta          以 NDJSON 持续输出，首次输出全部行，之后只输出变化的行
+  --stagger        与 --watch/--delta 一起使用：每个代码按优先级独立刷新（休市放慢、大幅波动加快），
+                   请求均匀分散在刷新间隔内
+  --shards <进程数> 将代码分片到多个进程中获取和解析，适合数千个代码的大列表；各进程分摊上游限流额度
+
+  退出码: 0 全部成功，1 参数错误，2 全部失败，3 部分失败
+
+全市场扫描:
+  --scan           扫描整个市场，显示涨幅榜、跌幅榜和成交额榜，每 -i 秒重新扫描；加 --once 扫描一次后退出
+  --markets <列表> 扫描的市场，逗号分隔: SH, SZ, BJ, HK, US，默认 SH,SZ,BJ
+  --top <数量>     每个排行榜显示的数量，默认 10
+
 示例:
   python stock_cli.py               使用默认自选股并每30秒刷新
   python stock_cli.py SH513100      查看指定股票并每30秒刷新
@@ -130,10 +167,25 @@ def display_help():
   python stock_cli.py ETH           查看以太坊价格
   python stock_cli.py -t            显示正在交易的市场行情
   python stock_cli.py -h            显示此帮助信息
+  python stock_cli.py --once --format ndjson -f symbols.txt   批量获取并输出 NDJSON
+  cat symbols.txt | python stock_cli.py --watch -i 10 > quotes.csv   每10秒输出一次 CSV
+  python stock_cli.py --delta -i 5 -f symbols.txt   每5秒输出一次变化的行
+  python stock_cli.py --once --shards 4 -f all_symbols.txt   用4个进程批量获取大列表
+  python stock_cli.py --columns High,Low,Volume SH600000   显示最高、最低价和成交量
+  python stock_cli.py --scan --markets SH,SZ,HK --top 20   扫描沪深港市场的前20名
+  python stock_cli.py --record -f symbols.txt   查看行情并录制上游响应
+  python stock_cli.py --stub --delta -i 1 -f 10000_symbols.txt   离线对一万个代码做负载测试
+  python stock_cli.py --bars 1m -i 5 SH600000   每5秒刷新并显示最近20分钟的走势和区间
+  python stock_cli.py --history 1d -w 科技股   下载命名列表中所有代码近5年的日K线
+  python stock_cli.py --search zgpa   按拼音首字母查找“中国平安”的代码
+  python stock_cli.py 贵州茅台      代码、名称或拼音首字母在本地代码目录中唯一对应时可直接使用
+  python stock_cli.py --trace trace.json -i 5 SH600000   跟踪刷新过程，退出后查看 trace.json
+  python stock_cli.py --watch -i 1 --replay-speed 30 --replay ~/.stock_quote/recordings/<文件>   30倍速回放
 
 在程序运行过程中:
   按 'q' 键退出程序
   按 'x' 键在自选股与指数显示间切换
+  按 's' 键显示/隐藏统计信息
   按 Ctrl+C 也可以退出程序
     """
     print(help_text)
@@ -158,388 +210,91 @@ def display_version():
     print(version_text)
 
 
-def is_forex_symbol(symbol):
+def fetch_quotes(session, headers, symbols, max_workers=MAX_FETCH_WORKERS):
     """
-    判断是否为外汇符号
-    外汇符号格式如: USDCNH, USDJPY, EURUSD 等
+    并发获取一组代码的行情，按完成顺序逐个产出 (symbol, stock_info)
+    股票合并为批量请求，外汇和加密货币在首选提供方不支持批量时单独请求；失败时 stock_info 为 None
+    仍在隔离期内的失效代码不发请求，直接产出 None
+    其他进程在 SHARED_QUOTE_MAX_AGE 秒内获取过的代码直接从共享缓存读取，新获取的行情写回共享缓存
     """
-    # 首先检查是否在支持的外汇代码映射表中
-    if symbol.upper() in forex_code_map:
-        return True
-    # 如果不在映射表中，使用正则表达式进行通用检查
-    # 外汇代码通常是6个字母组成，前3个是基础货币，后3个是报价货币
-    return bool(re.match(r'^[A-Z]{6}$', symbol)) and symbol != "SH513100" and symbol != "SH513500" and symbol != "SH513180" and symbol != "IBIT"
-
-
-def is_crypto_symbol(symbol):
-    """
-    判断是否为加密货币符号
-    """
-    crypto_symbols = ['BTC', 'ETH', 'XRP', 'USDT', 'BNB', 'SOL', 'USDC', 'DOGE', 'ADA', 'SHIB']
-    return symbol.upper() in crypto_symbols
-
-
-def get_crypto_info(symbol):
-    """
-    从528btc网站获取加密货币信息
-    """
-    symbol = symbol.upper()
-    
-    # 定义加密货币映射
-    crypto_mapping = {
-        'BTC': {'name': 'Bitcoin', 'id': 3008},
-        'ETH': {'name': 'Ethereum', 'id': 3007},
-        'XRP': {'name': 'Ripple', 'id': 3006},
-        'USDT': {'name': 'Tether', 'id': 32675},
-        'BNB': {'name': 'Binance Coin', 'id': 3155},
-        'SOL': {'name': 'Solana', 'id': 10114},
-        'USDC': {'name': 'USD Coin', 'id': 8249},
-        'DOGE': {'name': 'Dogecoin', 'id': 2993},
-        'ADA': {'name': 'Cardano', 'id': 3010},
-        'SHIB': {'name': 'Shiba Inu', 'id': 10547},
-        
-    }
-    
-    if symbol not in crypto_mapping:
-        return {"error": "InvalidSymbol", "message": f"不支持的加密货币: {symbol}"}
-    
-    html_content = ""
-    try:
-        url = f"https://www.528btc.com/coin/{crypto_mapping[symbol]['id']}/kline-24h"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Referer": "https://www.528btc.com/"
-        }
-        
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        
-        # 解析HTML内容
-        html_content = response.text
-        
-        # 提取价格信息
-        price_match = re.search(r'<i class="price_num word(Rise|Fall)">\$?([0-9,]+\.?[0-9]*)</i>', html_content)
-        change_match = re.search(r'<span id="rise_fall_amount"[^>]*class="word(Rise|Fall)">([+-])\$?([0-9,]+\.?[0-9]*)</span>', html_content)
-        percent_match = re.search(r'<div id="rise_fall_percent"[^>]*>([+-]?)(?:\s*)([0-9]+\.?[0-9]*)\s*%', html_content)
-        
-        if not price_match:
-            error_message = f"无法解析 {symbol} 的价格信息"
-            log_error(symbol, html_content, error_message)
-            return {"error": "ParsingError", "message": error_message}
-        
-        # 处理价格中的逗号
-        price_str = price_match.group(2)
-        price = float(price_str.replace(',', ''))
-        
-        change = 0.0
-        percent = 0.0
-        
-        if change_match:
-            # 获取符号和数值
-            sign = change_match.group(2)  # '+' 或 '-'
-            change_str = change_match.group(3)  # 数值部分
-            change_value = float(change_str.replace(',', ''))
-            # 应用符号
-            if sign == '-':
-                change = -change_value
+    symbols, held = symbol_quarantine.split_due(symbols)
+    for symbol in held:
+        yield symbol, None
+
+    shared_cache = get_shared_quote_cache()
+    if shared_cache is not None:
+        missing = []
+        for symbol in symbols:
+            stock_info = shared_cache.get(symbol, SHARED_QUOTE_MAX_AGE)
+            if stock_info is None or not tencent_wire_format.covers(stock_info, get_tencent_market_symbol(symbol)[1]):
+                missing.append(symbol)
+                continue
+            symbol_quarantine.record_success(symbol)
+            yield symbol, stock_info
+        symbols = missing
+
+    batched = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_symbols = {}
+        for symbol in symbols:
+            asset = "crypto" if is_crypto_symbol(symbol) else "forex" if is_forex_symbol(symbol) else "equity"
+            if asset == "equity" or batches_asset(asset):
+                batched.setdefault(asset, []).append(symbol)
+            elif asset == "crypto":
+                future_to_symbols[executor.submit(get_crypto_info, symbol)] = (False, [symbol])
             else:
-                change = change_value
-        
-        if percent_match:
-            # 正确处理正负号
-            sign = percent_match.group(1)  # '+' 或 '-'
-            percent_value = float(percent_match.group(2))
-            if sign == '-':
-                percent = -percent_value
-            else:
-                percent = percent_value
-            
-        crypto_info = {
-            "Symbol": symbol,
-            "Name": crypto_mapping[symbol]['name'],
-            "Price": price,
-            "Change": change,
-            "Percent": f"{percent:.2f}%",
-            "Status": "-"
-        }
-        
-        return crypto_info
-        
-    except requests.exceptions.RequestException as e:
-        error_message = f"网络连接失败: {e}"
-        log_error(symbol, "", error_message)
-        return {"error": "NetworkError", "message": error_message}
-    except (ValueError, AttributeError) as e:
-        error_message = f"解析数据失败: {e}"
-        log_error(symbol, html_content, error_message)
-        return {"error": "ParsingError", "message": error_message}
-    except Exception as e:
-        error_message = f"发生未知错误: {e}"
-        log_error(symbol, html_content, error_message)
-        return {"error": "UnexpectedError", "message": error_message}
-
+                future_to_symbols[executor.submit(get_forex_info, symbol)] = (False, [symbol])
 
-# 外汇代码映射表
-forex_code_map = {
-    'JPYUSD': {'secid': '119.JPYUSD', 'name': '日元/美元'},
-    'USDCNH': {'secid': '133.USDCNH', 'name': '美元/人民币'},
-    'EURUSD': {'secid': '119.EURUSD', 'name': '欧元/美元'},
-    'GBPUSD': {'secid': '119.GBPUSD', 'name': '英镑/美元'},
-    'AUDUSD': {'secid': '119.AUDUSD', 'name': '澳元/美元'},
-    'USDJPY': {'secid': '119.USDJPY', 'name': '美元/日元'}
-}
+        for asset, asset_symbols in batched.items():
+            for i in range(0, len(asset_symbols), TENCENT_BATCH_SIZE):
+                chunk = asset_symbols[i:i + TENCENT_BATCH_SIZE]
+                future_to_symbols[executor.submit(fetch_from_providers, session, chunk, headers, asset)] = (True, chunk)
 
-def get_eastmoney_forex_info(symbol):
-    """
-    从东方财富网获取外汇信息
-    支持映射表中的外汇代码和通用的6位外汇代码
-    """
-    try:
-        symbol = symbol.upper()
-        
-        # 获取对应的secid
-        if symbol in forex_code_map:
-            # 使用预定义的secid
-            secid = forex_code_map[symbol]['secid']
-            name = forex_code_map[symbol]['name']
-        else:
-            # 对于不在映射表中的外汇代码，尝试构造通用的secid
-            # 大多数外汇使用119作为市场代码
-            secid = f"119.{symbol}"
-            # 构造一个通用的名称
-            if len(symbol) == 6:
-                base_currency = symbol[:3]
-                quote_currency = symbol[3:]
-                name = f"{base_currency}/{quote_currency}"
+        for future in as_completed(future_to_symbols):
+            is_batch, chunk = future_to_symbols[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                for symbol in chunk:
+                    log_error(symbol, "", f"获取 {symbol} 数据时出错: {e}")
+                    yield symbol, None
+                continue
+
+            if is_batch:
+                if shared_cache is not None:
+                    shared_cache.put_many(info for info in result.values() if info)
+                for symbol in chunk:
+                    if result.get(symbol):
+                        symbol_quarantine.record_success(symbol)
+                    yield symbol, result.get(symbol)
+            elif result and not result.get("error"):
+                if shared_cache is not None:
+                    shared_cache.put_many([result])
+                symbol_quarantine.record_success(chunk[0])
+                yield chunk[0], result
             else:
-                name = symbol
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-            'Referer': f'https://quote.eastmoney.com/forex/{symbol}.html'
-        }
-        
-        # 请求东方财富网外汇API
-        api_url = f"https://push2.eastmoney.com/api/qt/stock/get?secid={secid}&fields=f43,f44,f45,f46,f47,f48,f49,f50,f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61,f170,f171,f168"
-        
-        response = requests.get(api_url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        # 解析JSON数据
-        data = response.json()
-        
-        if data and 'data' in data and data['data'] is not None:
-            api_data = data['data']
-            
-            # 提取名称，如果API返回了名称则使用API的名称
-            if 'f58' in api_data and api_data['f58']:
-                name = api_data.get('f58')
-            
-            # 提取当前价格 (f43)
-            current_price = None
-            if 'f43' in api_data and api_data['f43']:
-                current_price = api_data['f43'] / 10000
-            
-            # 计算涨跌额 (f43 - f60)
-            change_amount = None
-            if 'f43' in api_data and 'f60' in api_data and api_data['f43'] and api_data['f60']:
-                change_amount = (api_data['f43'] - api_data['f60']) / 10000
-            
-            # 提取涨跌幅 (f170)
-            change_percent = None
-            if 'f170' in api_data and api_data['f170']:
-                change_percent = api_data['f170'] / 100  # 转换为百分比
-            
-            forex_info = {
-                "Symbol": symbol,
-                "Name": name,
-                "Price": current_price,
-                "Change": change_amount,
-                "Percent": f"{change_percent:.2f}%" if change_percent is not None else "0.00%",
-                "Status": "-"
-            }
-            
-            return forex_info
-        else:
-            # 如果不在映射表中且东方财富网没有数据，返回错误
-            error_message = f"未能获取到有效的数据: {symbol}"
-            log_error(symbol, str(data), error_message)
-            return {"error": "ParsingError", "message": error_message}
-            
-    except requests.exceptions.RequestException as e:
-        error_message = f"网络连接失败: {e}"
-        log_error(symbol, "", error_message)
-        return {"error": "NetworkError", "message": error_message}
-    except json.JSONDecodeError as e:
-        error_message = f"解析JSON数据失败: {e}"
-        log_error(symbol, "", error_message)
-        return {"error": "ParsingError", "message": error_message}
-    except Exception as e:
-        error_message = f"发生未知错误: {e}"
-        log_error(symbol, "", error_message)
-        return {"error": "UnexpectedError", "message": error_message}
-
-def get_forex_info(symbol):
-    """
-    获取外汇信息，使用东方财富网API
-    """
-    return get_eastmoney_forex_info(symbol)
+                error = result.get("error") if result else None
+                state = "INVALID" if error == "InvalidSymbol" else "FAILING"
+                symbol_quarantine.record_failure(chunk[0], state, (result or {}).get("message", "no data"))
+                yield chunk[0], None
+    symbol_metadata.save_if_dirty()
 
 
-def get_market_status(market):
+def collect_quotes(session, headers, symbols):
     """
-    根据当前时间判断市场状态
+    获取一组代码的行情，并按原始顺序返回成功的结果；每笔行情同时计入 K 线
     """
-    now = datetime.now()
-    weekday = now.weekday()  # Monday is 0 and Sunday is 6
-    
-    # Weekend
-    if weekday >= 5:
-        return "CLOSED"
-    
-    current_time = now.time()
-    
-    if market in ["SH", "SZ"]:  # A股市场
-        # A股交易时间:
-        # 上午: 9:30 - 11:30
-        # 下午: 13:00 - 15:00
-        morning_open = dt_time(9, 30)
-        morning_close = dt_time(11, 30)
-        afternoon_open = dt_time(13, 0)
-        afternoon_close = dt_time(15, 0)
-        
-        if (morning_open <= current_time <= morning_close) or \
-           (afternoon_open <= current_time <= afternoon_close):
-            return "OPEN"
-        else:
-            return "CLOSED"
-            
-    elif market == "HK":  # 港股市场
-        # 港股交易时间:
-        # 上午: 9:30 - 12:00
-        # 下午: 13:00 - 16:00
-        morning_open = dt_time(9, 30)
-        morning_close = dt_time(12, 0)
-        afternoon_open = dt_time(13, 0)
-        afternoon_close = dt_time(16, 0)
-        
-        if (morning_open <= current_time <= morning_close) or \
-           (afternoon_open <= current_time <= afternoon_close):
-            return "OPEN"
-        else:
-            return "CLOSED"
-    
-    
-    elif market == "US": # 美股市场
-        # 美股夏令时交易时间 (北京时间):
-        # 晚上: 21:30 - 凌晨 4:00
-        # 美股冬令时交易时间 (北京时间):
-        # 晚上: 22:30 - 凌晨 5:00
-        
-        # 简单处理，不区分冬夏令时，按夏令时计算
-        trading_open_evening = dt_time(21, 30)
-        trading_close_evening = dt_time(23, 59, 59)
-        trading_open_morning = dt_time(0, 0)
-        trading_close_morning = dt_time(4, 0)
-
-        if (trading_open_evening <= current_time <= trading_close_evening) or \
-           (trading_open_morning <= current_time <= trading_close_morning):
-            return "OPEN"
-        else:
-            return "CLOSED"
-
-    # Default case
-    return "-"
-
-
-def get_stock_info(session, symbol, headers):
-    """
-    从腾讯获取股票信息
-    """
-    # 格式化 symbol
-    symbol_lower = symbol.lower()
-    market_symbol = ""
-    market_type = ""
-    if symbol_lower.startswith(('sh', 'sz')):
-        market_symbol = symbol_lower
-        market_type = "A-Share"
-    elif symbol_lower.startswith('.'): # 指数
-        market_symbol = f"s_us{symbol_lower}"
-        market_type = "Index"
-    elif symbol_lower.startswith('hkhsi'):
-        market_symbol = "s_hkHSI"
-        market_type = "HK-Index"
-    elif symbol_lower.startswith('hkhstech'):
-        market_symbol = "s_hkHSTECH"
-        market_type = "HK-Index"
-    elif symbol_lower.startswith(('hk')):
-        market_symbol = f"hk{symbol_lower[2:]}"
-        market_type = "HK-Share"
-    else: # 默认美股
-        market_symbol = f"us{symbol.upper()}"
-        market_type = "US-Share"
-
-    url = f"https://qt.gtimg.cn/q={market_symbol}"
-    response_text = ""
-    try:
-        response = session.get(url, headers=headers, verify=False)
-        response_text = response.text
-        response.raise_for_status()
-
-        # 解析返回的字符串
-        data_part = response_text.split('=')[1].strip('"\n;')
-        if not data_part or "none" in data_part:
-            log_error(symbol, response_text, f"No data found for symbol: {symbol}")
-            return None
+    with trace_span("fetch", symbols=len(symbols)):
+        all_stock_info = [info for _, info in fetch_quotes(session, headers, symbols) if info]
+    for stock_info in all_stock_info:
+        bar_aggregator.update(stock_info)
+    bar_aggregator.flush()
 
-        parts = data_part.split('~')
-        
-        stock_info = {}
-        if market_type in ["Index", "HK-Index"]:
-            stock_info = {
-                "Symbol": symbol,
-                "Name": parts[1],
-                "Price": float(parts[3]),
-                "Change": float(parts[4]),
-                "Percent": f"{float(parts[5]):.2f}%",
-                "Status": "-"
-            }
-        elif market_type == "US-Share":
-            status = get_market_status("US")
-            stock_info = {
-                "Symbol": symbol,
-                "Name": parts[1],
-                "Price": float(parts[3]),
-                "Change": float(parts[31]),
-                "Percent": f"{float(parts[32]):.2f}%",
-                "extPrice": float(parts[22]),
-                "extChange": float(parts[23]),
-                "extPercent": f"{float(parts[24]):.2f}%",
-                "Status": status
-            }
-        else: # A-Share / HK-Share
-            region = "SH" if symbol.startswith("SH") else "SZ" if symbol.startswith("SZ") else "HK"
-            status = get_market_status(region)
-            stock_info = {
-                "Symbol": symbol,
-                "Name": parts[1],
-                "Price": float(parts[3]),
-                "Change": float(parts[31]),
-                "Percent": f"{float(parts[32]):.2f}%",
-                "Status": status
-            }
-        
-        return stock_info
-
-    except requests.exceptions.RequestException as e:
-        log_error(symbol, "", f"Request error: {e}")
-        return None
-    except (IndexError, ValueError) as e:
-        log_error(symbol, response_text, f"Parsing error: {e}")
-        return None
-    except Exception as e:
-        log_error(symbol, response_text, f"Unknown error: {e}")
-        return None
+    # 按原始顺序排序结果
+    with trace_span("sort", rows=len(all_stock_info)):
+        symbol_order = {symbol: i for i, symbol in enumerate(symbols)}
+        all_stock_info.sort(key=lambda x: symbol_order.get(x.get('Symbol'), float('inf')))
+    return all_stock_info
 
 
 def load_favorites():
@@ -573,8 +328,7 @@ def save_favorites(favorites):
     """
     favorites_file = os.path.join(get_app_data_dir(), 'favorites.json')
     try:
-        with open(favorites_file, 'w', encoding='utf-8') as f:
-            json.dump({'stocks': favorites}, f, ensure_ascii=False, indent=4)
+        atomic_write_json(favorites_file, {'stocks': favorites})
     except Exception as e:
         log_error("FAVORITES", "", f"Error saving favorites file: {e}")
 
@@ -613,15 +367,74 @@ def save_indexes(indexes):
     """
     indexes_file = os.path.join(get_app_data_dir(), 'indexes.json')
     try:
-        with open(indexes_file, 'w', encoding='utf-8') as f:
-            json.dump({'indexes': indexes}, f, ensure_ascii=False, indent=4)
+        atomic_write_json(indexes_file, {'indexes': indexes})
     except Exception as e:
         log_error("INDEXES", "", f"Error saving indexes file: {e}")
 
 
-def display_stock_table(stock_data, show_ext_data=False):
+DEFAULT_WATCHLIST_INTERVAL = 30
+
+def load_watchlists():
+    """
+    加载所有列表：自选股和指数来自各自的文件，其他命名列表及各列表的刷新间隔来自 watchlists.json
+    返回 {名称: {'symbols': [...], 'interval': 秒数}}
+    """
+    stored = {}
+    watchlists_path = os.path.join(get_app_data_dir(), 'watchlists.json')
+    if os.path.exists(watchlists_path):
+        try:
+            with open(watchlists_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f).get('watchlists', {})
+        except Exception as e:
+            log_error("WATCHLISTS", "", f"Error loading watchlists file: {e}")
+
+    watchlists = {
+        'favorites': {'symbols': load_favorites()},
+        'indexes': {'symbols': load_indexes()},
+    }
+    for name, entry in stored.items():
+        if name not in watchlists:
+            watchlists[name] = {'symbols': [s.upper() for s in entry.get('symbols', [])]}
+    for name, entry in watchlists.items():
+        entry['interval'] = stored.get(name, {}).get('interval', DEFAULT_WATCHLIST_INTERVAL)
+    return watchlists
+
+
+def get_stats_lines():
+    """
+    汇总统计视图中显示的内容
+    """
+    lines = ["[上游限流]"]
+    lines.extend(rate_limiter.format_stats())
+    lines.append("")
+    lines.append("[延迟与对冲请求]")
+    lines.extend(rate_limiter.format_latency_stats())
+    lines.append("")
+    lines.append("[行情提供方]")
+    lines.extend(format_provider_stats())
+    lines.append("")
+    lines.append("[隔离的失效代码]")
+    lines.extend(symbol_quarantine.format_lines())
+    lines.append("")
+    lines.append("[录制与回放]")
+    lines.extend(format_traffic_lines())
+    lines.append("")
+    lines.append("[共享行情缓存]")
+    lines.extend(format_shared_cache_lines())
+    lines.append("")
+    lines.append("[腾讯行情格式]")
+    lines.extend(tencent_wire_format.format_lines())
+    lines.append("")
+    lines.append("[K线聚合]")
+    lines.extend(bar_aggregator.format_lines())
+    return lines
+
+
+def display_stock_table(stock_data, show_ext_data=False, extra_fields=(), bar_period=None):
     """
     Takes a list of stock info dictionaries and prints a formatted table.
+    extra_fields are optional columns (see OPTIONAL_FIELDS) appended after the default ones.
+    bar_period (see BAR_PERIODS) adds Trend and Range columns built from the locally aggregated bars.
     """
     if not stock_data:
         return
@@ -632,54 +445,769 @@ def display_stock_table(stock_data, show_ext_data=False):
     headers = ["Symbol", "Price", "Change", "Percent"]
     if has_ext_data:
         headers.extend(["extPrice", "extChange", "extPercent"])
+    headers.extend(extra_fields)
         
     # Create a header dict for tabulate to ensure column order and naming.
     header_map = {h: h for h in headers}
     
-    display_data = [{k: v for k, v in d.items() if k != 'Name' and k != 'Note' and k != 'Status'} for d in stock_data]
+    # Only the header columns are shown: quote objects may carry decoded optional fields
+    display_data = [{h: d.get(h, '-' if h in extra_fields else '') for h in headers} for d in stock_data]
+    if bar_period:
+        header_map.update(Trend="Trend", Range="Range")
+        for row, d in zip(display_data, stock_data):
+            summary = bar_aggregator.summary(d.get("Symbol"), bar_period)
+            row["Trend"], row["Range"] = summary or ("-", "-")
+
+    with trace_span("render", rows=len(display_data)):
+        table = tabulate.tabulate(display_data, headers=header_map, tablefmt="grid")
+        print(table)
 
-    table = tabulate.tabulate(display_data, headers=header_map, tablefmt="grid")
-    print(table)
+
+def display_quarantine_notice(symbols):
+    """
+    在表格下方列出被隔离的失效代码及其重试时间
+    """
+    for symbol in symbols:
+        reason = symbol_quarantine.describe(symbol)
+        if reason:
+            print(f"{symbol}: {reason}")
 
 
-def display_favorite_stocks(session, headers, favorites=None, show_ext_data=False, show_trading_only=False):
+def display_favorite_stocks(session, headers, favorites=None, show_ext_data=False, show_trading_only=False, extra_fields=(), bar_period=None):
     """
     显示自选股的报价
     """
     if favorites is None:
         favorites = load_favorites()
     
-    all_stock_info = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_symbol = {}
-        for symbol in favorites:
-            if is_crypto_symbol(symbol):
-                future = executor.submit(get_crypto_info, symbol)
-            elif is_forex_symbol(symbol):
-                future = executor.submit(get_forex_info, symbol)
-            else:
-                future = executor.submit(get_stock_info, session, symbol, headers)
-            future_to_symbol[future] = symbol
+    all_stock_info = collect_quotes(session, headers, favorites)
+
+    if show_trading_only:
+        with trace_span("filter", rows=len(all_stock_info)):
+            all_stock_info = [s for s in all_stock_info if s.get('Status') != "CLOSED"]
+
+    display_stock_table(all_stock_info, show_ext_data, extra_fields, bar_period)
+    display_quarantine_notice(favorites)
+
+
+# --- 多进程分片获取 ---
+
+# 分片结果中按 float64 传输的字段，其余为文本；缺失的数值以 NaN 表示
+SHARD_NUMERIC_FIELDS = ["Price", "Change", "extPrice", "extChange", "ExchangeTime"]
+SHARD_TEXT_FIELDS = ["Symbol", "Name", "Percent", "extPercent", "Status", "Source"]
+SHARD_TEXT_EXTRAS = {"QuoteTime"}
+SHARD_CHUNK_SIZE = TENCENT_BATCH_SIZE * 10  # 每个分片任务的最大代码数量
+SHARD_HEADER = struct.Struct('<II')  # (行情数量, 失败数量)
+SHARD_TEXT_SEP = '\x1f'
 
-        for future in as_completed(future_to_symbol):
+
+def get_shard_schema(extra_fields=()):
+    """返回分片结果的 (数值字段, 文本字段)，附加列按类型归入其中一类"""
+    numeric = SHARD_NUMERIC_FIELDS + [f for f in extra_fields if f not in SHARD_TEXT_EXTRAS and f not in SHARD_NUMERIC_FIELDS]
+    text = SHARD_TEXT_FIELDS + [f for f in extra_fields if f in SHARD_TEXT_EXTRAS]
+    return numeric, text
+
+
+def encode_shard_result(quotes, failed, numeric, text):
+    """
+    将一个分片的结果编码为紧凑的二进制，代替逐个 pickle 字典：
+    头部 (行情数量, 失败数量) + 按行排列的 float64 数值 + 以 \\x1f 分隔的 UTF-8 文本
+    failed 为 [(symbol, 隔离状态, 原因)]，未被隔离的失败代码状态为空字符串
+    """
+    values = array('d')
+    strings = []
+    for quote in quotes:
+        for field in numeric:
             try:
-                stock_info = future.result()
-                if stock_info and not stock_info.get("error"):
-                    all_stock_info.append(stock_info)
-                elif stock_info and stock_info.get("error"):
-                    pass
+                values.append(float(quote.get(field)))
+            except (TypeError, ValueError):
+                values.append(math.nan)
+        strings.extend('' if quote.get(field) is None else str(quote.get(field)) for field in text)
+    for entry in failed:
+        strings.extend(entry)
+    return SHARD_HEADER.pack(len(quotes), len(failed)) + values.tobytes() + SHARD_TEXT_SEP.join(strings).encode('utf-8')
+
+
+def decode_shard_result(data, numeric, text):
+    """encode_shard_result 的逆过程，返回 (quotes, failed)"""
+    count, failed_count = SHARD_HEADER.unpack_from(data)
+    offset = SHARD_HEADER.size + count * len(numeric) * 8
+    values = array('d')
+    values.frombytes(data[SHARD_HEADER.size:offset])
+    strings = data[offset:].decode('utf-8').split(SHARD_TEXT_SEP) if count or failed_count else []
+
+    quotes = []
+    for i in range(count):
+        quote = {field: value for field, value in zip(text, strings[i * len(text):(i + 1) * len(text)]) if value}
+        for j, field in enumerate(numeric):
+            value = values[i * len(numeric) + j]
+            if not math.isnan(value):
+                quote[field] = int(value) if field == "ExchangeTime" or "Vol" in field else value
+        quotes.append(quote)
+    base = count * len(text)
+    failed = [tuple(strings[base + 3 * k:base + 3 * k + 3]) for k in range(failed_count)]
+    return quotes, failed
+
+
+_shard_session = None
+
+
+def _init_shard_worker(shards, cookies, log_queue):
+    """
+    分片工作进程的初始化：按分片数分摊各主机的限流额度，
+    复用协调进程的 cookie，日志和学到的元数据交给协调进程统一写入文件
+    """
+    global _shard_session
+    rate_limiter.share = 1.0 / shards
+    symbol_metadata.persist = False
+    secid_map.persist = False
+    symbol_quarantine.log_changes = False
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    _shard_session = requests.Session()
+    _shard_session.cookies.update(cookies)
+
+
+def _fetch_shard(symbols, headers, extra_fields):
+    """
+    在工作进程中获取并解析一组代码，返回编码后的结果以及本批新学到的代码元数据和 secid；
+    隔离状态和这些文件都交由协调进程维护
+    """
+    numeric, text = get_shard_schema(extra_fields)
+    tencent_wire_format.configure(ext_data=True, fields=extra_fields)
+    if extra_fields:
+        disable_shared_quote_cache()
+    quotes, failed = [], []
+    for symbol, stock_info in fetch_quotes(_shard_session, headers, symbols):
+        if stock_info:
+            quotes.append(stock_info)
+            continue
+        entry = symbol_quarantine.get(symbol)
+        failed.append((symbol, entry["state"], entry["reason"]) if entry else (symbol, "", ""))
+        symbol_quarantine.record_success(symbol)
+    return encode_shard_result(quotes, failed, numeric, text), symbol_metadata.take_learned(), secid_map.take_learned()
+
+
+class ShardedFetcher:
+    """
+    多进程分片获取：代码按块分配给进程池，每个进程独立完成批量请求和解析，
+    结果以紧凑的二进制形式返回协调进程。调用方式与 fetch_quotes 相同
+    """
+    def __init__(self, shards, session, extra_fields=()):
+        self.shards = shards
+        self.extra_fields = list(extra_fields)
+        self.schema = get_shard_schema(extra_fields)
+        # 统一使用 spawn，避免 fork 复制线程池和锁的状态
+        context = multiprocessing.get_context("spawn")
+        self.log_queue = context.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *logger.handlers)
+        self.log_listener.start()
+        self.executor = ProcessPoolExecutor(max_workers=shards, mp_context=context, initializer=_init_shard_worker,
+                                            initargs=(shards, session.cookies.get_dict(), self.log_queue))
+
+    def __call__(self, session, headers, symbols):
+        symbols, held = symbol_quarantine.split_due(symbols)
+        for symbol in held:
+            yield symbol, None
+        if not symbols:
+            return
+
+        chunk_size = max(TENCENT_BATCH_SIZE, min(SHARD_CHUNK_SIZE, math.ceil(len(symbols) / self.shards)))
+        future_to_chunk = {}
+        for i in range(0, len(symbols), chunk_size):
+            chunk = symbols[i:i + chunk_size]
+            future_to_chunk[self.executor.submit(_fetch_shard, chunk, headers, self.extra_fields)] = chunk
+
+        for future in as_completed(future_to_chunk):
+            try:
+                payload, metadata, secids = future.result()
+                quotes, failed = decode_shard_result(payload, *self.schema)
             except Exception as e:
-                symbol = future_to_symbol[future]
-                log_error(symbol, "", f"获取 {symbol} 数据时出错: {e}")
+                for symbol in future_to_chunk[future]:
+                    log_error(symbol, "", f"分片获取 {symbol} 数据时出错: {e}")
+                    yield symbol, None
+                continue
+            symbol_metadata.merge(metadata)
+            secid_map.merge(secids)
+            for stock_info in quotes:
+                symbol_quarantine.record_success(stock_info["Symbol"])
+                yield stock_info["Symbol"], stock_info
+            for symbol, state, reason in failed:
+                if state:
+                    symbol_quarantine.record_failure(symbol, state, reason)
+                yield symbol, None
+        symbol_metadata.save_if_dirty()
+        secid_map.save_if_dirty()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.log_listener.stop()
+
+
+# --- 历史K线下载 ---
+
+# 历史 K 线周期及其在东方财富 kline 接口中的 klt 参数；分钟 K 线上游只提供最近一段时间
+HISTORY_PERIODS = {"1d": 101, "1h": 60, "15m": 15, "5m": 5, "1m": 1}
+# 首次下载时默认回溯的年数
+HISTORY_DEFAULT_YEARS = 5
+# 每列一个文件，按小端序连续存放，可直接用 numpy.fromfile(路径, dtype) 读取
+HISTORY_COLUMNS = [("time", "q"), ("open", "d"), ("high", "d"), ("low", "d"),
+                   ("close", "d"), ("volume", "d"), ("amount", "d")]
+HISTORY_DTYPES = {"q": "<i8", "d": "<f8"}
+# 下载进度写入检查点文件的最短间隔（秒）
+HISTORY_CHECKPOINT_INTERVAL = 1.0
+
+
+class HistoryStore:
+    """
+    历史 K 线的列式本地缓存：history/<周期>/<代码>/ 下每列一个 .bin 文件，行按时间升序
+    time 为 int64 时间戳，其余为 float64；新数据只追加到文件末尾，与已有最后几行重叠的部分先截掉再追加，
+    写到一半中断时各列长度可能不同，读取时按最短的一列为准；早于缓存开头的数据需要整体重写各列
+    """
+    def __init__(self, dirname='history'):
+        self.root = os.path.join(get_app_data_dir(), dirname)
 
-    # 按原始顺序排序结果
-    symbol_order = {symbol: i for i, symbol in enumerate(favorites)}
-    all_stock_info.sort(key=lambda x: symbol_order.get(x.get('Symbol'), float('inf')))
+    def _dir(self, period, symbol):
+        return os.path.join(self.root, period, symbol)
+
+    def _column_path(self, period, symbol, column):
+        return os.path.join(self._dir(period, symbol), f"{column}.bin")
+
+    def rows(self, symbol, period="1d"):
+        """已缓存的行数"""
+        try:
+            return min(os.path.getsize(self._column_path(period, symbol, name)) // 8 for name, _ in HISTORY_COLUMNS)
+        except OSError:
+            return 0
+
+    def _read_column(self, period, symbol, name, typecode, count):
+        values = array(typecode)
+        with open(self._column_path(period, symbol, name), 'rb') as f:
+            values.frombytes(f.read(count * 8))
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def load(self, symbol, period="1d"):
+        """读取一个代码的全部 K 线，返回 {列名: array}，没有缓存时各列为空"""
+        count = self.rows(symbol, period)
+        if not count:
+            return {name: array(typecode) for name, typecode in HISTORY_COLUMNS}
+        return {name: self._read_column(period, symbol, name, typecode, count) for name, typecode in HISTORY_COLUMNS}
+
+    def first_time(self, symbol, period="1d"):
+        """第一行的时间戳，没有缓存时返回 None"""
+        if not self.rows(symbol, period):
+            return None
+        with open(self._column_path(period, symbol, "time"), 'rb') as f:
+            return struct.unpack('<q', f.read(8))[0]
+
+    def last_time(self, symbol, period="1d"):
+        """最后一行的时间戳，没有缓存时返回 None"""
+        count = self.rows(symbol, period)
+        if not count:
+            return None
+        with open(self._column_path(period, symbol, "time"), 'rb') as f:
+            f.seek((count - 1) * 8)
+            return struct.unpack('<q', f.read(8))[0]
+
+    def merge(self, symbol, period, rows):
+        """
+        把按时间升序的新行 [(time, open, high, low, close, volume, amount)] 合并到缓存：
+        时间不早于第一条新行的已有行（例如下载时尚未收盘的最后一根）被新数据替换，返回新增的行数
+        """
+        if not rows:
+            return 0
+        os.makedirs(self._dir(period, symbol), exist_ok=True)
+        count = self.rows(symbol, period)
+        keep = count
+        if count:
+            times = self._read_column(period, symbol, "time", "q", count)
+            keep = bisect.bisect_left(times, rows[0][0])
+        for i, (name, typecode) in enumerate(HISTORY_COLUMNS):
+            values = array(typecode, (row[i] for row in rows))
+            if sys.byteorder == "big":
+                values.byteswap()
+            with open(self._column_path(period, symbol, name), 'r+b' if count else 'wb') as f:
+                f.truncate(keep * 8)
+                f.seek(keep * 8)
+                f.write(values.tobytes())
+        return keep + len(rows) - count
+
+    def covered_since(self, symbol, period="1d"):
+        """已经向上游请求过的最早日期（上市前或节假日没有 K 线，第一行可能晚于该日期），没有记录时返回 None"""
+        try:
+            with open(os.path.join(self._dir(period, symbol), "since"), 'r', encoding='utf-8') as f:
+                return datetime.strptime(f.read().strip(), "%Y-%m-%d").date()
+        except (OSError, ValueError):
+            return None
+
+    def set_covered_since(self, symbol, period, since):
+        with open(os.path.join(self._dir(period, symbol), "since"), 'w', encoding='utf-8') as f:
+            f.write(since.isoformat())
+
+    def prepend(self, symbol, period, rows):
+        """
+        把早于第一行缓存的新行（按时间升序）加到缓存开头，返回新增的行数
+        各列先完整写入同级的临时目录，再替换原目录；替换中途中断时该代码的缓存丢失，下次会重新下载
+        """
+        first = self.first_time(symbol, period)
+        if first is None:
+            return self.merge(symbol, period, rows)
+        rows = [row for row in rows if row[0] < first]
+        if not rows:
+            return 0
+        existing = self.load(symbol, period)
+        directory = self._dir(period, symbol)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{symbol}.", dir=os.path.dirname(directory))
+        try:
+            for i, (name, typecode) in enumerate(HISTORY_COLUMNS):
+                values = array(typecode, (row[i] for row in rows))
+                values.extend(existing[name])
+                if sys.byteorder == "big":
+                    values.byteswap()
+                with open(os.path.join(tmp_dir, f"{name}.bin"), 'wb') as f:
+                    f.write(values.tobytes())
+            old_dir = tmp_dir + ".old"
+            os.rename(directory, old_dir)
+            try:
+                os.rename(tmp_dir, directory)
+            except BaseException:
+                os.rename(old_dir, directory)
+                raise
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        shutil.rmtree(old_dir, ignore_errors=True)
+        return len(rows)
+
+    def _checkpoint_path(self, period):
+        return os.path.join(self.root, period, "checkpoint.json")
+
+    def load_checkpoint(self, period, symbols):
+        """返回当天对同一组代码未完成的下载中已完成的代码集合；更早的检查点不再使用，以免漏掉之后的新数据"""
+        try:
+            with open(self._checkpoint_path(period), 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if checkpoint.get("date") != datetime.now().date().isoformat() or sorted(checkpoint.get("symbols", [])) != sorted(symbols):
+            return set()
+        return set(checkpoint.get("done", []))
+
+    def save_checkpoint(self, period, symbols, done):
+        os.makedirs(os.path.join(self.root, period), exist_ok=True)
+        atomic_write_json(self._checkpoint_path(period), {"date": datetime.now().date().isoformat(),
+                                                          "symbols": list(symbols), "done": sorted(done)})
+
+    def clear_checkpoint(self, period):
+        try:
+            os.remove(self._checkpoint_path(period))
+        except FileNotFoundError:
+            pass
+
+
+history_store = HistoryStore()
+
+
+def get_history_region(symbol):
+    """K 线时间所在的时区：美股和美股指数为美东时间，其余（A股、港股、外汇）为北京时间"""
+    return "US" if get_tencent_market_symbol(symbol)[1] in ("US-Share", "Index") else "SH"
+
+
+def get_history_secid(symbol, session=None):
+    """历史 K 线使用东方财富 secid：外汇取映射表中的 secid，其余与行情备用提供方相同"""
+    if symbol.upper() in forex_code_map:
+        return forex_code_map[symbol.upper()]['secid']
+    if is_crypto_symbol(symbol):
+        return None
+    return secid_map.resolve(symbol, session)
+
+
+def fetch_history(session, symbol, period="1d", since=None, until=None):
+    """
+    从东方财富 kline 接口获取一个代码自 since 至 until（date，含当天；省略时到最新）的不复权 K 线，返回按时间升序的行
+    使用不复权价格，增量追加的数据不会因为之后的除权而与已缓存的部分不一致
+    无法映射到东方财富代码时抛出 ValueError，请求失败时抛出 RequestException
+    """
+    secid = get_history_secid(symbol, session)
+    if not secid:
+        raise ValueError(f"{symbol} 没有对应的东方财富代码")
+    begin = since.strftime("%Y%m%d") if since else "0"
+    end = until.strftime("%Y%m%d") if until else "20500101"
+    url = ("https://push2his.eastmoney.com/api/qt/stock/kline/get?fields1=f1,f2,f3"
+           f"&fields2=f51,f52,f53,f54,f55,f56,f57&klt={HISTORY_PERIODS[period]}&fqt=0"
+           f"&secid={secid}&beg={begin}&end={end}&lmt=1000000")
+    response = http_get(url, session, headers=EASTMONEY_HEADERS, timeout=30)
+    response.raise_for_status()
+    try:
+        klines = ((response.json() or {}).get('data') or {}).get('klines') or []
+    except ValueError as e:
+        raise requests.exceptions.RequestException(f"Invalid Eastmoney response: {e}")
+    region = get_history_region(symbol)
+    rows = []
+    with trace_span("parse", "history", symbol=symbol, rows=len(klines)):
+        for line in klines:
+            # 日期, 开, 收, 高, 低, 成交量, 成交额
+            date, open_, close, high, low, volume, amount = line.split(',')[:7]
+            rows.append((exchange_local_to_epoch(datetime.fromisoformat(date), region), float(open_), float(high), float(low),
+                         float(close), float(volume), float(amount)))
+    return rows
+
+
+def update_history(session, symbol, period="1d", since=None):
+    """
+    增量更新一个代码的缓存：已有缓存时只从最后一根 K 线所在的日期开始获取，否则从 since 开始；
+    since 早于缓存的第一根 K 线时，另外获取缺少的开头部分并加到缓存开头
+    返回新增的行数
+    """
+    region = get_history_region(symbol)
+    added = 0
+    first = history_store.first_time(symbol, period)
+    if first is not None and since is not None:
+        first_date = epoch_to_exchange_local(first, region).date()
+        if since < (history_store.covered_since(symbol, period) or first_date):
+            added += history_store.prepend(symbol, period, fetch_history(session, symbol, period, since, first_date))
+            history_store.set_covered_since(symbol, period, since)
+    last = history_store.last_time(symbol, period)
+    if last is not None:
+        return added + history_store.merge(symbol, period, fetch_history(
+            session, symbol, period, epoch_to_exchange_local(last, region).date()))
+    if since is None:
+        since = datetime.now().date() - timedelta(days=365 * HISTORY_DEFAULT_YEARS)
+    added = history_store.merge(symbol, period, fetch_history(session, symbol, period, since))
+    if added:
+        history_store.set_covered_since(symbol, period, since)
+    return added
+
+
+def download_history(session, symbols, period="1d", since=None, max_workers=MAX_FETCH_WORKERS, on_progress=None):
+    """
+    并发下载一组代码的历史 K 线到本地缓存，每个代码只获取缓存中缺少的部分
+    下载进度记录在检查点文件中，中断后对同一组代码再次调用时跳过已完成的代码，全部完成后删除检查点
+    on_progress(symbol, 新增行数或 None, 已完成数, 总数) 在每个代码完成时调用，失败时新增行数为 None
+    返回 {symbol: 新增行数}，失败的代码为 None
+    """
+    if period not in HISTORY_PERIODS:
+        raise ValueError(f"unknown history period: {period}")
+    symbols = list(dict.fromkeys(symbols))
+    done = history_store.load_checkpoint(period, symbols)
+    results = {symbol: 0 for symbol in symbols if symbol in done}
+    last_save = 0.0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(update_history, session, symbol, period, since): symbol
+                   for symbol in symbols if symbol not in done}
+        try:
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    results[symbol] = future.result()
+                    done.add(symbol)
+                except (requests.exceptions.RequestException, ValueError, OSError) as e:
+                    log_error(symbol, "", f"History download failed: {e}")
+                    results[symbol] = None
+                if on_progress is not None:
+                    on_progress(symbol, results[symbol], len(results), len(symbols))
+                if time.monotonic() - last_save >= HISTORY_CHECKPOINT_INTERVAL:
+                    history_store.save_checkpoint(period, symbols, done)
+                    last_save = time.monotonic()
+        finally:
+            for future in futures:
+                future.cancel()
+            if len(done) == len(symbols):
+                history_store.clear_checkpoint(period)
+            else:
+                history_store.save_checkpoint(period, symbols, done)
+    secid_map.save_if_dirty()
+    return results
+
+
+def load_history(symbols, period="1d"):
+    """从本地缓存读取多个代码的历史 K 线，返回 {symbol: {列名: array}}，不访问网络"""
+    return {symbol: history_store.load(symbol, period) for symbol in symbols}
+
+
+# --- 批处理模式 ---
+
+# 批处理模式的退出码
+EXIT_OK = 0            # 全部代码获取成功
+EXIT_USAGE = 1         # 参数或输入错误
+EXIT_ALL_FAILED = 2    # 没有获取到任何数据
+EXIT_PARTIAL = 3       # 部分代码获取失败
+
+BATCH_FORMATS = ["csv", "json", "ndjson"]
+BATCH_FIELDS = ["Time", "Symbol", "Name", "Price", "Change", "Percent", "Status", "extPrice", "extChange", "extPercent", "Source"]
+
+
+def read_symbols(source):
+    """
+    从文件或标准输入('-')读取代码列表
+    每行一个或多个代码（以空白或逗号分隔），忽略空行和以 '#' 开头的注释，去重并保持顺序
+    """
+    if source == '-':
+        lines = sys.stdin
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+
+    symbols = []
+    seen = set()
+    for line in lines:
+        line = line.split('#', 1)[0]
+        for symbol in line.replace(',', ' ').split():
+            symbol = symbol.upper()
+            if symbol not in seen:
+                seen.add(symbol)
+                symbols.append(symbol)
+    return symbols
+
+
+class BatchWriter:
+    """
+    将行情结果以 CSV / JSON / NDJSON 格式流式写入标准输出
+    JSON 格式每个刷新周期输出一个数组，数组元素随结果到达逐个写出
+    """
+    def __init__(self, output_format, out=None, fields=BATCH_FIELDS):
+        self.format = output_format
+        self.out = out or sys.stdout
+        self.fields = fields
+        self.csv_writer = None
+        self.items_in_cycle = 0
+
+    def begin_cycle(self):
+        self.items_in_cycle = 0
+        if self.format == "json":
+            self.out.write("[")
+
+    def write(self, stock_info, changed=None, **overrides):
+        row = {}
+        for k in self.fields:
+            value = overrides[k] if k in overrides else stock_info.get(k)
+            if value is not None:
+                row[k] = value
+        if changed is not None:
+            row["Changed"] = changed
+        if self.format == "csv":
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.out, fieldnames=self.fields, extrasaction='ignore')
+                self.csv_writer.writeheader()
+            self.csv_writer.writerow(row)
+        elif self.format == "json":
+            if self.items_in_cycle:
+                self.out.write(",")
+            self.out.write("\n  " + json.dumps(row, ensure_ascii=False))
+        else:
+            self.out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.items_in_cycle += 1
+        self.out.flush()
+
+    def end_cycle(self):
+        if self.format == "json":
+            self.out.write("\n]\n" if self.items_in_cycle else "]\n")
+        self.out.flush()
 
-    if show_trading_only:
-        all_stock_info = [s for s in all_stock_info if s.get('Status') != "CLOSED"]
 
-    display_stock_table(all_stock_info, show_ext_data)
+def run_batch_cycle(session, headers, symbols, writer, show_trading_only=False, tracker=None, quote_cache=None, fetch=fetch_quotes):
+    """
+    执行一次批量获取，结果按到达顺序写出，返回失败的代码数量
+    传入 tracker 时只写出与上一次相比发生变化的行；传入 quote_cache 时记录每个代码的最新行情
+    fetch 为获取函数，默认在本进程内获取，分片模式下为 ShardedFetcher
+    """
+    failed = 0
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    writer.begin_cycle()
+    with trace_span("refresh", symbols=len(symbols)):
+        for symbol, stock_info in fetch(session, headers, symbols):
+            if not stock_info:
+                failed += 1
+                reason = symbol_quarantine.describe(symbol)
+                print(f"错误: 无法获取 {symbol} 的数据" + (f" ({reason})" if reason else ""), file=sys.stderr)
+                continue
+            if quote_cache is not None:
+                note_exchange_time(quote_cache.get(symbol), stock_info)
+                quote_cache[symbol] = stock_info
+            bar_aggregator.update(stock_info)
+            if show_trading_only and stock_info.get('Status') == "CLOSED":
+                continue
+            if tracker is None:
+                writer.write(stock_info, Time=timestamp)
+                continue
+            result = tracker.update(symbol, stock_info)
+            if result is None:
+                writer.write(stock_info, Time=timestamp, changed=list(DELTA_FIELDS))
+            elif result[0]:
+                writer.write(stock_info, Time=timestamp, changed=tracker.changed_fields(result[0]))
+    writer.end_cycle()
+    bar_aggregator.flush()
+    return failed
+
+
+def get_batch_exit_code(failed, total):
+    if failed == 0:
+        return EXIT_OK
+    elif failed == total:
+        return EXIT_ALL_FAILED
+    return EXIT_PARTIAL
+
+
+def run_batch_mode(session, headers, symbols, output_format, watch=False, refresh_interval=30, show_trading_only=False, delta=False, show_stats=False, stagger=False, extra_fields=(), shards=1):
+    """
+    非交互批处理模式：--once 获取一次后退出，--watch 按刷新间隔持续输出
+    delta 为 True 时首个周期输出全部行，之后只输出变化的行
+    show_stats 为 True 时每个周期结束后将统计信息写到标准错误
+    stagger 为 True 时（仅 --watch）每个代码按自己的优先级间隔刷新，请求均匀分散在间隔内
+    extra_fields 为追加在默认字段之后的附加字段
+    shards 大于 1 时将代码分片到多个进程中获取和解析，各进程分摊上游主机的限流额度
+    返回进程退出码
+    """
+    writer = BatchWriter(output_format, fields=BATCH_FIELDS + list(extra_fields))
+    # 批处理输出总是包含盘前盘后字段
+    tencent_wire_format.configure(ext_data=True, fields=extra_fields)
+    tracker = ChangeTracker() if delta else None
+    fetcher = ShardedFetcher(shards, session, extra_fields) if shards > 1 else fetch_quotes
+    exit_code = EXIT_OK
+    try:
+        if watch and stagger:
+            quote_cache = {}
+            scheduler = RefreshScheduler(lambda s: get_priority_interval(refresh_interval, quote_cache.get(s)))
+            scheduler.sync(symbols)
+            while True:
+                if stock_common.traffic_replayer is not None and stock_common.traffic_replayer.finished():
+                    return exit_code
+                with trace_span("schedule"):
+                    due_symbols = scheduler.pop_due()
+                if due_symbols:
+                    failed = run_batch_cycle(session, headers, due_symbols, writer, show_trading_only, tracker, quote_cache, fetcher)
+                    exit_code = get_batch_exit_code(failed, len(due_symbols))
+                    if show_stats:
+                        print("\n".join(get_stats_lines()), file=sys.stderr)
+                next_due = scheduler.next_due()
+                time.sleep(min(1.0, max(0.05, next_due - time.time())))
+
+        while True:
+            start_time = time.time()
+            failed = run_batch_cycle(session, headers, symbols, writer, show_trading_only, tracker, fetch=fetcher)
+            if show_stats:
+                print("\n".join(get_stats_lines()), file=sys.stderr)
+            exit_code = get_batch_exit_code(failed, len(symbols))
+
+            if not watch or (stock_common.traffic_replayer is not None and stock_common.traffic_replayer.finished()):
+                break
+            time.sleep(max(0, refresh_interval - (time.time() - start_time)))
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # 下游管道已关闭（例如 | head），静默退出
+        try:
+            sys.stdout = open(os.devnull, 'w')
+        except OSError:
+            pass
+    finally:
+        if fetcher is not fetch_quotes:
+            fetcher.close()
+    return exit_code
+
+
+def run_scan_mode(session, markets, top_n, refresh_interval=30, once=False):
+    """
+    全市场扫描模式：每收到一页就重绘排行，--once 时扫描一次、输出结果后退出
+    返回进程退出码
+    """
+    last_draw = 0.0
+
+    def draw(scan):
+        nonlocal last_draw
+        now = time.monotonic()
+        if now - last_draw < SCAN_REDRAW_INTERVAL:
+            return
+        last_draw = now
+        os.system('cls' if os.name == 'nt' else 'clear')
+        print("\n".join(format_scan_lines(scan)), flush=True)
+
+    try:
+        while True:
+            start_time = time.time()
+            scan = scan_market(session, markets, top_n, on_update=None if once else draw)
+            if once:
+                print("\n".join(format_scan_lines(scan)))
+                return EXIT_OK if scan.scanned else EXIT_ALL_FAILED
+            last_draw = 0.0
+            draw(scan)
+            print(f"\n按 Ctrl+C 退出，{refresh_interval} 秒后重新扫描...", flush=True)
+            time.sleep(max(0, refresh_interval - (time.time() - start_time)))
+    except KeyboardInterrupt:
+        return EXIT_OK
+
+
+def run_history_mode(session, symbols, period, since=None):
+    """
+    下载一组代码的历史 K 线到本地缓存，进度和结果写到标准错误
+    返回进程退出码
+    """
+    def report(symbol, added, completed, total):
+        status = "失败" if added is None else f"新增 {added} 行"
+        print(f"[{completed}/{total}] {symbol}: {status}", file=sys.stderr, flush=True)
+
+    try:
+        results = download_history(session, symbols, period, since, on_progress=report)
+    except KeyboardInterrupt:
+        print("\n下载已中断，再次运行相同的命令将从中断处继续", file=sys.stderr)
+        return EXIT_PARTIAL
+    failed = sum(1 for added in results.values() if added is None)
+    added = sum(added for added in results.values() if added)
+    print(f"完成 {len(results) - failed} 个代码，失败 {failed} 个，共新增 {added} 行，"
+          f"缓存位于 {os.path.join(history_store.root, period)}", file=sys.stderr)
+    return get_batch_exit_code(failed, len(results))
+
+
+SEARCH_OUTPUT_LIMIT = 20
+
+
+def ensure_symbol_directory(session, download=True):
+    """
+    加载本地代码目录，没有缓存或已过期时重新下载（download 为 False、回放或模拟行情时不联网）
+    返回目录是否可用
+    """
+    loaded = symbol_directory.load()
+    if download and (not loaded or symbol_directory.is_stale()) and stock_common.traffic_replayer is None and not stub_provider_active():
+        print("正在下载代码目录...", file=sys.stderr)
+        local_entries = [(symbol, entry['name'], "FX") for symbol, entry in forex_code_map.items()]
+        symbol_directory.download(session, local_entries)
+    return symbol_directory.available()
+
+
+def run_search_mode(session, text):
+    """
+    在本地代码目录中按代码、名称或拼音首字母前缀检索并输出匹配的代码
+    返回进程退出码：有匹配时为 EXIT_OK，否则为 EXIT_USAGE
+    """
+    if not ensure_symbol_directory(session):
+        print("错误: 代码目录不可用", file=sys.stderr)
+        return EXIT_ALL_FAILED
+    matches = symbol_directory.search(text, limit=SEARCH_OUTPUT_LIMIT)
+    if not matches:
+        print(f"没有与 '{text}' 匹配的代码", file=sys.stderr)
+        return EXIT_USAGE
+    for symbol, name, market in matches:
+        print(f"{symbol:<12}{market:<8}{name}")
+    return EXIT_OK
+
+
+def resolve_symbols(symbols):
+    """
+    用已缓存的代码目录把名称、拼音首字母或不带前缀的数字代码换成完整代码，不联网
+    目录中没有的代码（指数、外汇、加密货币除外）在标准错误上提示，但仍会尝试获取
+    """
+    if not symbols or not ensure_symbol_directory(None, download=False):
+        return symbols
+    resolved = []
+    for symbol in symbols:
+        symbol = symbol_directory.resolve(symbol) or symbol
+        if (not symbol_directory.contains(symbol) and not is_forex_symbol(symbol) and not is_crypto_symbol(symbol)
+                and get_tencent_market_symbol(symbol)[1] not in ["Index", "HK-Index"]):
+            print(f"警告: 本地代码目录中没有 {symbol}", file=sys.stderr)
+        if symbol not in resolved:
+            resolved.append(symbol)
+    return resolved
 
 
 if __name__ == "__main__":
@@ -690,92 +1218,311 @@ if __name__ == "__main__":
         display_version()
         sys.exit(0)
 
+    setup_logging()
+
     show_indexes = "-idx" in sys.argv or "--indexes" in sys.argv
     show_ext_data = "--ext-data" in sys.argv or "-e" in sys.argv
     show_trading_only = "--trading-only" in sys.argv or "-t" in sys.argv
-    
+    run_once = "--once" in sys.argv
+    run_watch = "--watch" in sys.argv
+    delta_output = "--delta" in sys.argv
+    show_stats = "--stats" in sys.argv
+    stagger = "--stagger" in sys.argv
+    scan_mode = "--scan" in sys.argv
+
+    refresh_interval = 30  # 默认刷新间隔为30秒
+    interval_given = False
+    stock_symbols = []
+    watchlist_name = None
+    input_source = None
+    output_format = None
+    extra_fields = []
+    scan_markets = list(DEFAULT_SCAN_MARKETS)
+    scan_top = DEFAULT_SCAN_TOP
+    shards = 1
+    record = "--record" in sys.argv
+    replay_path = None
+    replay_speed = 1.0
+    stub = "--stub" in sys.argv
+    stub_rate = STUB_DEFAULT_RATE
+    trace_path = None
+    search_text = None
+    bar_period = None
+    history_period = None
+    history_since = None
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-i" and i + 1 < len(sys.argv):
+            try:
+                refresh_interval = int(sys.argv[i + 1])
+                interval_given = True
+                i += 2  # 跳过 -i 和它的参数值
+            except ValueError:
+                print("错误: -i 参数需要一个整数值")
+                sys.exit(EXIT_USAGE)
+        elif sys.argv[i] in ["-w", "--watchlist"] and i + 1 < len(sys.argv):
+            watchlist_name = sys.argv[i + 1]
+            i += 2
+        elif sys.argv[i] in ["-f", "--file"] and i + 1 < len(sys.argv):
+            input_source = sys.argv[i + 1]
+            i += 2
+        elif sys.argv[i] == "--format" and i + 1 < len(sys.argv):
+            output_format = sys.argv[i + 1].lower()
+            if output_format not in BATCH_FORMATS:
+                print(f"错误: --format 仅支持 {', '.join(BATCH_FORMATS)}", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--markets" and i + 1 < len(sys.argv):
+            scan_markets = [m.strip().upper() for m in sys.argv[i + 1].split(',') if m.strip()]
+            unknown = [m for m in scan_markets if m not in SCAN_MARKETS]
+            if unknown or not scan_markets:
+                print(f"错误: --markets 仅支持 {', '.join(SCAN_MARKETS)}", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--top" and i + 1 < len(sys.argv):
+            try:
+                scan_top = int(sys.argv[i + 1])
+            except ValueError:
+                scan_top = 0
+            if scan_top <= 0:
+                print("错误: --top 参数需要一个正整数", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--shards" and i + 1 < len(sys.argv):
+            try:
+                shards = int(sys.argv[i + 1])
+            except ValueError:
+                shards = 0
+            if shards <= 0:
+                print("错误: --shards 参数需要一个正整数", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--replay" and i + 1 < len(sys.argv):
+            replay_path = sys.argv[i + 1]
+            i += 2
+        elif sys.argv[i] == "--replay-speed" and i + 1 < len(sys.argv):
+            try:
+                replay_speed = float(sys.argv[i + 1])
+            except ValueError:
+                replay_speed = 0
+            if replay_speed <= 0:
+                print("错误: --replay-speed 参数需要一个正数", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--bars" and i + 1 < len(sys.argv):
+            bar_period = sys.argv[i + 1].lower()
+            if bar_period not in BAR_PERIODS:
+                print(f"错误: --bars 仅支持 {', '.join(BAR_PERIODS)}", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--history" and i + 1 < len(sys.argv):
+            history_period = sys.argv[i + 1].lower()
+            if history_period not in HISTORY_PERIODS:
+                print(f"错误: --history 仅支持 {', '.join(HISTORY_PERIODS)}", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--since" and i + 1 < len(sys.argv):
+            try:
+                history_since = datetime.strptime(sys.argv[i + 1], "%Y-%m-%d").date()
+            except ValueError:
+                print("错误: --since 参数需要 YYYY-MM-DD 格式的日期", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--search" and i + 1 < len(sys.argv):
+            search_text = sys.argv[i + 1]
+            i += 2
+        elif sys.argv[i] == "--trace" and i + 1 < len(sys.argv):
+            trace_path = sys.argv[i + 1]
+            i += 2
+        elif sys.argv[i] == "--stub-rate" and i + 1 < len(sys.argv):
+            try:
+                stub_rate = float(sys.argv[i + 1])
+            except ValueError:
+                stub_rate = 0
+            if stub_rate <= 0:
+                print("错误: --stub-rate 参数需要一个正数", file=sys.stderr)
+                sys.exit(EXIT_USAGE)
+            i += 2
+        elif sys.argv[i] == "--columns" and i + 1 < len(sys.argv):
+            optional_names = {name.lower(): name for name in OPTIONAL_FIELDS}
+            for column in sys.argv[i + 1].split(','):
+                column = column.strip()
+                if column.lower() not in optional_names:
+                    print(f"错误: 未知的列 '{column}'，可用列: {', '.join(OPTIONAL_FIELDS)}", file=sys.stderr)
+                    sys.exit(EXIT_USAGE)
+                if optional_names[column.lower()] not in extra_fields:
+                    extra_fields.append(optional_names[column.lower()])
+            i += 2
+        elif sys.argv[i] in ["-h", "--help", "-v", "--version", "-idx", "--indexes", "-e", "--ext-data", "-t", "--trading-only", "--once", "--watch", "--delta", "--stats", "--stagger", "--scan", "--record", "--stub"]:
+            i += 1
+        elif sys.argv[i] == "-":
+            input_source = "-"
+            i += 1
+        elif sys.argv[i].startswith("-"):
+            # 处理未知参数
+            print(f"错误: 未知参数 '{sys.argv[i]}'")
+            display_help()
+            sys.exit(EXIT_USAGE)
+        else:
+            # 将股票代码转换为大写
+            stock_symbols.append(sys.argv[i].upper())
+            i += 1
+
+    if run_once and run_watch:
+        print("错误: --once 与 --watch 不能同时使用", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if stagger and not (run_watch or delta_output):
+        print("错误: --stagger 需要与 --watch 或 --delta 一起使用", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if delta_output:
+        if output_format not in (None, "ndjson"):
+            print("错误: --delta 仅支持 ndjson 输出格式", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+        output_format = "ndjson"
+        run_watch = not run_once
+
+    if record and replay_path is not None:
+        print("错误: --record 与 --replay 不能同时使用", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if shards > 1 and (record or replay_path is not None or stub):
+        print("错误: --shards 不能与 --record、--replay 或 --stub 一起使用", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if scan_mode and stub:
+        # 扫描直接请求各交易所的排行接口，模拟行情没有对应的数据
+        print("错误: --scan 不能与 --stub 一起使用", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if stub:
+        use_stub_provider(rate=stub_rate)
+    if extra_fields:
+        # 共享缓存只保存核心字段，需要附加列时本进程自行获取
+        disable_shared_quote_cache()
+    if trace_path is not None:
+        start_tracing()
+        atexit.register(finish_tracing, trace_path)
+    if replay_path is not None:
+        try:
+            start_replay(os.path.expanduser(replay_path), replay_speed)
+        except (OSError, ValueError) as e:
+            print(f"错误: 无法读取录制文件: {e}", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+    elif record:
+        print(f"录制上游响应到 {start_recording('stock_cli')}", file=sys.stderr)
+
+    if search_text is not None:
+        sys.exit(run_search_mode(requests.Session(), search_text))
+
+    if scan_mode:
+        if run_watch or delta_output or input_source is not None or output_format is not None or shards > 1:
+            print("错误: --scan 只能与 --once、-i、--markets、--top 一起使用", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+        sys.exit(run_scan_mode(requests.Session(), scan_markets, scan_top, refresh_interval, once=run_once))
+
+    if watchlist_name is not None:
+        watchlists = load_watchlists()
+        if watchlist_name not in watchlists:
+            print(f"错误: 列表 '{watchlist_name}' 不存在，可用列表: {', '.join(watchlists)}", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+        stock_symbols.extend(s for s in watchlists[watchlist_name]['symbols'] if s not in stock_symbols)
+        if not interval_given:
+            refresh_interval = watchlists[watchlist_name]['interval']
+
     # 创建全局唯一的 Session 和 headers
     session = requests.Session()
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
     }
-    # 第一次访问以获取 cookie
-    session.get("https://gu.qq.com", headers=headers, verify=False)
+
+    if history_period is not None:
+        if stub or run_watch or delta_output or output_format is not None or shards > 1 or bar_period is not None:
+            print("错误: --history 不能与 --stub、--watch、--delta、--format、--shards 或 --bars 一起使用", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+        try:
+            if input_source is not None:
+                stock_symbols.extend(s for s in read_symbols(input_source) if s not in stock_symbols)
+        except OSError as e:
+            print(f"错误: 无法读取代码列表: {e}", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+        stock_symbols = resolve_symbols(stock_symbols)
+        if not stock_symbols:
+            stock_symbols = load_indexes() if show_indexes else load_favorites()
+        sys.exit(run_history_mode(session, stock_symbols, history_period, history_since))
+    elif history_since is not None:
+        print("错误: --since 需要与 --history 一起使用", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+
+    batch_mode = run_once or run_watch or input_source is not None or output_format is not None
+    if shards > 1 and not batch_mode:
+        print("错误: --shards 仅用于批处理模式 (--once、--watch、--delta 或 -f)", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if bar_period is not None and batch_mode:
+        print("错误: --bars 仅用于交互模式", file=sys.stderr)
+        sys.exit(EXIT_USAGE)
+    if batch_mode:
+        try:
+            if input_source is not None:
+                stock_symbols.extend(s for s in read_symbols(input_source) if s not in stock_symbols)
+            elif not stock_symbols and not sys.stdin.isatty():
+                stock_symbols = read_symbols('-')
+        except OSError as e:
+            print(f"错误: 无法读取代码列表: {e}", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+        stock_symbols = resolve_symbols(stock_symbols)
+        if not stock_symbols:
+            stock_symbols = load_indexes() if show_indexes else load_favorites()
+        if not stock_symbols:
+            print("错误: 没有需要获取的代码", file=sys.stderr)
+            sys.exit(EXIT_USAGE)
+
+        try:
+            # 第一次访问以获取 cookie（回放或模拟行情时不访问网络）
+            if stock_common.traffic_replayer is None and not stub:
+                session.get("https://gu.qq.com", headers=headers, verify=False)
+        except requests.exceptions.RequestException as e:
+            log_error("SESSION", "", f"Failed to initialize session: {e}")
+        sys.exit(run_batch_mode(session, headers, stock_symbols, output_format or "csv",
+                                watch=run_watch, refresh_interval=refresh_interval,
+                                show_trading_only=show_trading_only, delta=delta_output,
+                                show_stats=show_stats, stagger=stagger, extra_fields=extra_fields,
+                                shards=shards))
+
+    # 第一次访问以获取 cookie（回放或模拟行情时不访问网络）
+    if stock_common.traffic_replayer is None and not stub:
+        session.get("https://gu.qq.com", headers=headers, verify=False)
+
+    stock_symbols = resolve_symbols(stock_symbols)
+    tencent_wire_format.configure(show_ext_data, extra_fields)
 
     keyboard = KeyboardInput()  # 初始化跨平台输入检测
     try:
-        refresh_interval = 30  # 默认刷新间隔为30秒
-        stock_symbols = []
-        
-        i = 1
-        while i < len(sys.argv):
-            if sys.argv[i] == "-i" and i + 1 < len(sys.argv):
-                try:
-                    refresh_interval = int(sys.argv[i + 1])
-                    i += 2  # 跳过 -i 和它的参数值
-                except ValueError:
-                    print("错误: -i 参数需要一个整数值")
-                    sys.exit(1)
-            elif sys.argv[i] in ["-h", "--help", "-v", "--version", "-idx", "--indexes", "-e", "--ext-data", "-t", "--trading-only"]:
-                i += 1
-            elif sys.argv[i].startswith("-"):
-                # 处理未知参数
-                print(f"错误: 未知参数 '{sys.argv[i]}'")
-                display_help()
-                sys.exit(1)
-            else:
-                # 将股票代码转换为大写
-                stock_symbols.append(sys.argv[i].upper())
-                i += 1
-        
         running = True
         while running:
             os.system('cls' if os.name == 'nt' else 'clear')
             
             if len(stock_symbols) > 0 and not show_indexes:
-                all_stock_info = []
-                with ThreadPoolExecutor(max_workers=10) as executor:
-                    future_to_symbol = {}
-                    for symbol in stock_symbols:
-                        if is_crypto_symbol(symbol):
-                            future = executor.submit(get_crypto_info, symbol)
-                        elif is_forex_symbol(symbol):
-                            future = executor.submit(get_forex_info, symbol)
-                        else:
-                            future = executor.submit(get_stock_info, session, symbol, headers)
-                        future_to_symbol[future] = symbol
-
-                    for future in as_completed(future_to_symbol):
-                        try:
-                            stock_info = future.result()
-                            if stock_info and not stock_info.get("error"):
-                                all_stock_info.append(stock_info)
-                            elif stock_info and stock_info.get("error"):
-                                pass
-                        except Exception as e:
-                            symbol = future_to_symbol[future]
-                            log_error(symbol, "", f"获取 {symbol} 数据时出错: {e}")
-
-                # 按原始顺序排序结果
-                symbol_order = {symbol: i for i, symbol in enumerate(stock_symbols)}
-                all_stock_info.sort(key=lambda x: symbol_order.get(x.get('Symbol'), float('inf')))
+                all_stock_info = collect_quotes(session, headers, stock_symbols)
 
                 if show_trading_only:
-                    all_stock_info = [s for s in all_stock_info if s.get('Status') != "CLOSED"]
+                    with trace_span("filter", rows=len(all_stock_info)):
+                        all_stock_info = [s for s in all_stock_info if s.get('Status') != "CLOSED"]
 
                 if not all_stock_info:
                     print("错误: 输入的代码为无效代码，请检查后重新输入。")
                     sys.exit(1)
                 
-                display_stock_table(all_stock_info, show_ext_data)
+                display_stock_table(all_stock_info, show_ext_data, extra_fields, bar_period)
+                display_quarantine_notice(stock_symbols)
 
             else:
                 if show_indexes:
                     indexes = load_indexes()
-                    display_favorite_stocks(session, headers, favorites=indexes, show_ext_data=show_ext_data, show_trading_only=show_trading_only)
+                    display_favorite_stocks(session, headers, favorites=indexes, show_ext_data=show_ext_data, show_trading_only=show_trading_only, extra_fields=extra_fields, bar_period=bar_period)
                 else:
-                    display_favorite_stocks(session, headers, show_ext_data=show_ext_data, show_trading_only=show_trading_only)
+                    display_favorite_stocks(session, headers, show_ext_data=show_ext_data, show_trading_only=show_trading_only, extra_fields=extra_fields, bar_period=bar_period)
         
+            if show_stats:
+                print()
+                print("\n".join(get_stats_lines()))
             print(f"\n")
 
             start_time = time.time()
@@ -785,7 +1532,7 @@ if __name__ == "__main__":
                 remaining_time = int(timeout - elapsed_time)
                 
                 # 输出剩余时间，'\r' 表示回到行首，end='' 防止换行
-                print(f"\r按 'Q' 退出，按 'X' 切换自选/指数，或等待 {remaining_time} 秒后自动刷新...", end='', flush=True)
+                print(f"\r按 'Q' 退出，按 'X' 切换自选/指数，按 'S' 显示/隐藏统计，或等待 {remaining_time} 秒后自动刷新...", end='', flush=True)
                 
                 if keyboard.has_input():
                     char = keyboard.get_input()
@@ -796,6 +1543,9 @@ if __name__ == "__main__":
                     elif char == 'x':
                         show_indexes = not show_indexes
                         break
+                    elif char == 's':
+                        show_stats = not show_stats
+                        break
                 time.sleep(0.1)
             # 在刷新前清除剩余时间显示
             print("\r" + " " * 30 + "\r", end='', flush=True)
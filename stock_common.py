@@ -0,0 +1,3083 @@
+"""
+带薪看盘图形界面 (stock.py) 与命令行 (stock_cli.py) 共用的基础设施：
+日志、限流、录制回放、行情提供方注册表、共享行情缓存、代码目录、K 线聚合和刷新调度等
+"""
+import requests
+import json
+import os
+import sys
+import time
+import threading
+import queue
+import re
+import math
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+import logging
+import logging.handlers
+import atexit
+from urllib.parse import urlparse
+from datetime import datetime, timedelta, time as dt_time
+import tempfile
+import contextlib
+from collections import deque
+import struct
+import mmap
+import zlib
+import gzip
+import bisect
+import heapq
+import itertools
+import random
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# --- 配置和路径管理 ---
+
+def get_app_data_dir():
+    """获取用户特定的应用数据目录，并确保它存在"""
+    home = os.path.expanduser("~")
+    app_data_dir = os.path.join(home, ".stock_quote")
+    os.makedirs(app_data_dir, exist_ok=True)
+    return app_data_dir
+
+def get_resource_path(relative_path):
+    """获取资源的绝对路径，无论是在开发环境还是在PyInstaller打包后"""
+    if hasattr(sys, '_MEIPASS'):
+        # PyInstaller创建的临时文件夹
+        base_path = sys._MEIPASS
+    else:
+        # 正常开发环境
+        base_path = os.path.abspath(os.path.dirname(__file__))
+    return os.path.join(base_path, relative_path)
+
+# 配置日志：工作线程只把记录放入队列，由后台监听线程以 JSON 格式写入按大小轮转的日志文件
+# 图形界面、命令行和分片进程共用同一个日志文件，轮转在跨进程锁内进行
+LOG_FILE_NAME = 'stock_quote.log'
+LOG_MAX_BYTES = 2 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# 同一代码的同类错误在该时间窗口（秒）内只记录一次
+LOG_DEDUP_WINDOW = 60
+# 原始数据最多保留的字符数，超出时保留开头和结尾的片段
+LOG_MAX_DATA = 512
+
+
+class JsonLogFormatter(logging.Formatter):
+    """将日志记录格式化为单行 JSON"""
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "symbol": getattr(record, "symbol", None),
+            "error": record.getMessage(),
+        }
+        for key in ("data", "data_len", "suppressed"):
+            value = getattr(record, key, None)
+            if value:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SharedRotatingFileHandler(logging.Handler):
+    """
+    多个进程共用的按大小轮转日志处理器
+    每条记录在跨进程锁内检查文件大小、必要时轮转，再以追加方式打开、写入并关闭；
+    没有进程长期持有文件句柄，Windows 上重命名轮转不会因为其他进程占用而失败
+    """
+    def __init__(self, path, max_bytes, backup_count):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file_lock = _InterProcessLock(path + ".lock")
+
+    def emit(self, record):
+        try:
+            line = (self.format(record) + "\n").encode('utf-8')
+            with self.file_lock:
+                try:
+                    size = os.path.getsize(self.path)
+                except OSError:
+                    size = 0
+                if size and size + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, 'ab') as f:
+                    f.write(line)
+        except Exception:
+            self.handleError(record)
+
+    def _rotate(self):
+        """stock_quote.log -> .1 -> .2 ...，超出保留数量的最旧文件被覆盖"""
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        os.replace(self.path, self.path + ".1")
+
+
+# 导入模块时只创建记录器，不打开文件也不启动线程；由程序入口调用 setup_logging()
+logger = logging.getLogger("stock_quote")
+logger.setLevel(logging.ERROR)
+logger.propagate = False
+logger.addHandler(logging.NullHandler())
+_log_listener = None
+
+
+def setup_logging():
+    """创建异步日志：QueueHandler 放入队列，QueueListener 在后台线程写文件；重复调用不会重复创建"""
+    global _log_listener
+    if _log_listener is not None:
+        return logger
+    file_handler = SharedRotatingFileHandler(
+        os.path.join(get_app_data_dir(), LOG_FILE_NAME), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonLogFormatter())
+    log_queue = queue.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logger
+
+
+_log_dedup = {}
+_log_dedup_lock = threading.Lock()
+
+
+def truncate_log_data(data):
+    """截断过长的原始数据，保留开头和结尾的片段"""
+    data = str(data) if data else ""
+    if len(data) <= LOG_MAX_DATA:
+        return data
+    head = LOG_MAX_DATA * 3 // 4
+    return f"{data[:head]} ...[{len(data) - LOG_MAX_DATA} chars omitted]... {data[-(LOG_MAX_DATA - head):]}"
+
+
+def log_error(symbol, data, error_message):
+    """记录错误到日志文件（异步写入，同一代码的重复错误在时间窗口内只记录一次）"""
+    key = (symbol, str(error_message)[:80])
+    now = time.monotonic()
+    with _log_dedup_lock:
+        entry = _log_dedup.get(key)
+        if entry is not None and now - entry[0] < LOG_DEDUP_WINDOW:
+            entry[1] += 1
+            return
+        suppressed = entry[1] if entry is not None else 0
+        if len(_log_dedup) > 10000:
+            for k in [k for k, v in _log_dedup.items() if now - v[0] >= LOG_DEDUP_WINDOW]:
+                del _log_dedup[k]
+        _log_dedup[key] = [now, 0]
+    logger.error(error_message, extra={
+        "symbol": symbol,
+        "data": truncate_log_data(data),
+        "data_len": len(str(data)) if data else 0,
+        "suppressed": suppressed,
+    })
+
+
+def atomic_write_json(path, data):
+    """
+    原子写入 JSON 文件：先写入同目录下的临时文件并刷新到磁盘，再重命名覆盖目标文件
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# --- 限流与自适应并发 ---
+
+# 各上游主机的限流参数：每秒请求数、突发容量、初始并发和最大并发
+# hedge 表示是否允许对冲请求（网页抓取类的主机不对冲，避免加重负担）
+HOST_LIMITS = {
+    "qt.gtimg.cn": {"rate": 20.0, "burst": 20, "concurrency": 8, "max_concurrency": 32, "hedge": True},
+    "push2.eastmoney.com": {"rate": 10.0, "burst": 10, "concurrency": 4, "max_concurrency": 16, "hedge": True},
+    "push2his.eastmoney.com": {"rate": 5.0, "burst": 5, "concurrency": 4, "max_concurrency": 8, "hedge": False},
+    "www.528btc.com": {"rate": 1.0, "burst": 2, "concurrency": 2, "max_concurrency": 4, "hedge": False},
+}
+DEFAULT_HOST_LIMIT = {"rate": 10.0, "burst": 10, "concurrency": 4, "max_concurrency": 16, "hedge": False}
+
+# 平均延迟超过最小延迟的倍数时视为拥塞
+LATENCY_CONGESTION_FACTOR = 3.0
+# 被限流 (429/503) 或连接失败后的退避时间上限（秒）
+MAX_BACKOFF = 30.0
+# 线程池大小，真正的并发由各主机的限流器控制
+MAX_FETCH_WORKERS = 32
+
+# 对冲请求：首个请求超过该主机最近的 p95 延迟仍未返回时，再发一个相同的请求，先返回者胜出
+LATENCY_WINDOW = 256
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BUDGET_RATIO = 0.05  # 对冲请求占该主机请求总数的比例上限
+HEDGE_MIN_DELAY = 0.05
+
+
+class HostLimiter:
+    """
+    单个主机的令牌桶限流 + AIMD 并发控制
+    成功且延迟正常时并发加性增长，出错、被限流或延迟明显升高时并发减半；
+    429/503 等限流响应还会降低令牌速率并进入指数退避。
+    同时在环形缓冲区中记录最近的延迟，用于计算分位数和对冲阈值
+    """
+    def __init__(self, host, rate, burst, concurrency, max_concurrency, hedge=False):
+        self.host = host
+        self.hedge_enabled = hedge
+        self.latencies = array('d', bytes(8 * LATENCY_WINDOW))
+        self.latency_count = 0
+        self.sorted_latencies = None
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.limit = float(concurrency)
+        self.max_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.min_latency = None
+        self.avg_latency = None
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """阻塞直到拿到令牌且并发未超出限制"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if now < self.backoff_until:
+                    wait = self.backoff_until - now
+                elif self.in_flight >= int(self.limit):
+                    wait = 1.0
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                self.cond.wait(wait)
+
+    def release(self, latency, ok, throttled=False):
+        """记录一次请求的结果并调整限流参数"""
+        with self.cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self.requests += 1
+            if ok:
+                self.latencies[self.latency_count % LATENCY_WINDOW] = latency
+                self.latency_count += 1
+                if self.latency_count % 16 == 0:
+                    self.sorted_latencies = None
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency * 1.01, latency)
+                self.avg_latency = latency if self.avg_latency is None else self.avg_latency * 0.8 + latency * 0.2
+                self.backoff = 0.0
+                # 以平均延迟判断拥塞，单个慢请求不会导致并发减半
+                congested = self.avg_latency > self.min_latency * LATENCY_CONGESTION_FACTOR and self.avg_latency > 0.2
+                if congested:
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                    self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+            else:
+                self.errors += 1
+                if throttled:
+                    self.throttled += 1
+                    self.rate = max(self.base_rate / 16, self.rate / 2)
+                self.backoff = min(MAX_BACKOFF, max(1.0, self.backoff * 2))
+                self.backoff_until = now + self.backoff
+                self._decrease(now)
+            self.cond.notify_all()
+
+    def _decrease(self, now):
+        # 每个平均延迟周期内最多减半一次，避免一次拥塞导致并发降到底
+        if now - self.last_decrease >= (self.avg_latency or 1.0):
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+    def percentile(self, q):
+        """返回最近成功请求延迟的 q 分位数（秒），样本不足时返回 None"""
+        with self.cond:
+            n = min(self.latency_count, LATENCY_WINDOW)
+            if n < HEDGE_MIN_SAMPLES:
+                return None
+            # 排序结果每 16 个新样本才重新计算一次
+            if self.sorted_latencies is None or len(self.sorted_latencies) != n:
+                self.sorted_latencies = sorted(self.latencies[:n])
+            return self.sorted_latencies[min(n - 1, int(q * n))]
+
+    def hedge_delay(self):
+        """返回发出对冲请求前的等待时间，不允许对冲时返回 None"""
+        if not self.hedge_enabled:
+            return None
+        p95 = self.percentile(0.95)
+        return None if p95 is None else max(HEDGE_MIN_DELAY, p95)
+
+    def try_hedge(self):
+        """在预算内则占用一次对冲机会"""
+        with self.cond:
+            if self.hedges >= HEDGE_BUDGET_RATIO * self.requests + 1:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_hedge_win(self):
+        with self.cond:
+            self.hedge_wins += 1
+
+    def stats(self):
+        with self.cond:
+            return {
+                "host": self.host,
+                "rate": self.rate,
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "throttled": self.throttled,
+                "avg_latency_ms": (self.avg_latency or 0) * 1000,
+                "backoff": max(0.0, self.backoff_until - time.monotonic()),
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+
+class RateLimiter:
+    """
+    按主机划分的限流器集合
+    share 为本进程可用的额度比例：多个进程共同访问同一主机时按比例分摊速率、突发量和并发数
+    """
+    def __init__(self, share=1.0):
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.share = share
+
+    def get(self, host):
+        with self.lock:
+            limiter = self.hosts.get(host)
+            if limiter is None:
+                config = dict(HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+                if self.share < 1.0:
+                    config["rate"] = config["rate"] * self.share
+                    for key in ("burst", "concurrency", "max_concurrency"):
+                        config[key] = max(1, int(config[key] * self.share))
+                limiter = HostLimiter(host, **config)
+                self.hosts[host] = limiter
+            return limiter
+
+    def format_stats(self):
+        """返回用于统计视图的文本行"""
+        lines = ["主机                    速率/秒 并发 进行中  请求   错误  限流  平均延迟  退避"]
+        for host in sorted(self.hosts):
+            s = self.hosts[host].stats()
+            lines.append(f"{s['host']:<22} {s['rate']:>7.1f} {s['limit']:>4} {s['in_flight']:>6} {s['requests']:>5} "
+                         f"{s['errors']:>6} {s['throttled']:>5} {s['avg_latency_ms']:>7.0f}ms {s['backoff']:>4.0f}s")
+        return lines
+
+    def format_latency_stats(self):
+        """返回各主机延迟分位数和对冲请求的统计行"""
+        lines = ["主机                       p50      p95      p99  对冲  对冲胜出"]
+        for host in sorted(self.hosts):
+            limiter = self.hosts[host]
+            values = [limiter.percentile(q) for q in (0.5, 0.95, 0.99)]
+            cells = " ".join(f"{v * 1000:>6.0f}ms" if v is not None else f"{'-':>8}" for v in values)
+            s = limiter.stats()
+            lines.append(f"{host:<22} {cells} {s['hedges']:>5} {s['hedge_wins']:>9}")
+        return lines
+
+
+rate_limiter = RateLimiter()
+
+
+def _send_request(limiter, url, session, kwargs):
+    """经过限流器发出一次 GET 请求，并记录延迟和结果"""
+    with trace_span("acquire", "net", host=limiter.host):
+        limiter.acquire()
+    start = time.monotonic()
+    ok = False
+    throttled = False
+    try:
+        with trace_span("request", "net", host=limiter.host) as span:
+            response = (session or requests).get(url, **kwargs)
+            span["status"] = response.status_code
+        throttled = response.status_code in (429, 503)
+        ok = response.status_code < 500 and not throttled
+        if traffic_recorder is not None:
+            traffic_recorder.record_response(url, start, time.monotonic() - start, response)
+        return response
+    except requests.exceptions.RequestException as e:
+        if traffic_recorder is not None:
+            traffic_recorder.record_error(url, start, time.monotonic() - start, e)
+        raise
+    finally:
+        limiter.release(time.monotonic() - start, ok, throttled)
+
+
+def _close_response(future):
+    """关闭对冲中落败一方的响应，释放连接"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+hedge_executor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS * 2, thread_name_prefix="http")
+
+
+def http_get(url, session=None, **kwargs):
+    """
+    经过所属主机限流器的 GET 请求，所有上游请求都应通过此函数发出
+    对允许对冲的主机，请求超过最近的 p95 延迟仍未返回时，在预算内再发一个相同的请求，
+    先成功返回的结果胜出，另一个被取消（已发出的则在完成后关闭连接）
+    回放录制文件时直接返回录制的响应，不访问网络
+    """
+    if traffic_replayer is not None:
+        return traffic_replayer.get(url)
+    limiter = rate_limiter.get(urlparse(url).hostname)
+    delay = limiter.hedge_delay()
+    if delay is None:
+        return _send_request(limiter, url, session, kwargs)
+
+    primary = hedge_executor.submit(_send_request, limiter, url, session, kwargs)
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeoutError:
+        pass
+    if not limiter.try_hedge():
+        return primary.result()
+
+    hedge = hedge_executor.submit(_send_request, limiter, url, session, kwargs)
+    done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+    winner = primary if primary in done else hedge
+    loser = hedge if winner is primary else primary
+    if winner.exception() is not None:
+        # 先完成的一方失败时，以另一方的结果为准
+        winner, loser = loser, winner
+        wait([winner])
+    if winner is hedge:
+        limiter.record_hedge_win()
+    if not loser.cancel():
+        loser.add_done_callback(_close_response)
+    return winner.result()
+
+
+# --- 刷新过程跟踪 ---
+
+TRACE_MAX_EVENTS = 200000  # 只保留最近的事件，长时间跟踪时内存不会无限增长
+
+
+class TraceRecorder:
+    """
+    以 Chrome trace-event 格式记录刷新各阶段（调度、建立连接、请求、解析、排序、筛选、渲染）的起止时间
+    保存的 JSON 可在 chrome://tracing 或 Perfetto 中打开，按线程查看各阶段耗时和实际并发
+    """
+    def __init__(self):
+        self.events = deque(maxlen=TRACE_MAX_EVENTS)
+        self.thread_names = {}
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        thread = threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            self.events.append({"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": thread.ident,
+                                "ts": round((start - self.origin) * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+                                "args": args})
+
+    def save(self, path):
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in self.thread_names.items()]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return len(self.events)
+
+
+tracer = None
+
+
+def trace_span(name, category="refresh", **args):
+    """跟踪开启时记录一个阶段，否则什么也不做；with 语句得到的字典可在阶段内补充参数"""
+    if tracer is None:
+        return contextlib.nullcontext(args)
+    return tracer.span(name, category, **args)
+
+
+def _traced_connect(original, name):
+    def connect(self):
+        with trace_span(name, "net", host=self.host):
+            return original(self)
+    connect.traced_original = original
+    return connect
+
+
+def start_tracing():
+    """开始跟踪，并在 urllib3 的连接过程中记录 DNS 解析/TCP 连接和 TLS 握手"""
+    global tracer
+    tracer = TraceRecorder()
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    if not hasattr(HTTPConnection._new_conn, "traced_original"):
+        HTTPConnection._new_conn = _traced_connect(HTTPConnection._new_conn, "dns+tcp")
+        HTTPSConnection.connect = _traced_connect(HTTPSConnection.connect, "connect")
+
+
+def stop_tracing(path):
+    """停止跟踪并保存到 path，返回保存的事件数量"""
+    global tracer
+    recorder, tracer = tracer, None
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    for cls, attr in ((HTTPConnection, "_new_conn"), (HTTPSConnection, "connect")):
+        original = getattr(getattr(cls, attr), "traced_original", None)
+        if original is not None:
+            setattr(cls, attr, original)
+    return recorder.save(path) if recorder is not None else 0
+
+
+def get_traces_dir():
+    """获取跟踪文件目录，并确保它存在"""
+    path = os.path.join(get_app_data_dir(), "traces")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# --- 录制与回放 ---
+
+# 录制文件为 gzip 压缩的 NDJSON：首行为文件头，之后每行一条上游响应（或请求异常）及其耗时
+RECORDING_VERSION = 1
+RECORDING_FLUSH_INTERVAL = 1.0  # 录制时刷新到磁盘的最小间隔（秒），异常退出时最多丢失这段时间的记录
+
+
+def get_recordings_dir():
+    """获取录制文件目录，并确保它存在"""
+    path = os.path.join(get_app_data_dir(), "recordings")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class TrafficRecorder:
+    """将每个上游原始响应连同时间偏移和延迟写入压缩文件，用于之后离线回放"""
+    def __init__(self, app, path=None):
+        self.path = path or os.path.join(get_recordings_dir(), datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{app}.ndjson.gz")
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last_flush = self.start
+        self.count = 0
+        self.file = gzip.open(self.path, 'wt', encoding='utf-8')
+        self._write({"version": RECORDING_VERSION, "app": app, "started": datetime.now().isoformat(timespec='seconds'),
+                     "epoch": round(time.time(), 3)})
+
+    def _write(self, entry):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            if "url" in entry:
+                self.count += 1
+            now = time.monotonic()
+            if now - self.last_flush >= RECORDING_FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def record_response(self, url, started, latency, response):
+        try:
+            body = response.text
+        except Exception as e:
+            log_error("RECORDING", url, f"Failed to read response body: {e}")
+            return
+        self._write({"t": round(started - self.start, 4), "url": url, "latency": round(latency, 4),
+                     "status": response.status_code, "body": body})
+
+    def record_error(self, url, started, latency, error):
+        self._write({"t": round(started - self.start, 4), "url": url, "latency": round(latency, 4),
+                     "error": type(error).__name__, "message": str(error)})
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TrafficReplayer:
+    """
+    从录制文件回放上游响应，不访问网络
+    回放时钟按 speed 倍速前进，每个 URL 返回录制时间不晚于当前回放时钟的最新响应，并按录制的延迟（同样按倍速缩短）等待
+    腾讯的批量请求按代码拆分索引，回放时即使批次的组成与录制时不同也能拼出响应
+    """
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.responses = {}      # url -> ([t...], [entry...])
+        self.tencent_lines = {}  # 腾讯代码 -> ([t...], [行...])
+        self.duration = 0.0
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header.get("version") != RECORDING_VERSION:
+                raise ValueError(f"不支持的录制文件版本: {header.get('version')}")
+            # 录制开始时的时间戳，较早的录制文件只有本地时间
+            self.started = header.get("epoch") or datetime.fromisoformat(header["started"]).timestamp()
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # 录制被中断时最后一行可能不完整
+                self._index(entry)
+        self.start = time.monotonic()
+
+    def _index(self, entry):
+        times, entries = self.responses.setdefault(entry["url"], ([], []))
+        times.append(entry["t"])
+        entries.append(entry)
+        self.duration = max(self.duration, entry["t"])
+        if urlparse(entry["url"]).hostname == "qt.gtimg.cn" and entry.get("status") == 200:
+            for line in entry["body"].split(';'):
+                line = line.strip()
+                if line.startswith('v_') and '=' in line:
+                    times, lines = self.tencent_lines.setdefault(line[2:line.index('=')].lower(), ([], []))
+                    times.append(entry["t"])
+                    lines.append(line)
+
+    def clock(self):
+        """当前回放到录制中的第几秒"""
+        return (time.monotonic() - self.start) * self.speed
+
+    def wall_time(self):
+        """回放时钟对应的录制时的时间戳"""
+        return self.started + self.clock()
+
+    def finished(self):
+        return self.clock() > self.duration
+
+    def _latest(self, timeline):
+        """时间线中不晚于当前回放时钟的最新一项；回放时钟早于第一项时返回第一项"""
+        if timeline is None:
+            return None
+        times, items = timeline
+        return items[max(0, bisect.bisect_right(times, self.clock()) - 1)]
+
+    def _tencent_entry(self, url):
+        codes = url.split('q=', 1)[1].split(',') if 'q=' in url else []
+        lines = []
+        for code in codes:
+            code = code.lower()
+            timeline = self.tencent_lines.get(code)
+            if timeline is None and code.startswith('s_'):
+                timeline = self.tencent_lines.get(code[2:])  # 录制中没有简要行情时用同一代码的完整记录代替
+            lines.append(self._latest(timeline))
+        lines = [line for line in lines if line]
+        if not lines:
+            return None
+        return {"latency": 0.0, "status": 200, "body": "\n".join(line + ";" for line in lines)}
+
+    def get(self, url):
+        entry = self._latest(self.responses.get(url))
+        if entry is None and urlparse(url).hostname == "qt.gtimg.cn":
+            entry = self._tencent_entry(url)
+        if entry is None:
+            entry = {"latency": 0.0, "status": 404, "body": "not in recording"}
+        time.sleep(entry["latency"] / self.speed)
+        if "error" in entry:
+            error_class = getattr(requests.exceptions, entry["error"], requests.exceptions.RequestException)
+            raise error_class(entry["message"])
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response._content = entry["body"].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = url
+        return response
+
+    def describe(self):
+        return f"回放 {os.path.basename(self.path)} ×{self.speed:g}: {min(self.clock(), self.duration):.0f}/{self.duration:.0f}s"
+
+
+traffic_recorder = None
+traffic_replayer = None
+
+
+def format_traffic_lines():
+    """返回统计视图中录制与回放状态的文本行"""
+    lines = []
+    if traffic_recorder is not None:
+        lines.append(f"录制中: {traffic_recorder.path}，已录制 {traffic_recorder.count} 条")
+    if traffic_replayer is not None:
+        lines.append(traffic_replayer.describe())
+    return lines or ["(未启用)"]
+
+
+def start_recording(app):
+    """开始录制上游响应，返回录制文件路径"""
+    global traffic_recorder
+    stop_recording()
+    traffic_recorder = TrafficRecorder(app)
+    return traffic_recorder.path
+
+
+def stop_recording():
+    global traffic_recorder
+    recorder, traffic_recorder = traffic_recorder, None
+    if recorder is not None:
+        recorder.close()
+
+
+def start_replay(path, speed=1.0):
+    """从录制文件回放，之后的所有上游请求都不再访问网络"""
+    global traffic_replayer
+    traffic_replayer = TrafficReplayer(path, speed)
+
+
+def stop_replay():
+    global traffic_replayer
+    traffic_replayer = None
+
+
+def quote_clock():
+    """当前时间戳；回放时返回回放时钟对应的录制时间，回放的行情按录制时的时间判断是否新鲜"""
+    replayer = traffic_replayer
+    return time.time() if replayer is None else replayer.wall_time()
+
+
+atexit.register(stop_recording)
+
+
+# --- 失效代码隔离 ---
+
+# 隔离后的重试间隔从 QUARANTINE_BASE_DELAY 开始每次翻倍，不超过各状态的上限
+QUARANTINE_BASE_DELAY = 60
+QUARANTINE_MAX_DELAY = {"INVALID": 3600, "FAILING": 600}
+QUARANTINE_LABELS = {"INVALID": "无效代码", "FAILING": "获取失败"}
+
+
+class SymbolQuarantine:
+    """
+    失效代码的负缓存
+    INVALID: 上游正常响应但没有该代码的数据（代码拼写错误、已退市）
+    FAILING: 该代码的请求或解析持续出错
+    被隔离的代码在重试时间到达之前直接跳过，不再发出请求；获取成功后解除隔离
+    只在进入隔离、状态改变和解除隔离时记录日志，隔离期间的重复失败只更新计数
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        # 分片工作进程中为 False：隔离状态由协调进程维护并记录
+        self.log_changes = True
+
+    def record_failure(self, symbol, state, reason=""):
+        with self.lock:
+            entry = self.entries.get(symbol)
+            failures = entry["failures"] + 1 if entry else 1
+            delay = min(QUARANTINE_BASE_DELAY * 2 ** (failures - 1), QUARANTINE_MAX_DELAY[state])
+            self.entries[symbol] = {"state": state, "failures": failures,
+                                    "retry_at": time.monotonic() + delay, "reason": reason}
+        if self.log_changes and (entry is None or entry["state"] != state):
+            log_error(symbol, "", f"Quarantined as {state}: {reason}")
+
+    def record_success(self, symbol):
+        with self.lock:
+            entry = self.entries.pop(symbol, None)
+        if self.log_changes and entry is not None:
+            log_error(symbol, "", f"Released from {entry['state']} quarantine after {entry['failures']} failures")
+
+    def get(self, symbol):
+        with self.lock:
+            entry = self.entries.get(symbol)
+            return dict(entry) if entry else None
+
+    def split_due(self, symbols):
+        """将代码分为可以请求的和仍在隔离期内的两组"""
+        now = time.monotonic()
+        due, held = [], []
+        with self.lock:
+            for symbol in symbols:
+                entry = self.entries.get(symbol)
+                (held if entry and entry["retry_at"] > now else due).append(symbol)
+        return due, held
+
+    def describe(self, symbol):
+        """返回代码隔离状态的说明，未被隔离时返回 None"""
+        entry = self.get(symbol)
+        if entry is None:
+            return None
+        remaining = max(0, int(entry["retry_at"] - time.monotonic()))
+        return f"{QUARANTINE_LABELS[entry['state']]}，已失败 {entry['failures']} 次，{remaining} 秒后重试"
+
+    def format_lines(self):
+        with self.lock:
+            entries = sorted(self.entries.items())
+        if not entries:
+            return ["(无)"]
+        now = time.monotonic()
+        lines = ["代码           状态      失败次数  重试倒计时  原因"]
+        for symbol, entry in entries:
+            lines.append(f"{symbol:<14} {entry['state']:<9} {entry['failures']:>8} {max(0, entry['retry_at'] - now):>9.0f}s  {entry['reason'][:40]}")
+        return lines
+
+
+symbol_quarantine = SymbolQuarantine()
+
+
+# --- 股票行情提供方与故障切换 ---
+
+EASTMONEY_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+    'Referer': 'https://quote.eastmoney.com/'
+}
+
+# 无法按规则推导的指数代码对应的东方财富 secid
+EASTMONEY_INDEX_SECIDS = {
+    ".DJI": "100.DJIA",
+    ".INX": "100.SPX",
+    ".IXIC": "100.NDX",
+    "HKHSI": "100.HSI",
+    "HKHSTECH": "124.HSTECH",
+}
+# 东方财富行情中与腾讯附加字段对应的字段编号，停牌或无数据时为 "-"
+EASTMONEY_OPTIONAL_FIELDS = {
+    "Open": "f17", "PrevClose": "f18", "High": "f15", "Low": "f16", "Volume": "f5", "Turnover": "f6",
+}
+# 腾讯美股代码的交易所后缀 (如 AAPL.OQ) 对应的东方财富市场编号
+US_EXCHANGE_MARKETS = {"OQ": "105", "N": "106", "AM": "107"}
+
+
+class SecidMap:
+    """
+    代码到东方财富 secid 的映射
+    A股、港股和常用指数按规则推导；美股的交易所从腾讯返回的代码后缀学习，
+    或通过东方财富搜索接口查询，结果保存在 secid_map.json 中
+    """
+    def __init__(self, filename='secid_map.json'):
+        self.path = os.path.join(get_app_data_dir(), filename)
+        self.lock = threading.Lock()
+        self.mapping = {}
+        self.unresolved = set()
+        self.dirty = False
+        # 分片工作进程中为 False：不写文件，新学到的映射由 take_learned() 交给协调进程合并保存
+        self.persist = True
+        self.learned = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.mapping = json.load(f).get('secids', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_error("SECID_MAP", "", f"Error loading secid map: {e}")
+
+    @staticmethod
+    def rule_secid(symbol):
+        symbol = symbol.upper()
+        if symbol in EASTMONEY_INDEX_SECIDS:
+            return EASTMONEY_INDEX_SECIDS[symbol]
+        match = re.fullmatch(r'(SH|SZ|BJ|HK)(\d+)', symbol)
+        if not match:
+            return None
+        market = {"SH": "1", "SZ": "0", "BJ": "0", "HK": "116"}[match.group(1)]
+        return f"{market}.{match.group(2)}"
+
+    def get(self, symbol):
+        with self.lock:
+            return self.rule_secid(symbol) or self.mapping.get(symbol)
+
+    def learn(self, symbol, secid):
+        with self.lock:
+            if self.mapping.get(symbol) != secid:
+                self.mapping[symbol] = secid
+                self.unresolved.discard(symbol)
+                self.dirty = True
+                if not self.persist:
+                    self.learned[symbol] = secid
+
+    def take_learned(self):
+        """取出上次调用以来新学到的映射"""
+        with self.lock:
+            learned, self.learned = self.learned, {}
+        return learned
+
+    def merge(self, learned):
+        """合并分片工作进程学到的映射"""
+        for symbol, secid in learned.items():
+            self.learn(symbol, secid)
+
+    def learn_from_tencent(self, symbol, code_field):
+        """从腾讯美股记录的代码字段（如 AAPL.OQ）学习交易所"""
+        _, _, suffix = code_field.rpartition('.')
+        market = US_EXCHANGE_MARKETS.get(suffix.upper())
+        if market and self.rule_secid(symbol) is None:
+            self.learn(symbol, f"{market}.{symbol.upper()}")
+
+    def resolve(self, symbol, session=None):
+        """返回 secid，未知的美股代码通过东方财富搜索接口查询（每个代码每次运行最多查询一次）"""
+        secid = self.get(symbol)
+        if secid or symbol in self.unresolved:
+            return secid
+        url = ("https://searchapi.eastmoney.com/api/suggest/get?type=14&count=5"
+               f"&token=D43BF722C8E33BDC906FB84D85E326E8&input={symbol}")
+        try:
+            response = http_get(url, session, headers=EASTMONEY_HEADERS, timeout=10)
+            response.raise_for_status()
+            items = (response.json().get('QuotationCodeTable') or {}).get('Data') or []
+            for item in items:
+                if str(item.get('Code', '')).upper() == symbol.upper() and str(item.get('MktNum')) in US_EXCHANGE_MARKETS.values():
+                    secid = item.get('QuoteID')
+                    self.learn(symbol, secid)
+                    self.save_if_dirty()
+                    return secid
+        except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+            log_error(symbol, "", f"Eastmoney secid lookup failed: {e}")
+        with self.lock:
+            self.unresolved.add(symbol)
+        return None
+
+    def save_if_dirty(self):
+        with self.lock:
+            if not self.dirty or not self.persist:
+                return
+            snapshot = dict(self.mapping)
+            self.dirty = False
+        try:
+            atomic_write_json(self.path, {'secids': snapshot})
+        except Exception as e:
+            log_error("SECID_MAP", "", f"Error saving secid map: {e}")
+
+
+secid_map = SecidMap()
+
+
+class ProviderHealth:
+    """
+    行情提供方的健康状态：延迟和错误率的指数平均、连续失败次数和冷却时间
+    排名时优先选择未冷却、得分（延迟 × 错误惩罚）最低的提供方；
+    错误率随时间衰减，出过故障的提供方过一段时间会重新排到前面接受试探
+    """
+    FAILURES_BEFORE_COOLDOWN = 3
+    COOLDOWN = 30.0
+    ERROR_HALF_LIFE = 120.0
+
+    def __init__(self, name, prior_latency):
+        self.name = name
+        self.latency = prior_latency
+        self.error_rate = 0.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.served = 0
+        self.lock = threading.Lock()
+
+    def _decayed_error_rate(self, now):
+        return self.error_rate * 0.5 ** ((now - self.updated) / self.ERROR_HALF_LIFE)
+
+    def record(self, ok, latency, served=0):
+        with self.lock:
+            now = time.monotonic()
+            self.requests += 1
+            self.served += served
+            self.error_rate = self._decayed_error_rate(now) * 0.8 + (0.0 if ok else 0.2)
+            self.updated = now
+            if ok:
+                self.latency = self.latency * 0.8 + latency * 0.2
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.FAILURES_BEFORE_COOLDOWN:
+                    self.cooldown_until = now + self.COOLDOWN
+
+    def rank_key(self):
+        with self.lock:
+            now = time.monotonic()
+            return (now < self.cooldown_until, self.latency * (1 + 4 * self._decayed_error_rate(now)))
+
+    def format_line(self):
+        with self.lock:
+            now = time.monotonic()
+            cooling = max(0.0, self.cooldown_until - now)
+            return (f"{self.name:<12} {self.latency * 1000:>7.0f}ms {self._decayed_error_rate(now) * 100:>6.1f}% "
+                    f"{self.requests:>6} {self.served:>8} {cooling:>5.0f}s")
+
+
+# 各行情提供方的健康状态，注册提供方时建立
+provider_health = {}
+
+
+def format_provider_stats():
+    lines = ["提供方         平均延迟  错误率   请求   提供行情  冷却  能力"]
+    for name in rank_providers():
+        lines.append(provider_health[name].format_line() + "  " + quote_providers[name].describe())
+    return lines
+
+
+# --- 代码元数据缓存 ---
+
+# 名称、地区和货币几乎不变：首次见到代码时记录，超过该秒数后在下一次获取行情时重新记录
+SYMBOL_METADATA_MAX_AGE = 86400
+REGION_CURRENCIES = {"SH": "CNY", "SZ": "CNY", "HK": "HKD", "US": "USD"}
+
+
+class SymbolMetadata:
+    """
+    代码元数据（名称、地区、货币）的持久化缓存，保存在 symbol_metadata.json 中
+    解析行情时未过期的代码直接使用缓存的名称和地区，只解析变化的数值字段；
+    图形界面启动时在联网之前就用它显示各代码的名称
+    """
+    def __init__(self, filename='symbol_metadata.json'):
+        self.path = os.path.join(get_app_data_dir(), filename)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        # 分片工作进程中为 False：不写文件，新记录的元数据由 take_learned() 交给协调进程合并保存
+        self.persist = True
+        self.learned = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get('symbols', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_error("SYMBOL_METADATA", "", f"Error loading symbol metadata: {e}")
+
+    def get(self, symbol):
+        """返回代码的元数据（不论是否过期），没有时返回 None"""
+        return self.entries.get(symbol)
+
+    def fresh(self, symbol):
+        """返回未过期的元数据，没有或已过期时返回 None"""
+        entry = self.entries.get(symbol)
+        if entry is None or time.time() - entry["updated"] > SYMBOL_METADATA_MAX_AGE:
+            return None
+        return entry
+
+    def learn(self, symbol, name, region=None, currency=None):
+        """记录代码的元数据并返回；名称为空时只返回不记录"""
+        entry = {"name": name, "region": region, "currency": currency or REGION_CURRENCIES.get(region),
+                 "updated": int(time.time())}
+        if name:
+            with self.lock:
+                self.entries[symbol] = entry
+                self.dirty = True
+                if not self.persist:
+                    self.learned[symbol] = entry
+        return entry
+
+    def take_learned(self):
+        """取出上次调用以来新记录的元数据"""
+        with self.lock:
+            learned, self.learned = self.learned, {}
+        return learned
+
+    def merge(self, learned):
+        """合并分片工作进程记录的元数据，同一代码保留较新的一条"""
+        with self.lock:
+            for symbol, entry in learned.items():
+                current = self.entries.get(symbol)
+                if current is None or current["updated"] <= entry["updated"]:
+                    self.entries[symbol] = entry
+                    self.dirty = True
+
+    def save_if_dirty(self):
+        with self.lock:
+            if not self.dirty or not self.persist:
+                return
+            snapshot = dict(self.entries)
+            self.dirty = False
+        try:
+            atomic_write_json(self.path, {'symbols': snapshot})
+        except Exception as e:
+            log_error("SYMBOL_METADATA", "", f"Error saving symbol metadata: {e}")
+
+
+symbol_metadata = SymbolMetadata()
+
+
+# --- 行情提供方注册表 ---
+
+QUOTE_ASSETS = ("equity", "crypto", "forex")
+
+
+class QuoteProvider:
+    """
+    行情提供方的公共约定：fetch(session, symbols, headers) 一次获取一组代码，返回 {symbol: stock_info 或 None}
+    单个代码出错时值为 {"error": 类型, "message": 说明}，类型为 "InvalidSymbol" 表示代码无效，其余按暂时失败处理
+    请求整体失败时抛出 RequestException，由调用方切换到下一个提供方
+    能力标记：batching 可在一次请求中获取多个代码，ext_hours 提供盘前盘后价格，timestamps 提供交易所时间
+    """
+    CAPABILITY_LABELS = (("batching", "批量"), ("ext_hours", "盘前盘后"), ("timestamps", "时间戳"))
+
+    def __init__(self, name, fetch, assets, batching=True, ext_hours=False, timestamps=False,
+                 prior_latency=0.3, enabled=True):
+        self.name = name
+        self.fetch = fetch
+        self.assets = set(assets)
+        self.batching = batching
+        self.ext_hours = ext_hours
+        self.timestamps = timestamps
+        self.prior_latency = prior_latency
+        self.enabled = enabled
+
+    def describe(self):
+        labels = [label for attr, label in self.CAPABILITY_LABELS if getattr(self, attr)]
+        return "/".join(sorted(self.assets)) + (" " + ",".join(labels) if labels else "")
+
+
+quote_providers = {}
+
+
+def register_provider(provider):
+    """注册（或替换）一个行情提供方，并为它建立健康状态"""
+    stub = quote_providers.get("stub")
+    if provider.name != "stub" and stub is not None and stub.enabled:
+        provider.enabled = False  # 模拟行情期间注册的在线提供方保持停用，避免意外访问网络
+    quote_providers[provider.name] = provider
+    if provider.name not in provider_health:
+        provider_health[provider.name] = ProviderHealth(provider.name, provider.prior_latency)
+
+
+def rank_providers(asset=None):
+    """按健康状况排序的已启用提供方名称列表，指定 asset 时只包含支持该品种的提供方"""
+    names = [name for name, provider in quote_providers.items()
+             if provider.enabled and (asset is None or asset in provider.assets)]
+    return sorted(names, key=lambda name: provider_health[name].rank_key())
+
+
+def batches_asset(asset):
+    """该品种当前首选的提供方是否支持批量获取"""
+    names = rank_providers(asset)
+    return bool(names) and quote_providers[names[0]].batching
+
+
+def fetch_from_providers(session, symbols, headers, asset="equity"):
+    """
+    按健康排名依次尝试支持该品种的提供方，前一个提供方缺失的代码交给下一个
+    成功的行情会在 "Source" 字段中记录提供方名称
+    """
+    results = {symbol: None for symbol in symbols}
+    remaining = list(symbols)
+    failures = {}
+    for name in rank_providers(asset):
+        if not remaining:
+            break
+        health = provider_health[name]
+        start = time.monotonic()
+        try:
+            with trace_span("provider", "quote", provider=name, symbols=len(remaining)):
+                batch = quote_providers[name].fetch(session, remaining, headers)
+        except requests.exceptions.RequestException as e:
+            health.record(False, time.monotonic() - start)
+            log_error(name.upper(), "", f"Provider request error, failing over: {e}")
+            continue
+
+        served = [symbol for symbol in remaining if batch.get(symbol) and not batch[symbol].get("error")]
+        # 整批请求成功但一个都没解析出来，视为提供方异常（单个代码时可能只是代码无效）
+        healthy = bool(served) or len(remaining) == 1
+        health.record(healthy, time.monotonic() - start, len(served))
+        for symbol in served:
+            batch[symbol]["Source"] = name
+            results[symbol] = batch[symbol]
+        remaining = [symbol for symbol in remaining if results[symbol] is None]
+        for symbol in remaining:
+            info = batch.get(symbol)
+            if info:
+                # 解析失败等暂时错误优先于无效：代码可能有数据，只是这次没取到
+                state = "INVALID" if info["error"] == "InvalidSymbol" else "FAILING"
+                if failures.get(symbol, ("INVALID",))[0] == "INVALID":
+                    failures[symbol] = (state, info.get("message", info["error"]))
+            elif healthy:
+                failures.setdefault(symbol, ("INVALID", "no data from any provider"))
+
+    # 只有提供方明确判定无效，或正常响应的提供方没有数据的代码才视为无效；
+    # 全部提供方请求失败时不隔离，由提供方健康状态处理
+    for symbol in remaining:
+        if symbol in failures:
+            symbol_quarantine.record_failure(symbol, *failures[symbol])
+    return results
+
+
+def fetch_each(fetch_one):
+    """
+    将单代码获取函数包装为批量约定，没有数据的代码为 None，出错的代码保留错误信息
+    网络错误作为提供方整体失败抛出，由 fetch_from_providers 切换到下一个提供方
+    """
+    def fetch(session, symbols, headers):
+        results = {}
+        for symbol in symbols:
+            info = fetch_one(symbol)
+            if info and info.get("error") == "NetworkError":
+                raise requests.exceptions.RequestException(info.get("message", "NetworkError"))
+            results[symbol] = info or None
+        return results
+    return fetch
+
+
+# 离线模拟行情的默认参数
+STUB_DEFAULT_RATE = 1.0    # 每个代码每秒的价格变动次数
+STUB_VOLATILITY = 0.002    # 每次变动的相对标准差
+STUB_LATENCY = 0.05        # 模拟的单次批量请求延迟（秒）
+
+
+class StubQuoteProvider:
+    """
+    离线模拟行情：每个代码从由代码决定的初始价格开始按对数正态随机游走，每秒变动 rate 次
+    距上次获取经过多次变动时一次合并计算，每次获取对每个代码都是 O(1)；不访问网络，
+    用于在没有上游的情况下以上万个代码做负载测试和界面性能分析
+    """
+    def __init__(self, rate=STUB_DEFAULT_RATE, volatility=STUB_VOLATILITY, latency=STUB_LATENCY):
+        self.rate = rate
+        self.volatility = volatility
+        self.latency = latency
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def _advance(self, symbol, now):
+        state = self.states.get(symbol)
+        if state is None:
+            seed = zlib.crc32(symbol.encode('utf-8'))
+            price = round(1 + seed % 50000 / 100, 2)
+            state = {"rng": random.Random(seed), "prev_close": price, "open": price, "price": price,
+                     "high": price, "low": price, "volume": 0, "turnover": 0.0, "tick": now}
+            self.states[symbol] = state
+        steps = int((now - state["tick"]) * self.rate)
+        if steps > 0:
+            rng = state["rng"]
+            state["tick"] += steps / self.rate
+            state["price"] = max(0.01, state["price"] * math.exp(rng.gauss(0, self.volatility * math.sqrt(steps))))
+            state["high"] = max(state["high"], state["price"])
+            state["low"] = min(state["low"], state["price"])
+            volume = rng.randint(1, 50) * 100 * steps
+            state["volume"] += volume
+            state["turnover"] += volume * state["price"]
+        return state
+
+    def _quote(self, symbol, state, now):
+        price = round(state["price"], 2)
+        change = round(price - state["prev_close"], 2)
+        quote = {
+            "Symbol": symbol,
+            "Name": f"模拟{symbol}",
+            "Price": price,
+            "Change": change,
+            "Percent": f"{change / state['prev_close'] * 100:.2f}%",
+        }
+        if is_crypto_symbol(symbol) or is_forex_symbol(symbol):
+            # 与在线的加密货币和外汇提供方一致：没有交易所时间、开高低收和成交量
+            quote["Status"] = "-"
+            return quote
+        quote.update({
+            "Status": "OPEN",
+            "ExchangeTime": int(now),
+            "Open": state["open"],
+            "PrevClose": state["prev_close"],
+            "High": round(state["high"], 2),
+            "Low": round(state["low"], 2),
+            "Volume": state["volume"],
+            "Turnover": round(state["turnover"], 2),
+            "QuoteTime": datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        if get_tencent_market_symbol(symbol)[1] == "US-Share":
+            # 只有美股个股有盘前盘后价格
+            ext_price = round(price * (1 + state["rng"].gauss(0, self.volatility)), 2)
+            quote["extPrice"] = ext_price
+            quote["extChange"] = round(ext_price - price, 2)
+            quote["extPercent"] = f"{(ext_price - price) / price * 100:.2f}%"
+        return quote
+
+    def fetch(self, session, symbols, headers):
+        time.sleep(self.latency)
+        now = time.time()
+        with self.lock:
+            return {symbol: self._quote(symbol, self._advance(symbol, now), now) for symbol in symbols}
+
+
+stub_provider = StubQuoteProvider()
+register_provider(QuoteProvider("stub", stub_provider.fetch, QUOTE_ASSETS, ext_hours=True, timestamps=True,
+                                prior_latency=0.0, enabled=False))
+
+
+def use_stub_provider(enabled=True, rate=STUB_DEFAULT_RATE):
+    """切换到离线模拟行情（停用所有在线提供方），或恢复在线提供方"""
+    stub_provider.rate = rate
+    for provider in quote_providers.values():
+        provider.enabled = (provider.name == "stub") == enabled
+
+
+def stub_provider_active():
+    return quote_providers["stub"].enabled
+
+
+# --- 跨进程共享行情缓存 ---
+
+# 共享缓存文件为固定布局的内存映射表：64 字节文件头 + 按代码哈希、线性探测的定长槽位
+# 每个槽位以序列号开头（seqlock）：写入前加一变为奇数，写完再加一；读取方不加锁，
+# 读到奇数或前后两次序列号不同就重读。写入方之间用文件锁互斥
+SHARED_CACHE_MAGIC = b"SQC2"
+SHARED_CACHE_SLOTS = 16384  # 槽位数量，必须是 2 的幂
+SHARED_CACHE_PROBES = 32    # 线性探测的最大步数，探测范围内没有空位时覆盖最久未更新的槽位
+SHARED_CACHE_HEADER = struct.Struct('<4sII')  # 魔数, 槽位数量, 槽位大小
+SHARED_CACHE_HEADER_SIZE = 64
+# 序列号, 代码, 写入时间, 8 个数值字段, 状态, 地区, 来源, 名称；文本按字符截断到各自的字节数
+SHARED_CACHE_SLOT = struct.Struct('<I16sd8d8s8s12s48s')
+SHARED_CACHE_SEQ = struct.Struct('<I')
+SHARED_CACHE_FIELDS = ("Price", "Change", "Percent", "extPrice", "extChange", "extPercent", "ExchangeTime", "Volume")
+SHARED_CACHE_TEXT_FIELDS = (("Status", 8), ("Region", 8), ("Source", 12), ("Name", 48))
+SHARED_CACHE_READ_RETRIES = 100
+SHARED_QUOTE_MAX_AGE = 15  # 其他进程在这么多秒内获取的行情直接复用，不再请求上游
+SHARED_CACHE_FILE_MODE = 0o644  # 缓存文件和锁文件的权限
+
+
+class _InterProcessLock:
+    """基于锁文件的跨进程互斥锁，同时用线程锁保证同一进程内的互斥"""
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), SHARED_CACHE_FILE_MODE)
+        self.file = os.fdopen(fd, 'r+b')
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.thread_lock.release()
+
+
+def encode_truncated(text, size):
+    """编码为 UTF-8 并截断到 size 字节以内，不拆开多字节字符"""
+    data = text.encode('utf-8')
+    if len(data) <= size:
+        return data
+    return data[:size].decode('utf-8', errors='ignore').encode('utf-8')
+
+
+class SharedQuoteCache:
+    """
+    多个进程（图形界面和若干命令行会话）共用的最新行情表
+    任一进程获取到行情后写入，其他进程在 max_age 秒内直接读取，重复的上游请求因此消失，且不需要单独的后台服务
+    只保存表格所需的核心字段，附加列仍需各自请求
+    """
+    def __init__(self, path, slots=SHARED_CACHE_SLOTS):
+        self.path = path
+        self.slots = slots
+        self.write_lock = _InterProcessLock(path + ".lock")
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        size = SHARED_CACHE_HEADER_SIZE + slots * SHARED_CACHE_SLOT.size
+        with self.write_lock:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), SHARED_CACHE_FILE_MODE)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            header = SHARED_CACHE_HEADER.unpack_from(self.mm, 0)
+            if header[0] == b"\0\0\0\0":
+                SHARED_CACHE_HEADER.pack_into(self.mm, 0, SHARED_CACHE_MAGIC, slots, SHARED_CACHE_SLOT.size)
+            elif header != (SHARED_CACHE_MAGIC, slots, SHARED_CACHE_SLOT.size):
+                self.mm.close()
+                raise ValueError(f"共享缓存文件布局不兼容: {header}")
+
+    def _probe(self, key):
+        start = zlib.crc32(key) & (self.slots - 1)
+        for i in range(SHARED_CACHE_PROBES):
+            yield SHARED_CACHE_HEADER_SIZE + ((start + i) & (self.slots - 1)) * SHARED_CACHE_SLOT.size
+
+    def _read_slot(self, offset):
+        """按 seqlock 协议读取一个槽位，写入方迟迟未完成时返回 None"""
+        for _ in range(SHARED_CACHE_READ_RETRIES):
+            seq = SHARED_CACHE_SEQ.unpack_from(self.mm, offset)[0]
+            if seq & 1:
+                continue
+            row = SHARED_CACHE_SLOT.unpack_from(self.mm, offset)
+            if row[0] == seq == SHARED_CACHE_SEQ.unpack_from(self.mm, offset)[0]:
+                return row
+        return None
+
+    def get(self, symbol, max_age):
+        """读取其他进程在 max_age 秒内写入的行情，没有时返回 None"""
+        key = encode_truncated(symbol, 16)
+        for offset in self._probe(key):
+            row = self._read_slot(offset)
+            if row is None:
+                break
+            slot_key = row[1].rstrip(b'\0')
+            if not slot_key:
+                break
+            if slot_key != key:
+                continue
+            if time.time() - row[2] > max_age:
+                break
+            self.hits += 1
+            return self._to_quote(symbol, row)
+        self.misses += 1
+        return None
+
+    def _to_quote(self, symbol, row):
+        values = dict(zip(SHARED_CACHE_FIELDS, row[3:11]))
+        status, region, source, name = (b.rstrip(b'\0').decode('utf-8') for b in row[11:15])
+        quote = {"Symbol": symbol, "Name": name, "Price": values["Price"], "Change": values["Change"],
+                 "Percent": f"{values['Percent']:.2f}%", "Status": status}
+        if not math.isnan(values["extPrice"]):
+            quote["extPrice"] = values["extPrice"]
+            quote["extChange"] = values["extChange"]
+            quote["extPercent"] = f"{values['extPercent']:.2f}%"
+        if not math.isnan(values["ExchangeTime"]):
+            quote["ExchangeTime"] = int(values["ExchangeTime"])
+        if not math.isnan(values["Volume"]):
+            quote["Volume"] = int(values["Volume"])
+        if region:
+            quote["Region"] = region
+        if source:
+            quote["Source"] = source
+        return quote
+
+    def put_many(self, quotes):
+        """写入一组行情，供其他进程读取"""
+        rows = []
+        for stock_info in quotes:
+            values = []
+            for field in SHARED_CACHE_FIELDS:
+                value = parse_percent(stock_info.get(field)) if field.endswith("Percent") else stock_info.get(field)
+                values.append(math.nan if value is None else float(value))
+            if any(math.isnan(v) for v in values[:3]):
+                continue
+            rows.append((encode_truncated(stock_info["Symbol"], 16), values,
+                         *(encode_truncated(str(stock_info.get(field) or ""), size) for field, size in SHARED_CACHE_TEXT_FIELDS)))
+        if not rows:
+            return
+        with self.write_lock:
+            now = time.time()
+            for key, values, status, region, source, name in rows:
+                target = oldest = None
+                for offset in self._probe(key):
+                    slot_key = self.mm[offset + 4:offset + 20].rstrip(b'\0')
+                    if slot_key == key or not slot_key:
+                        target = offset
+                        break
+                    updated = struct.unpack_from('<d', self.mm, offset + 20)[0]
+                    if oldest is None or updated < oldest[0]:
+                        oldest = (updated, offset)
+                if target is None:
+                    target = oldest[1]
+                seq = SHARED_CACHE_SEQ.unpack_from(self.mm, target)[0]
+                if not seq & 1:
+                    seq += 1
+                SHARED_CACHE_SEQ.pack_into(self.mm, target, seq)
+                SHARED_CACHE_SLOT.pack_into(self.mm, target, seq, key, now, *values, status, region, source, name)
+                SHARED_CACHE_SEQ.pack_into(self.mm, target, (seq + 1) & 0xFFFFFFFF)
+                self.writes += 1
+
+    def format_lines(self):
+        return [f"{self.path}",
+                f"命中 {self.hits}  未命中 {self.misses}  写入 {self.writes}  (复用 {SHARED_QUOTE_MAX_AGE} 秒内由任一进程获取的行情)"]
+
+
+_shared_quote_cache = None
+_shared_quote_cache_disabled = False
+_shared_quote_cache_lock = threading.Lock()
+
+
+def get_shared_quote_cache():
+    """返回跨进程共享行情缓存；回放、模拟行情或打开失败时返回 None"""
+    global _shared_quote_cache, _shared_quote_cache_disabled
+    if traffic_replayer is not None or stub_provider_active():
+        return None
+    with _shared_quote_cache_lock:
+        if _shared_quote_cache is None and not _shared_quote_cache_disabled:
+            try:
+                _shared_quote_cache = SharedQuoteCache(os.path.join(get_app_data_dir(), "quote_cache.bin"))
+            except (OSError, ValueError) as e:
+                log_error("SHARED_CACHE", "", f"Shared quote cache unavailable: {e}")
+                _shared_quote_cache_disabled = True
+        return _shared_quote_cache
+
+
+def disable_shared_quote_cache():
+    """本进程不再读写共享缓存（例如需要共享缓存中没有的附加列时）"""
+    global _shared_quote_cache_disabled
+    _shared_quote_cache_disabled = True
+
+
+def format_shared_cache_lines():
+    cache = _shared_quote_cache
+    if cache is None or _shared_quote_cache_disabled:
+        return ["(未启用)"]
+    return cache.format_lines()
+
+
+# --- 腾讯行情字段 ---
+
+TENCENT_TIME_FORMATS = ("%Y%m%d%H%M%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S")
+
+
+def parse_tencent_time(value):
+    """解析腾讯行情中的时间字段，A股/港股/美股的格式各不相同，无法解析时返回 None"""
+    for fmt in TENCENT_TIME_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _to_volume(value):
+    return int(float(value))
+
+
+def _to_quote_time(value):
+    parsed = parse_tencent_time(value)
+    if parsed is None:
+        raise ValueError(f"unknown time format: {value!r}")
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _ladder_fields(levels):
+    """五档盘口：买一价/量在第 9、10 个字段，卖一价/量在第 19、20 个字段，依次类推"""
+    fields = {}
+    for level in range(1, levels + 1):
+        fields[f"Bid{level}"] = (7 + 2 * level, float)
+        fields[f"BidVol{level}"] = (8 + 2 * level, _to_volume)
+        fields[f"Ask{level}"] = (17 + 2 * level, float)
+        fields[f"AskVol{level}"] = (18 + 2 * level, _to_volume)
+    return fields
+
+
+_TENCENT_COMMON_FIELDS = {
+    "PrevClose": (4, float),
+    "Open": (5, float),
+    "Volume": (6, _to_volume),
+    "QuoteTime": (30, _to_quote_time),
+    "High": (33, float),
+    "Low": (34, float),
+    "Turnover": (37, float),
+}
+
+# 各市场类型按需解码的附加字段: 名称 -> (字段序号, 转换函数)
+# 美股记录的 22~24 号字段是盘前盘后价格，盘口只有一档
+TENCENT_FIELD_LAYOUTS = {
+    "A-Share": dict(_TENCENT_COMMON_FIELDS, **_ladder_fields(5)),
+    "HK-Share": dict(_TENCENT_COMMON_FIELDS, **_ladder_fields(5)),
+    "US-Share": dict(_TENCENT_COMMON_FIELDS, **_ladder_fields(1)),
+    # 指数和个股的 s_ 简要行情只有成交量和成交额
+    "Index": {"Volume": (6, _to_volume), "Turnover": (7, float)},
+    "HK-Index": {"Volume": (6, _to_volume), "Turnover": (7, float)},
+    "Compact": {"Volume": (6, _to_volume), "Turnover": (7, float)},
+}
+
+# 可以作为附加列显示的字段
+OPTIONAL_FIELDS = (["Open", "PrevClose", "High", "Low", "Volume", "Turnover", "QuoteTime"]
+                   + [f"{side}{level}" for side in ("Bid", "BidVol", "Ask", "AskVol") for level in range(1, 6)])
+
+
+class TencentQuote(dict):
+    """
+    腾讯行情记录：常用字段在解析时填入字典，其余字段保留 '~' 分隔的原始字符串，
+    第一次访问时才解码并缓存；没有该字段或无法解码时与普通字典一样视为不存在
+    """
+    def __init__(self, fields, parts, market_type):
+        super().__init__(fields)
+        self.parts = parts
+        self.layout = TENCENT_FIELD_LAYOUTS.get(market_type, {})
+
+    def __missing__(self, key):
+        if key not in self.layout:
+            raise KeyError(key)
+        index, convert = self.layout[key]
+        try:
+            value = convert(self.parts[index])
+        except (IndexError, ValueError):
+            raise KeyError(key) from None
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+# --- 交易所时间与行情新鲜度 ---
+
+# 交易所时间距现在不超过该秒数时认为行情仍在更新，即处于交易中
+QUOTE_FRESH_SECONDS = 300
+CHINA_UTC_OFFSET = 8 * 3600
+EPOCH = datetime(1970, 1, 1)
+
+
+def us_eastern_utc_offset(utc_dt):
+    """美东时间相对 UTC 的偏移（秒）：夏令时从三月第二个周日到十一月第一个周日，均在当地 2:00 切换"""
+    second_sunday_march = datetime(utc_dt.year, 3, 8)
+    second_sunday_march += timedelta(days=(6 - second_sunday_march.weekday()) % 7)
+    first_sunday_november = datetime(utc_dt.year, 11, 1)
+    first_sunday_november += timedelta(days=(6 - first_sunday_november.weekday()) % 7)
+    # 2:00 EST = 7:00 UTC，2:00 EDT = 6:00 UTC
+    if second_sunday_march + timedelta(hours=7) <= utc_dt < first_sunday_november + timedelta(hours=6):
+        return -4 * 3600
+    return -5 * 3600
+
+
+def exchange_utc_offset(region, utc_dt):
+    return us_eastern_utc_offset(utc_dt) if region == "US" else CHINA_UTC_OFFSET
+
+
+def exchange_local_to_epoch(local_dt, region):
+    """将交易所当地时间转换为时间戳"""
+    # 美股先按标准时间估算 UTC，再取该时刻的实际偏移
+    offset = exchange_utc_offset(region, local_dt + timedelta(hours=5))
+    return int((local_dt - timedelta(seconds=offset) - EPOCH).total_seconds())
+
+
+def epoch_to_exchange_local(epoch, region):
+    utc_dt = EPOCH + timedelta(seconds=epoch)
+    return utc_dt + timedelta(seconds=exchange_utc_offset(region, utc_dt))
+
+
+def tencent_exchange_time(parts, region):
+    """腾讯完整行情的第 30 个字段为交易所当地时间，返回时间戳；缺失或无法解析时返回 None"""
+    try:
+        local_dt = parse_tencent_time(parts[30])
+    except IndexError:
+        return None
+    return None if local_dt is None else exchange_local_to_epoch(local_dt, region)
+
+
+def derive_market_status(region, exchange_time, schedule_status, now=None):
+    """
+    根据行情中的交易所时间推导市场状态，schedule_status 为按本地时钟和交易时段判断的结果：
+    交易所时间在 QUOTE_FRESH_SECONDS 以内为 OPEN；
+    按时段应在交易但时间停止前进时，同一交易日内为 STALE（上游延迟或冻结），否则为 CLOSED（假期、停牌）；
+    没有交易所时间时沿用 schedule_status
+    """
+    if exchange_time is None:
+        return schedule_status
+    now = quote_clock() if now is None else now
+    if now - exchange_time <= QUOTE_FRESH_SECONDS:
+        return "OPEN"
+    if schedule_status != "OPEN":
+        return "CLOSED"
+    if epoch_to_exchange_local(exchange_time, region).date() == epoch_to_exchange_local(now, region).date():
+        return "STALE"
+    return "CLOSED"
+
+
+# --- 腾讯简要行情 ---
+
+# 个股代码加 s_ 前缀即为简要行情：只有名称、代码、现价、涨跌、涨跌幅、成交量、成交额、市值等约 10 个字段，
+# 单条不到完整行情的五分之一，没有盘前盘后价格、开高低、盘口和交易所时间
+# 只请求简要行情时，每个地区每隔该秒数随机挑一个代码请求完整行情，用它的交易所时间推导该地区的市场状态
+REGION_CLOCK_INTERVAL = 60
+
+
+class TencentWireFormat:
+    """
+    按当前显示的列为每个代码选择腾讯行情格式：
+    美股显示盘前盘后数据、或显示了简要行情没有的附加列时请求完整行情，否则请求简要行情
+    显示内容改变时调用 configure()，下一次请求即使用新的格式
+    """
+    def __init__(self):
+        self.ext_data = False
+        self.fields = ()
+        self.lock = threading.Lock()
+        self.region_clock = {}   # 地区 -> 完整行情中最新的交易所时间
+        self.clock_probes = {}   # 地区 -> 上一次安排完整行情探测的时间
+        self.records = {"compact": 0, "full": 0}
+        self.response_bytes = 0
+
+    def configure(self, ext_data=False, fields=()):
+        """更新显示内容，返回新的显示内容是否需要当前格式没有的数据（需要重新获取）"""
+        richer = (ext_data and not self.ext_data) or (self._fields_need_full(fields) and not self._fields_need_full(self.fields))
+        self.ext_data = ext_data
+        self.fields = tuple(fields)
+        return richer
+
+    @staticmethod
+    def _fields_need_full(fields):
+        return any(field not in TENCENT_FIELD_LAYOUTS["Compact"] for field in fields)
+
+    def needs_full(self, market_type):
+        if market_type in ("Index", "HK-Index"):
+            return False
+        return (self.ext_data and market_type == "US-Share") or self._fields_need_full(self.fields)
+
+    def wire_codes(self, entries):
+        """
+        entries 为 [(腾讯代码, 市场类型, 地区)]，返回实际请求的代码列表：需要完整行情的代码和指数保持原样，
+        其余加 s_ 前缀；只请求简要行情的地区每隔 REGION_CLOCK_INTERVAL 秒有一个代码改为请求完整行情
+        """
+        full = [market_type in ("Index", "HK-Index") or self.needs_full(market_type) for _, market_type, _ in entries]
+        candidates = {}
+        for i, (_, _, region) in enumerate(entries):
+            if not full[i]:
+                candidates.setdefault(region, []).append(i)
+        now = time.monotonic()
+        with self.lock:
+            for region, indexes in candidates.items():
+                last = self.clock_probes.get(region)
+                if last is None or now - last >= REGION_CLOCK_INTERVAL:
+                    self.clock_probes[region] = now
+                    full[random.choice(indexes)] = True
+        return [code if is_full else "s_" + code for (code, _, _), is_full in zip(entries, full)]
+
+    def is_compact(self, wire_code, market_type):
+        return wire_code.lower().startswith("s_") and market_type not in ("Index", "HK-Index")
+
+    def update_clock(self, region, exchange_time):
+        """记录完整行情中的交易所时间，作为该地区简要行情的时钟"""
+        if exchange_time is None:
+            return
+        with self.lock:
+            if exchange_time > self.region_clock.get(region, 0):
+                self.region_clock[region] = exchange_time
+
+    def region_status(self, region, schedule_status):
+        """简要行情没有交易所时间，按该地区最近的完整行情推导市场状态"""
+        return derive_market_status(region, self.region_clock.get(region), schedule_status)
+
+    def covers(self, stock_info, market_type):
+        """共享缓存中的行情是否包含当前显示所需的数据（其他进程写入的简要行情没有盘前盘后价格）"""
+        return not (self.ext_data and market_type == "US-Share" and stock_info.get("Source") == "tencent"
+                    and "extPrice" not in stock_info)
+
+    def record_response(self, wire_codes, response_bytes):
+        compact = sum(1 for code in wire_codes if code.lower().startswith("s_"))
+        with self.lock:
+            self.records["compact"] += compact
+            self.records["full"] += len(wire_codes) - compact
+            self.response_bytes += response_bytes
+
+    def format_lines(self):
+        """返回统计视图中的文本行"""
+        with self.lock:
+            compact, full, response_bytes = self.records["compact"], self.records["full"], self.response_bytes
+        if self._fields_need_full(self.fields):
+            mode = "附加列需要完整行情"
+        elif self.ext_data:
+            mode = "美股完整行情（盘前盘后），其余简要行情"
+        else:
+            mode = "简要行情"
+        lines = [f"当前格式: {mode}"]
+        if compact + full:
+            lines.append(f"已请求简要行情 {compact} 条，完整行情 {full} 条，平均每条 {response_bytes / (compact + full):.0f} 字节")
+        return lines
+
+
+tencent_wire_format = TencentWireFormat()
+
+
+# --- 在线行情提供方 ---
+
+# 外汇代码映射表
+forex_code_map = {
+    "JPYUSD": {"secid": "119.JPYUSD", "name": "日元/美元"},
+    "USDCNH": {"secid": "133.USDCNH", "name": "美元/人民币"},
+    "EURUSD": {"secid": "119.EURUSD", "name": "欧元/美元"},
+    "GBPUSD": {"secid": "119.GBPUSD", "name": "英镑/美元"},
+    "AUDUSD": {"secid": "119.AUDUSD", "name": "澳元/美元"},
+    "USDJPY": {"secid": "119.USDJPY", "name": "美元/日元"},
+    "USDCHF": {"secid": "119.USDCHF", "name": "美元/瑞郎"},
+    "USDCAD": {"secid": "119.USDCAD", "name": "美元/加元"},
+    "USDHKD": {"secid": "119.USDHKD", "name": "美元/港币"},
+    "EURJPY": {"secid": "119.EURJPY", "name": "欧元/日元"},
+    "GBPJPY": {"secid": "119.GBPJPY", "name": "英镑/日元"}
+}
+
+
+def is_forex_symbol(symbol):
+    """
+    判断是否为外汇符号
+    外汇符号格式如: USDCNH, USDJPY, EURUSD 等
+    """
+    # 首先检查是否在支持的外汇代码映射表中
+    if symbol.upper() in forex_code_map:
+        return True
+    # 如果不在映射表中，使用正则表达式进行通用检查
+    # 外汇代码通常是6个字母组成，前3个是基础货币，后3个是报价货币
+    return bool(re.match(r'^[A-Z]{6}$', symbol)) and symbol != "SH513100" and symbol != "SH513500" and symbol != "SH513180" and symbol != "IBIT"
+
+
+def is_crypto_symbol(symbol):
+    """
+    判断是否为加密货币符号
+    """
+    crypto_symbols = ['BTC', 'ETH', 'XRP', 'USDT', 'BNB', 'SOL', 'USDC', 'DOGE', 'ADA', 'SHIB']
+    return symbol.upper() in crypto_symbols
+
+
+def get_crypto_info(symbol):
+    """
+    从528btc网站获取加密货币信息
+    """
+    symbol = symbol.upper()
+    
+    # 定义加密货币映射
+    crypto_mapping = {
+        'BTC': {'name': 'Bitcoin', 'id': 3008},
+        'ETH': {'name': 'Ethereum', 'id': 3007},
+        'XRP': {'name': 'Ripple', 'id': 3006},
+        'USDT': {'name': 'Tether', 'id': 32675},
+        'BNB': {'name': 'Binance Coin', 'id': 3155},
+        'SOL': {'name': 'Solana', 'id': 10114},
+        'USDC': {'name': 'USD Coin', 'id': 8249},
+        'DOGE': {'name': 'Dogecoin', 'id': 2993},
+        'ADA': {'name': 'Cardano', 'id': 3010},
+        'SHIB': {'name': 'Shiba Inu', 'id': 10547},
+        
+    }
+    
+    if symbol not in crypto_mapping:
+        return {"error": "InvalidSymbol", "message": f"不支持的加密货币: {symbol}"}
+    
+    html_content = ""
+    try:
+        url = f"https://www.528btc.com/coin/{crypto_mapping[symbol]['id']}/kline-24h"
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+            "Referer": "https://www.528btc.com/"
+        }
+        
+        response = http_get(url, headers=headers)
+        response.raise_for_status()
+        
+        # 解析HTML内容
+        html_content = response.text
+        
+        # 提取价格信息
+        price_match = re.search(r'<i class="price_num word(Rise|Fall)">\$?([0-9,]+\.?[0-9]*)</i>', html_content)
+        change_match = re.search(r'<span id="rise_fall_amount"[^>]*class="word(Rise|Fall)">([+-])\$?([0-9,]+\.?[0-9]*)</span>', html_content)
+        percent_match = re.search(r'<div id="rise_fall_percent"[^>]*>([+-]?)(?:\s*)([0-9]+\.?[0-9]*)\s*%', html_content)
+        
+        if not price_match:
+            error_message = f"无法解析 {symbol} 的价格信息"
+            log_error(symbol, html_content, error_message)
+            return {"error": "ParsingError", "message": error_message}
+        
+        # 处理价格中的逗号
+        price_str = price_match.group(2)
+        price = float(price_str.replace(',', ''))
+        
+        change = 0.0
+        percent = 0.0
+        
+        if change_match:
+            # 获取符号和数值
+            sign = change_match.group(2)  # '+' 或 '-'
+            change_str = change_match.group(3)  # 数值部分
+            change_value = float(change_str.replace(',', ''))
+            # 应用符号
+            if sign == '-':
+                change = -change_value
+            else:
+                change = change_value
+        
+        if percent_match:
+            # 正确处理正负号
+            sign = percent_match.group(1)  # '+' 或 '-'
+            percent_value = float(percent_match.group(2))
+            if sign == '-':
+                percent = -percent_value
+            else:
+                percent = percent_value
+            
+        crypto_info = {
+            "Region": "CRYPTO",
+            "Symbol": symbol,
+            "Name": crypto_mapping[symbol]['name'],
+            "Price": price,
+            "Change": change,
+            "Percent": f"{percent:.2f}%",
+            "Status": "-"
+        }
+        
+        return crypto_info
+        
+    except requests.exceptions.RequestException as e:
+        error_message = f"网络连接失败: {e}"
+        log_error(symbol, "", error_message)
+        return {"error": "NetworkError", "message": error_message}
+    except (ValueError, AttributeError) as e:
+        error_message = f"解析数据失败: {e}"
+        log_error(symbol, html_content, error_message)
+        return {"error": "ParsingError", "message": error_message}
+    except Exception as e:
+        error_message = f"发生未知错误: {e}"
+        log_error(symbol, html_content, error_message)
+        return {"error": "UnexpectedError", "message": error_message}
+
+
+def get_eastmoney_forex_info(symbol):
+    """
+    从东方财富网获取外汇信息
+    支持映射表中的外汇代码和通用的6位外汇代码
+    """
+    try:
+        symbol = symbol.upper()
+        
+        # 获取对应的secid
+        if symbol in forex_code_map:
+            # 使用预定义的secid
+            secid = forex_code_map[symbol]['secid']
+        else:
+            # 对于不在映射表中的外汇代码，尝试构造通用的secid
+            # 大多数外汇使用119作为市场代码
+            secid = f"119.{symbol}"
+        
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+            'Referer': f'https://quote.eastmoney.com/forex/{symbol}.html'
+        }
+        
+        # 请求东方财富网外汇API
+        api_url = f"https://push2.eastmoney.com/api/qt/stock/get?secid={secid}&fields=f43,f44,f45,f46,f47,f48,f49,f50,f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61,f170,f171,f168"
+        
+        response = http_get(api_url, headers=headers, timeout=10)
+        response.raise_for_status()
+        
+        # 解析JSON数据
+        data = response.json()
+        
+        if data and 'data' in data and data['data'] is not None:
+            api_data = data['data']
+            
+            # 名称取自代码元数据缓存；没有或已过期时优先使用API返回的名称，其次是映射表中的名称或通用名称
+            meta = symbol_metadata.fresh(symbol)
+            if meta is None:
+                if api_data.get('f58'):
+                    name = api_data['f58']
+                elif symbol in forex_code_map:
+                    name = forex_code_map[symbol]['name']
+                elif len(symbol) == 6:
+                    name = f"{symbol[:3]}/{symbol[3:]}"
+                else:
+                    name = symbol
+                meta = symbol_metadata.learn(symbol, name, "FX", symbol[3:] if len(symbol) == 6 else None)
+            
+            # 提取当前价格 (f43)
+            current_price = None
+            if 'f43' in api_data and api_data['f43']:
+                current_price = api_data['f43'] / 10000
+            
+            # 计算涨跌额 (f43 - f60)
+            change_amount = None
+            if 'f43' in api_data and 'f60' in api_data and api_data['f43'] and api_data['f60']:
+                change_amount = (api_data['f43'] - api_data['f60']) / 10000
+            
+            # 提取涨跌幅 (f170)
+            change_percent = None
+            if 'f170' in api_data and api_data['f170']:
+                change_percent = api_data['f170'] / 100  # 转换为百分比
+            
+            forex_info = {
+                "Region": "FX",
+                "Symbol": symbol,
+                "Name": meta["name"],
+                "Price": current_price,
+                "Change": change_amount,
+                "Percent": f"{change_percent:.2f}%" if change_percent is not None else "0.00%",
+                "Status": "-"
+            }
+            
+            return forex_info
+        else:
+            # 如果不在映射表中且东方财富网没有数据，返回错误
+            error_message = f"未能获取到有效的数据: {symbol}"
+            log_error(symbol, str(data), error_message)
+            return {"error": "ParsingError", "message": error_message}
+            
+    except requests.exceptions.RequestException as e:
+        error_message = f"网络连接失败: {e}"
+        log_error(symbol, "", error_message)
+        return {"error": "NetworkError", "message": error_message}
+    except json.JSONDecodeError as e:
+        error_message = f"解析JSON数据失败: {e}"
+        log_error(symbol, "", error_message)
+        return {"error": "ParsingError", "message": error_message}
+    except Exception as e:
+        error_message = f"发生未知错误: {e}"
+        log_error(symbol, "", error_message)
+        return {"error": "UnexpectedError", "message": error_message}
+
+def get_forex_info(symbol):
+    """
+    获取外汇信息，使用东方财富网API
+    """
+    return get_eastmoney_forex_info(symbol)
+
+
+def get_market_status(market):
+    """
+    根据当前时间判断市场状态
+    """
+    now = datetime.fromtimestamp(quote_clock())
+    weekday = now.weekday()  # Monday is 0 and Sunday is 6
+    
+    # Weekend
+    if weekday >= 5:
+        return "CLOSED"
+    
+    current_time = now.time()
+    
+    if market in ["SH", "SZ"]:  # A股市场
+        # A股交易时间:
+        # 上午: 9:30 - 11:30
+        # 下午: 13:00 - 15:00
+        morning_open = dt_time(9, 30)
+        morning_close = dt_time(11, 30)
+        afternoon_open = dt_time(13, 0)
+        afternoon_close = dt_time(15, 0)
+        
+        if (morning_open <= current_time <= morning_close) or \
+           (afternoon_open <= current_time <= afternoon_close):
+            return "OPEN"
+        else:
+            return "CLOSED"
+            
+    elif market == "HK":  # 港股市场
+        # 港股交易时间:
+        # 上午: 9:30 - 12:00
+        # 下午: 13:00 - 16:00
+        morning_open = dt_time(9, 30)
+        morning_close = dt_time(12, 0)
+        afternoon_open = dt_time(13, 0)
+        afternoon_close = dt_time(16, 0)
+        
+        if (morning_open <= current_time <= morning_close) or \
+           (afternoon_open <= current_time <= afternoon_close):
+            return "OPEN"
+        else:
+            return "CLOSED"
+    
+    
+    elif market == "US": # 美股市场
+        # 美股夏令时交易时间 (北京时间):
+        # 晚上: 21:30 - 凌晨 4:00
+        # 美股冬令时交易时间 (北京时间):
+        # 晚上: 22:30 - 凌晨 5:00
+        
+        # 简单处理，不区分冬夏令时，按夏令时计算
+        trading_open_evening = dt_time(21, 30)
+        trading_close_evening = dt_time(23, 59, 59)
+        trading_open_morning = dt_time(0, 0)
+        trading_close_morning = dt_time(4, 0)
+
+        if (trading_open_evening <= current_time <= trading_close_evening) or \
+           (trading_open_morning <= current_time <= trading_close_morning):
+            return "OPEN"
+        else:
+            return "CLOSED"
+
+    # Default case
+    return "-"
+
+
+def get_tencent_market_symbol(symbol):
+    """
+    将代码转换为腾讯行情接口使用的代码，并返回其市场类型
+    """
+    symbol_lower = symbol.lower()
+    if symbol_lower.startswith(('sh', 'sz')):
+        return symbol_lower, "A-Share"
+    elif symbol_lower.startswith('.'): # 指数
+        return f"s_us{symbol_lower}", "Index"
+    elif symbol_lower.startswith('hkhsi'):
+        return "s_hkHSI", "HK-Index"
+    elif symbol_lower.startswith('hkhstech'):
+        return "s_hkHSTECH", "HK-Index"
+    elif symbol_lower.startswith(('hk')):
+        return f"hk{symbol_lower[2:]}", "HK-Share"
+    else: # 默认美股
+        return f"us{symbol.upper()}", "US-Share"
+
+
+def get_tencent_region(symbol, market_type):
+    """个股所属地区：美股为 US，其余按代码前缀为 SH、SZ 或 HK"""
+    if market_type == "US-Share":
+        return "US"
+    return "SH" if symbol.startswith("SH") else "SZ" if symbol.startswith("SZ") else "HK"
+
+
+def get_quote_region(symbol):
+    """
+    按代码判断表格中显示的地区，元数据缓存中有记录时直接使用
+    """
+    meta = symbol_metadata.get(symbol)
+    if meta and meta["region"]:
+        return meta["region"]
+    if is_crypto_symbol(symbol):
+        return "CRYPTO"
+    if is_forex_symbol(symbol):
+        return "FX"
+    market_type = get_tencent_market_symbol(symbol)[1]
+    if market_type in ["Index", "HK-Index"]:
+        return "INDEX"
+    return get_tencent_region(symbol, market_type)
+
+
+def parse_tencent_quote(symbol, market_type, parts, compact=False):
+    """
+    将腾讯返回的 '~' 分隔字段解析为行情对象，附加字段在访问时才解码
+    compact 为 True 时 parts 为个股的 s_ 简要行情，市场状态按该地区最近的完整行情推导
+    名称和地区取自代码元数据缓存，缓存中没有或已过期时才从行情中解析并记录
+    """
+    if market_type in ["Index", "HK-Index"]:
+        meta = symbol_metadata.fresh(symbol) or symbol_metadata.learn(symbol, parts[1], "INDEX")
+        return TencentQuote({
+            "Region": "INDEX",
+            "Symbol": symbol,
+            "Name": meta["name"],
+            "Price": float(parts[3]),
+            "Change": float(parts[4]),
+            "Percent": f"{float(parts[5]):.2f}%",
+            "Status": "-"
+        }, parts, market_type)
+    meta = symbol_metadata.fresh(symbol) or symbol_metadata.learn(symbol, parts[1], get_tencent_region(symbol, market_type))
+    region = meta["region"]
+    if compact:
+        return TencentQuote({
+            "Region": region,
+            "Symbol": symbol,
+            "Name": meta["name"],
+            "Price": float(parts[3]),
+            "Change": float(parts[4]),
+            "Percent": f"{float(parts[5]):.2f}%",
+            "Status": tencent_wire_format.region_status(region, get_market_status(region))
+        }, parts, "Compact")
+    exchange_time = tencent_exchange_time(parts, region)
+    tencent_wire_format.update_clock(region, exchange_time)
+    status = derive_market_status(region, exchange_time, get_market_status(region))
+    if market_type == "US-Share":
+        return TencentQuote({
+            "Region": region,
+            "Symbol": symbol,
+            "Name": meta["name"],
+            "Price": float(parts[3]),
+            "Change": float(parts[31]),
+            "Percent": f"{float(parts[32]):.2f}%",
+            "extPrice": float(parts[22]),
+            "extChange": float(parts[23]),
+            "extPercent": f"{float(parts[24]):.2f}%",
+            "Status": status,
+            "ExchangeTime": exchange_time
+        }, parts, market_type)
+    else: # A-Share / HK-Share
+        return TencentQuote({
+            "Region": region,
+            "Symbol": symbol,
+            "Name": meta["name"],
+            "Price": float(parts[3]),
+            "Change": float(parts[31]),
+            "Percent": f"{float(parts[32]):.2f}%",
+            "Status": status,
+            "ExchangeTime": exchange_time
+        }, parts, market_type)
+
+
+
+# 腾讯接口单次请求合并的代码数量
+TENCENT_BATCH_SIZE = 60
+
+
+def get_stock_info_batch(session, symbols, headers):
+    """
+    在一次请求中从腾讯获取多只股票的信息
+    返回 {symbol: stock_info 或 None} 字典，解析失败的代码为错误信息
+    """
+    results = {symbol: None for symbol in symbols}
+    entries = []
+    for symbol in symbols:
+        market_symbol, market_type = get_tencent_market_symbol(symbol)
+        entries.append((market_symbol, market_type, get_tencent_region(symbol, market_type)))
+    wire_codes = tencent_wire_format.wire_codes(entries)
+    # 完整代码也加入映射：回放完整格式的录制时，简要行情的请求会得到完整记录
+    symbol_map = {}
+    for symbol, (market_symbol, market_type, _), wire_code in zip(symbols, entries, wire_codes):
+        symbol_map[market_symbol.lower()] = (symbol, market_type)
+        symbol_map[wire_code.lower()] = (symbol, market_type)
+
+    url = "https://qt.gtimg.cn/q=" + ",".join(wire_codes)
+    # 请求失败时抛出 RequestException，由 fetch_from_providers 切换到下一个提供方
+    response = http_get(url, session, headers=headers, verify=False)
+    response_text = response.text
+    response.raise_for_status()
+    tencent_wire_format.record_response(wire_codes, len(response.content))
+
+    # 返回格式: v_sh600000="1~浦发银行~600000~...";
+    with trace_span("parse", "quote", provider="tencent", symbols=len(symbols)):
+        # 先解析完整行情，用其交易所时间更新地区时钟，再解析简要行情
+        lines = sorted((line.strip() for line in response_text.split(';')), key=lambda line: line.startswith('v_s_'))
+        for line in lines:
+            if not line.startswith('v_') or '=' not in line:
+                continue
+            name, data_part = line.split('=', 1)
+            entry = symbol_map.get(name[2:].lower())
+            if entry is None:
+                continue
+            symbol, market_type = entry
+            data_part = data_part.strip('"\n')
+            if not data_part or "none" in data_part:
+                continue
+            parts = data_part.split('~')
+            try:
+                results[symbol] = parse_tencent_quote(symbol, market_type, parts, tencent_wire_format.is_compact(name[2:], market_type))
+            except (IndexError, ValueError) as e:
+                log_error(symbol, data_part, f"Parsing error: {e}")
+                results[symbol] = {"error": "ParsingError", "message": f"解析数据失败: {e}"}
+                continue
+            if market_type == "US-Share":
+                secid_map.learn_from_tencent(symbol, parts[2])
+
+    secid_map.save_if_dirty()
+    return results
+
+
+def parse_eastmoney_quote(symbol, item):
+    """
+    将东方财富 ulist 接口返回的字段解析为行情字典
+    f2: 最新价, f3: 涨跌幅, f4: 涨跌额, f14: 名称, f124: 行情时间戳
+    """
+    market_type = get_tencent_market_symbol(symbol)[1]
+    region = "INDEX" if market_type in ["Index", "HK-Index"] else get_tencent_region(symbol, market_type)
+    meta = symbol_metadata.fresh(symbol) or symbol_metadata.learn(symbol, item.get('f14'), region)
+    stock_info = {
+        "Region": region,
+        "Symbol": symbol,
+        "Name": meta["name"] or symbol,
+        "Price": float(item['f2']),
+        "Change": float(item['f4']),
+        "Percent": f"{float(item['f3']):.2f}%",
+    }
+    if region == "INDEX":
+        stock_info["Status"] = "-"
+    else:
+        exchange_time = int(item['f124']) if str(item.get('f124', '-')).isdigit() else None
+        stock_info["Status"] = derive_market_status(region, exchange_time, get_market_status(region))
+        stock_info["ExchangeTime"] = exchange_time
+        if exchange_time is not None:
+            stock_info["QuoteTime"] = epoch_to_exchange_local(exchange_time, region).strftime("%Y-%m-%d %H:%M:%S")
+    for field, key in EASTMONEY_OPTIONAL_FIELDS.items():
+        if item.get(key) not in (None, "-"):
+            stock_info[field] = item[key]
+    return stock_info
+
+
+def get_eastmoney_stock_info_batch(session, symbols, headers=None):
+    """
+    在一次请求中从东方财富获取多只股票的信息，作为腾讯接口的备用提供方
+    返回 {symbol: stock_info 或 None} 字典，解析失败的代码为错误信息，请求失败时抛出 RequestException
+    """
+    results = {symbol: None for symbol in symbols}
+    secid_to_symbol = {}
+    for symbol in symbols:
+        secid = secid_map.resolve(symbol, session)
+        if secid:
+            secid_to_symbol[secid] = symbol
+    if not secid_to_symbol:
+        return results
+
+    url = ("https://push2.eastmoney.com/api/qt/ulist.np/get?fltt=2&invt=2"
+           f"&fields=f2,f3,f4,f5,f6,f12,f13,f14,f15,f16,f17,f18,f124&secids={','.join(secid_to_symbol)}")
+    response = http_get(url, session, headers=EASTMONEY_HEADERS, timeout=10)
+    response.raise_for_status()
+    try:
+        diff = ((response.json() or {}).get('data') or {}).get('diff') or []
+    except ValueError as e:
+        raise requests.exceptions.RequestException(f"Invalid Eastmoney response: {e}")
+    if isinstance(diff, dict):
+        diff = list(diff.values())
+
+    with trace_span("parse", "quote", provider="eastmoney", symbols=len(symbols)):
+        for item in diff:
+            symbol = secid_to_symbol.get(f"{item.get('f13')}.{item.get('f12')}")
+            if symbol is None:
+                continue
+            try:
+                results[symbol] = parse_eastmoney_quote(symbol, item)
+            except (KeyError, TypeError, ValueError) as e:
+                # 停牌或无成交时价格字段为 "-"
+                log_error(symbol, json.dumps(item, ensure_ascii=False), f"Eastmoney parsing error: {e}")
+                results[symbol] = {"error": "ParsingError", "message": f"解析数据失败: {e}"}
+    return results
+
+
+# 初始延迟让腾讯排在东方财富之前
+register_provider(QuoteProvider("tencent", get_stock_info_batch, ["equity"], ext_hours=True, timestamps=True, prior_latency=0.2))
+register_provider(QuoteProvider("eastmoney", get_eastmoney_stock_info_batch, ["equity"], timestamps=True, prior_latency=0.4))
+register_provider(QuoteProvider("528btc", fetch_each(get_crypto_info), ["crypto"], batching=False, prior_latency=0.5))
+register_provider(QuoteProvider("eastmoney_fx", fetch_each(get_forex_info), ["forex"], batching=False, prior_latency=0.4))
+
+
+# --- 全市场扫描 ---
+
+# 各市场在东方财富 clist 接口中的筛选条件，以及代码前缀
+SCAN_MARKETS = {
+    "SH": ("m:1+t:2,m:1+t:23", "SH"),
+    "SZ": ("m:0+t:6,m:0+t:80", "SZ"),
+    "BJ": ("m:0+t:81+s:2048", "BJ"),
+    "HK": ("m:128+t:3,m:128+t:4", "HK"),
+    "US": ("m:105,m:106,m:107", ""),
+}
+DEFAULT_SCAN_MARKETS = ["SH", "SZ", "BJ"]
+SCAN_PAGE_SIZE = 100
+DEFAULT_SCAN_TOP = 10
+SCAN_REDRAW_INTERVAL = 0.5  # 扫描过程中重绘排行的最小间隔（秒）
+
+
+class TopN:
+    """
+    只保留 key 最大的 n 项的最小堆，内存占用固定为 O(n)
+    新项只需与堆顶比较，比堆顶小的直接丢弃
+    """
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.counter = itertools.count()
+
+    def offer(self, key, item):
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (key, next(self.counter), item))
+        elif key > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (key, next(self.counter), item))
+
+    def items(self):
+        return [item for _, _, item in sorted(self.heap, reverse=True)]
+
+
+class MarketScan:
+    """
+    一次全市场扫描的排行：涨幅榜、跌幅榜和成交额榜
+    每行只保存 (代码, 名称, 价格, 涨跌幅, 成交额) 元组，内存与市场规模无关
+    """
+    def __init__(self, top_n=DEFAULT_SCAN_TOP):
+        self.gainers = TopN(top_n)
+        self.losers = TopN(top_n)
+        self.turnover = TopN(top_n)
+        self.scanned = 0
+        self.total = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def offer(self, row):
+        _, _, _, percent, turnover = row
+        with self.lock:
+            self.scanned += 1
+            self.gainers.offer(percent, row)
+            self.losers.offer(-percent, row)
+            self.turnover.offer(turnover, row)
+
+    def add_total(self, count):
+        with self.lock:
+            self.total += count
+
+    def snapshot(self):
+        with self.lock:
+            return self.gainers.items(), self.losers.items(), self.turnover.items()
+
+
+def parse_scan_row(item, prefix):
+    """将 clist 接口的一行转换为 (代码, 名称, 价格, 涨跌幅, 成交额)，停牌等无价格的行返回 None"""
+    try:
+        return (f"{prefix}{item['f12']}", item.get('f14', ''), float(item['f2']),
+                float(item['f3']), float(item['f6']) if item.get('f6') not in (None, '-') else 0.0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def fetch_scan_page(session, market, page):
+    """获取某个市场的一页行情，返回 (该市场总数, 行列表)"""
+    fs, _ = SCAN_MARKETS[market]
+    url = ("https://push2.eastmoney.com/api/qt/clist/get?np=1&fltt=2&invt=2"
+           f"&pn={page}&pz={SCAN_PAGE_SIZE}&fs={fs}&fields=f2,f3,f6,f12,f13,f14")
+    response = http_get(url, session, headers=EASTMONEY_HEADERS, timeout=10)
+    response.raise_for_status()
+    data = (response.json() or {}).get('data') or {}
+    diff = data.get('diff') or []
+    if isinstance(diff, dict):
+        diff = list(diff.values())
+    return data.get('total', 0), diff
+
+
+def scan_market(session, markets=None, top_n=DEFAULT_SCAN_TOP, on_update=None, max_workers=MAX_FETCH_WORKERS):
+    """
+    分页扫描整个市场并维护排行榜
+    每个市场先请求第一页得到总数，再并发请求其余各页；每收到一页就更新排行并调用 on_update(scan)
+    """
+    scan = MarketScan(top_n)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(fetch_scan_page, session, market, 1): (market, 1) for market in markets or DEFAULT_SCAN_MARKETS}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                market, page = pending.pop(future)
+                try:
+                    total, rows = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    log_error(f"SCAN_{market}", "", f"Scan page {page} failed: {e}")
+                    continue
+                if page == 1:
+                    scan.add_total(total)
+                    for next_page in range(2, math.ceil(total / SCAN_PAGE_SIZE) + 1):
+                        pending[executor.submit(fetch_scan_page, session, market, next_page)] = (market, next_page)
+                prefix = SCAN_MARKETS[market][1]
+                for item in rows:
+                    row = parse_scan_row(item, prefix)
+                    if row is not None:
+                        scan.offer(row)
+                if on_update:
+                    on_update(scan)
+    scan.finished = time.monotonic()
+    return scan
+
+
+def format_scan_lines(scan):
+    """将扫描排行格式化为文本行"""
+    elapsed = (scan.finished or time.monotonic()) - scan.started
+    state = "完成" if scan.finished else "扫描中"
+    lines = [f"[全市场扫描] {state} {scan.scanned}/{scan.total or '?'} 只，用时 {elapsed:.1f} 秒"]
+    titles = ("涨幅榜", "跌幅榜", "成交额榜")
+    for title, rows in zip(titles, scan.snapshot()):
+        lines.append("")
+        lines.append(f"[{title}]")
+        lines.append(f"{'代码':<10}{'价格':>10}{'涨跌幅':>9}{'成交额(亿)':>10}  名称")
+        for symbol, name, price, percent, turnover in rows:
+            lines.append(f"{symbol:<12}{price:>12.3f}{percent:>11.2f}%{turnover / 1e8:>13.2f}  {name}")
+    return lines
+
+
+# --- 代码目录与搜索 ---
+
+# 本地代码目录：A股、港股和美股的代码和名称从东方财富 clist 接口分页下载后缓存，超过该秒数后重新下载
+SYMBOL_DIRECTORY_MAX_AGE = 7 * 86400
+DIRECTORY_MARKETS = ["SH", "SZ", "HK", "US"]
+DIRECTORY_CRYPTO = {
+    'BTC': 'Bitcoin', 'ETH': 'Ethereum', 'XRP': 'Ripple', 'USDT': 'Tether', 'BNB': 'Binance Coin',
+    'SOL': 'Solana', 'USDC': 'USD Coin', 'DOGE': 'Dogecoin', 'ADA': 'Cardano', 'SHIB': 'Shiba Inu',
+}
+SEARCH_LIMIT = 10
+
+# GB2312 一级汉字按拼音排序，这里是各声母第一个汉字的编码（没有以 I、U、V 开头的拼音）
+_PINYIN_BOUNDARIES = [
+    (0xB0A1, "A"), (0xB0C5, "B"), (0xB2C1, "C"), (0xB4EE, "D"), (0xB6EA, "E"), (0xB7A2, "F"),
+    (0xB8C1, "G"), (0xB9FE, "H"), (0xBBF7, "J"), (0xBFA6, "K"), (0xC0AC, "L"), (0xC2E8, "M"),
+    (0xC4C3, "N"), (0xC5B6, "O"), (0xC5BE, "P"), (0xC6DA, "Q"), (0xC8BB, "R"), (0xC8F6, "S"),
+    (0xCBFA, "T"), (0xCDDA, "W"), (0xCEF4, "X"), (0xD1B9, "Y"), (0xD4D1, "Z"),
+]
+_PINYIN_STARTS = [code for code, _ in _PINYIN_BOUNDARIES]
+_PINYIN_LAST = 0xD7F9
+# 股票名称中常见的多音字，各读音的首字母都建立索引
+POLYPHONE_INITIALS = {"行": "HX", "长": "CZ", "重": "ZC", "乐": "LY", "厦": "XS", "藏": "ZC", "调": "TD"}
+
+
+def pinyin_initials(text, max_variants=4):
+    """
+    名称的拼音首字母：汉字取 GB2312 一级汉字的声母，字母和数字原样保留，其余字符忽略
+    多音字产生多个结果，最多 max_variants 个
+    """
+    variants = [""]
+    for ch in text:
+        if ch in POLYPHONE_INITIALS:
+            letters = POLYPHONE_INITIALS[ch]
+        elif ch.isascii():
+            if not ch.isalnum():
+                continue
+            letters = ch.upper()
+        else:
+            try:
+                code = int.from_bytes(ch.encode('gb2312'), 'big')
+            except UnicodeEncodeError:
+                continue
+            if not _PINYIN_STARTS[0] <= code <= _PINYIN_LAST:
+                continue
+            letters = _PINYIN_BOUNDARIES[bisect.bisect_right(_PINYIN_STARTS, code) - 1][1]
+        variants = [variant + letter for variant in variants for letter in letters][:max_variants]
+    return variants
+
+
+class SymbolDirectory:
+    """
+    本地代码目录及其前缀索引，代码、不带市场前缀的数字代码、名称和名称的拼音首字母都可以按前缀检索
+    索引是展平成有序数组的前缀树：所有键按字典序排列，同一前缀下的子树是一段连续区间，
+    二分查找定位区间起点后顺序取出，一次查询为 O(log n + 结果数)，内存只有键本身
+    """
+    def __init__(self, filename='symbol_directory.json'):
+        self.path = os.path.join(get_app_data_dir(), filename)
+        self.lock = threading.Lock()
+        self.entries = []      # [(代码, 名称, 市场)]
+        self.by_symbol = {}
+        self.keys = []
+        self.ids = []
+        self.updated = 0
+
+    def load(self):
+        """从缓存文件加载目录并建立索引，没有缓存或无法读取时返回 False"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            log_error("SYMBOL_DIRECTORY", "", f"Error loading symbol directory: {e}")
+            return False
+        self._build([tuple(entry) for entry in data.get('symbols', [])], data.get('updated', 0))
+        return True
+
+    def is_stale(self):
+        return time.time() - self.updated > SYMBOL_DIRECTORY_MAX_AGE
+
+    def available(self):
+        return bool(self.entries)
+
+    def download(self, session, local_entries=(), max_workers=MAX_FETCH_WORKERS):
+        """
+        分页下载各市场的代码和名称，加上本地的外汇和加密货币代码后重建索引并写入缓存
+        每个市场先请求第一页得到总数，再并发请求其余各页；任一页失败时保留原有目录，返回是否成功
+        """
+        entries = list(local_entries)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(fetch_scan_page, session, market, 1): (market, 1) for market in DIRECTORY_MARKETS}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    market, page = pending.pop(future)
+                    try:
+                        total, rows = future.result()
+                    except (requests.exceptions.RequestException, ValueError) as e:
+                        log_error("SYMBOL_DIRECTORY", "", f"Directory page {market}/{page} failed: {e}")
+                        for other in pending:
+                            other.cancel()
+                        return False
+                    if page == 1:
+                        for next_page in range(2, math.ceil(total / SCAN_PAGE_SIZE) + 1):
+                            pending[executor.submit(fetch_scan_page, session, market, next_page)] = (market, next_page)
+                    prefix = SCAN_MARKETS[market][1]
+                    entries.extend((f"{prefix}{item['f12']}", item['f14'], market)
+                                   for item in rows if item.get('f12') and item.get('f14'))
+        entries.extend((symbol, name, "CRYPTO") for symbol, name in DIRECTORY_CRYPTO.items())
+        # 分页期间行情排序变化可能使同一代码出现在相邻两页
+        self._build(list({entry[0]: entry for entry in entries}.values()), int(time.time()))
+        try:
+            atomic_write_json(self.path, {'updated': self.updated, 'symbols': self.entries})
+        except Exception as e:
+            log_error("SYMBOL_DIRECTORY", "", f"Error saving symbol directory: {e}")
+        return True
+
+    def _build(self, entries, updated):
+        """为每个代码生成检索键并排序，完成后一次性替换，查询不会看到建了一半的索引"""
+        by_symbol = {}
+        pairs = []
+        for i, (symbol, name, market) in enumerate(entries):
+            by_symbol[symbol] = i
+            keys = {symbol, name.upper()}
+            if market in ("SH", "SZ", "HK"):
+                keys.add(symbol[2:])
+            if not name.isascii():
+                keys.update(pinyin_initials(name))
+            pairs.extend((key, i) for key in keys if key)
+        pairs.sort()
+        with self.lock:
+            self.entries = entries
+            self.by_symbol = by_symbol
+            self.keys = [key for key, _ in pairs]
+            self.ids = [i for _, i in pairs]
+            self.updated = updated
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """按前缀检索，返回最多 limit 个 (代码, 名称, 市场)，与输入完全相同的代码排在最前"""
+        prefix = text.strip().upper()
+        if not prefix:
+            return []
+        with self.lock:
+            entries, by_symbol, keys, ids = self.entries, self.by_symbol, self.keys, self.ids
+        results = []
+        seen = set()
+        if prefix in by_symbol:
+            seen.add(by_symbol[prefix])
+            results.append(entries[by_symbol[prefix]])
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if len(results) >= limit or not keys[i].startswith(prefix):
+                break
+            if ids[i] not in seen:
+                seen.add(ids[i])
+                results.append(entries[ids[i]])
+        return results
+
+    def resolve(self, text):
+        """
+        将输入解析为目录中的代码：输入本身是代码，或者不带前缀的数字代码、完整名称、拼音首字母
+        只对应一个代码时返回该代码，否则返回 None
+        """
+        key = text.strip().upper()
+        with self.lock:
+            entries, by_symbol, keys, ids = self.entries, self.by_symbol, self.keys, self.ids
+        if key in by_symbol:
+            return key
+        matches = set()
+        i = bisect.bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            matches.add(ids[i])
+            i += 1
+        return entries[matches.pop()][0] if len(matches) == 1 else None
+
+    def contains(self, symbol):
+        return symbol in self.by_symbol
+
+
+symbol_directory = SymbolDirectory()
+
+
+# --- K线聚合 ---
+
+# 由每次刷新得到的行情逐笔聚合的 K 线周期（秒），按 UTC 整点对齐
+BAR_PERIODS = {"1m": 60, "5m": 300, "15m": 900, "1h": 3600}
+# 每个代码每个周期在内存中保留的已收盘 K 线数量
+BAR_HISTORY = 240
+# 文件中的行数超过保留数量的该倍数时重写文件，每个代码只保留最近 BAR_HISTORY 根
+BAR_COMPACT_FACTOR = 2
+# 走势列使用的 K 线数量
+SPARKLINE_BARS = 20
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
+
+
+class BarAggregator:
+    """
+    按刷新得到的行情为每个代码增量生成各周期的 K 线（开、高、低、收、量）
+    每笔行情只更新各周期当前未收盘的一根 K 线，不回看历史；已收盘的 K 线放入定长环形缓冲区，
+    并追加写入 bars 目录下各周期的文件，下次启动时读回；多个进程共用这些文件，追加和重写都在跨进程锁内进行
+    成交量由行情中的累计成交量相减得到，没有成交量字段的行情只更新价格
+    """
+    def __init__(self, dirname='bars'):
+        self.directory = os.path.join(get_app_data_dir(), dirname)
+        self.lock = threading.Lock()
+        self.symbols = {}   # 代码 -> {"volume": 上一笔累计成交量, "open": {周期: 未收盘K线}, "closed": {周期: deque}}
+        self.pending = []   # 待写入文件的 (周期, 代码, 已收盘K线)
+        self.file_lines = dict.fromkeys(BAR_PERIODS, 0)
+        self.compacted_lines = dict.fromkeys(BAR_PERIODS, 0)  # 上次重写后文件中的行数
+        self.file_lock = None
+        self.loaded = False
+        self.stats = {"ticks": 0, "closed": 0, "written": 0}
+
+    def _state(self, symbol):
+        state = self.symbols.get(symbol)
+        if state is None:
+            state = self.symbols[symbol] = {"volume": None, "open": {}, "closed": {}}
+        return state
+
+    def _path(self, period):
+        return os.path.join(self.directory, f"{period}.csv")
+
+    def _load(self):
+        """读回各周期文件中的已收盘 K 线，每行为 代码,开始时间,开,高,低,收,量"""
+        self.loaded = True
+        for period in BAR_PERIODS:
+            lines = 0
+            try:
+                with open(self._path(period), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        lines += 1
+                        try:
+                            symbol, start, o, h, l, c, v = line.rstrip('\n').split(',')
+                            bar = (int(start), float(o), float(h), float(l), float(c), float(v))
+                        except ValueError:
+                            continue
+                        closed = self._state(symbol)["closed"]
+                        bars = closed.get(period)
+                        if bars is None:
+                            bars = closed[period] = deque(maxlen=BAR_HISTORY)
+                        # 多个进程写入同一文件时可能有重复或乱序的 K 线
+                        if not bars or bar[0] > bars[-1][0]:
+                            bars.append(bar)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log_error("BARS", "", f"Error loading {period} bars: {e}")
+            self.file_lines[period] = lines
+
+    def reset(self):
+        """丢弃内存中的 K 线（切换到回放或模拟行情时），下一笔行情到达时重新从文件读回"""
+        with self.lock:
+            self.symbols = {}
+            self.pending = []
+            self.loaded = False
+
+    def update(self, stock_info, now=None):
+        """用一笔行情更新该代码各周期的 K 线；休市、停滞或没有价格的行情不参与聚合"""
+        price = stock_info.get("Price")
+        if not isinstance(price, (int, float)) or price <= 0 or stock_info.get("Status") in ("CLOSED", "STALE"):
+            return
+        symbol = stock_info.get("Symbol")
+        timestamp = int(stock_info.get("ExchangeTime") or (quote_clock() if now is None else now))
+        volume = stock_info.get("Volume")
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            self.stats["ticks"] += 1
+            state = self._state(symbol)
+            delta = 0
+            if isinstance(volume, (int, float)):
+                # 累计成交量变小说明进入了新的交易日，这一笔的增量未知
+                if state["volume"] is not None and volume >= state["volume"]:
+                    delta = volume - state["volume"]
+                state["volume"] = volume
+            for period, seconds in BAR_PERIODS.items():
+                start = timestamp - timestamp % seconds
+                bar = state["open"].get(period)
+                if bar is not None and start == bar[0]:
+                    if price > bar[2]:
+                        bar[2] = price
+                    if price < bar[3]:
+                        bar[3] = price
+                    bar[4] = price
+                    bar[5] += delta
+                elif bar is None or start > bar[0]:
+                    if bar is not None:
+                        closed_bar = tuple(bar)
+                        bars = state["closed"].get(period)
+                        if bars is None:
+                            bars = state["closed"][period] = deque(maxlen=BAR_HISTORY)
+                        if not bars or closed_bar[0] > bars[-1][0]:
+                            bars.append(closed_bar)
+                            self.pending.append((period, symbol, closed_bar))
+                            self.stats["closed"] += 1
+                    state["open"][period] = [start, price, price, price, price, delta]
+                # 早于当前 K 线的行情（时间倒退）忽略
+
+    def flush(self):
+        """把新收盘的 K 线追加到文件；回放和模拟行情的数据只保留在内存中"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending or traffic_replayer is not None or stub_provider_active():
+            return
+        by_period = {}
+        for period, symbol, bar in pending:
+            by_period.setdefault(period, []).append(
+                f"{symbol},{bar[0]},{bar[1]:g},{bar[2]:g},{bar[3]:g},{bar[4]:g},{bar[5]:g}\n")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.file_lock is None:
+                self.file_lock = _InterProcessLock(os.path.join(self.directory, "bars.lock"))
+            with self.file_lock:
+                for period, lines in by_period.items():
+                    with open(self._path(period), 'a', encoding='utf-8') as f:
+                        f.writelines(lines)
+                    self.file_lines[period] += len(lines)
+                    self.stats["written"] += len(lines)
+                    self._compact_if_needed(period)
+        except OSError as e:
+            log_error("BARS", "", f"Error saving bars: {e}")
+
+    def _compact_if_needed(self, period):
+        """
+        文件行数超过保留数量的 BAR_COMPACT_FACTOR 倍时原子地重写文件（调用方持有文件锁）
+        重写的内容从磁盘重新读取，其他进程追加的 K 线同样保留，每个代码保留最近 BAR_HISTORY 根
+        """
+        with self.lock:
+            kept = sum(len(state["closed"][period]) for state in self.symbols.values() if period in state["closed"])
+        if self.file_lines[period] <= BAR_COMPACT_FACTOR * max(kept, self.compacted_lines[period], BAR_HISTORY):
+            return
+        path = self._path(period)
+        series = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    continue  # 写到一半中断的行
+                symbol, _, rest = line.partition(',')
+                start, _, _ = rest.partition(',')
+                try:
+                    series.setdefault(symbol, {})[int(start)] = line
+                except ValueError:
+                    continue
+        lines = [bars[start] for bars in series.values() for start in sorted(bars)[-BAR_HISTORY:]]
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.file_lines[period] = self.compacted_lines[period] = len(lines)
+
+    def bars(self, symbol, period, count=BAR_HISTORY):
+        """返回最近 count 根 K 线 [(开始时间, 开, 高, 低, 收, 量)]，最后一根为尚未收盘的 K 线"""
+        with self.lock:
+            state = self.symbols.get(symbol)
+            if state is None:
+                return []
+            closed = state["closed"].get(period, ())
+            current = state["open"].get(period)
+            result = list(closed)[-count:] if closed else []
+        if current is not None:
+            result = result[-(count - 1):] if count > 1 else []
+            result.append(tuple(current))
+        return result
+
+    def summary(self, symbol, period, count=SPARKLINE_BARS):
+        """返回 (走势, 区间)：最近 count 根 K 线收盘价的字符走势图，以及其中的最低价~最高价；没有 K 线时返回 None"""
+        bars = self.bars(symbol, period, count)
+        if not bars:
+            return None
+        closes = [bar[4] for bar in bars]
+        low = min(bar[3] for bar in bars)
+        high = max(bar[2] for bar in bars)
+        span = high - low
+        levels = len(SPARKLINE_CHARS) - 1
+        spark = "".join(SPARKLINE_CHARS[round((close - low) / span * levels) if span else levels // 2] for close in closes)
+        return spark, f"{low:g}~{high:g}"
+
+    def format_lines(self):
+        """返回统计视图中的文本行"""
+        with self.lock:
+            symbols = len(self.symbols)
+            held = sum(len(bars) for state in self.symbols.values() for bars in state["closed"].values())
+            stats = dict(self.stats)
+        return [f"跟踪 {symbols} 个代码，内存中 {held} 根已收盘 K 线",
+                f"已处理行情 {stats['ticks']} 笔，收盘 K 线 {stats['closed']} 根，写入文件 {stats['written']} 根"]
+
+
+bar_aggregator = BarAggregator()
+
+
+# --- 刷新调度 ---
+
+# 优先级对刷新间隔的影响：不在当前列表中的代码、休市中的代码放慢，大幅波动的代码加快
+# 交易所时间连续未前进的代码每次翻倍放慢，最多与休市相同
+# 简要行情没有交易所时间，交易中累计成交量连续这么多次不变即视为冻结，状态改为 STALE
+HIDDEN_SYMBOL_FACTOR = 3.0
+CLOSED_MARKET_FACTOR = 10.0
+FROZEN_BACKOFF_BASE = 2.0
+VOLATILE_FACTOR = 0.5
+VOLATILE_PERCENT = 3.0
+MIN_SYMBOL_INTERVAL = 5
+MAX_SYMBOL_INTERVAL = 1800
+FROZEN_VOLUME_POLLS = 3
+
+
+def parse_percent(value):
+    """将 '1.23%' 形式的涨跌幅转换为浮点数，无法解析时返回 None"""
+    try:
+        return float(str(value).rstrip('%'))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_priority_interval(base_interval, stock_info=None, visible=True):
+    """
+    根据优先级计算单个代码的刷新间隔
+    """
+    interval = base_interval
+    if not visible:
+        interval *= HIDDEN_SYMBOL_FACTOR
+    if stock_info:
+        slowdown = CLOSED_MARKET_FACTOR if stock_info.get('Status') == "CLOSED" else 1.0
+        frozen = stock_info.get('FrozenPolls', 0)
+        if frozen:
+            slowdown = max(slowdown, min(FROZEN_BACKOFF_BASE ** frozen, CLOSED_MARKET_FACTOR))
+        interval *= slowdown
+        percent = parse_percent(stock_info.get('Percent'))
+        if percent is not None and abs(percent) >= VOLATILE_PERCENT:
+            interval *= VOLATILE_FACTOR
+    return min(MAX_SYMBOL_INTERVAL, max(MIN_SYMBOL_INTERVAL, interval))
+
+
+def note_exchange_time(previous, stock_info):
+    """
+    与同一代码上一次的行情比较交易所时间，在 FrozenPolls 中记录连续未前进的次数
+    没有交易所时间的行情（腾讯简要行情）改为比较累计成交量：交易中连续 FROZEN_VOLUME_POLLS 次不变时标记为 STALE
+    """
+    if previous is None:
+        return
+    exchange_time = stock_info.get('ExchangeTime')
+    if exchange_time is not None:
+        if previous.get('ExchangeTime') == exchange_time:
+            stock_info['FrozenPolls'] = previous.get('FrozenPolls', 0) + 1
+        return
+    volume = stock_info.get('Volume')
+    if volume is None or stock_info.get('Status') not in ("OPEN", "STALE") or previous.get('Volume') != volume:
+        return
+    stock_info['FrozenPolls'] = previous.get('FrozenPolls', 0) + 1
+    if stock_info['FrozenPolls'] >= FROZEN_VOLUME_POLLS:
+        stock_info['Status'] = "STALE"
+
+
+class RefreshScheduler:
+    """
+    基于最小堆的逐代码刷新调度器
+    每个代码按 interval_func 给出的间隔独立刷新，新代码的首次到期时间在一个间隔内均匀分布，
+    之后每次重新排期都加入随机抖动，使请求平滑地分散在整个间隔内。
+    取出一个到期代码和重新排期均为 O(log n)，失效的堆元素按版本号惰性删除。
+    """
+    def __init__(self, interval_func, jitter=0.1):
+        self.interval_func = interval_func
+        self.jitter = jitter
+        self.heap = []
+        self.versions = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.versions)
+
+    def _push(self, symbol, due):
+        version = next(self.counter)
+        self.versions[symbol] = version
+        heapq.heappush(self.heap, (due, version, symbol))
+
+    def _compact(self):
+        # 失效元素过多时重建堆，保证堆的大小与代码数量同阶
+        if len(self.heap) > 2 * len(self.versions) + 64:
+            self.heap = [e for e in self.heap if self.versions.get(e[2]) == e[1]]
+            heapq.heapify(self.heap)
+
+    def add(self, symbol, now=None):
+        """加入代码，首次到期时间在 [now, now + 间隔) 内随机分布"""
+        with self.lock:
+            if symbol in self.versions:
+                return
+            now = time.time() if now is None else now
+            self._push(symbol, now + random.uniform(0, self.interval_func(symbol)))
+
+    def remove(self, symbol):
+        with self.lock:
+            self.versions.pop(symbol, None)
+            self._compact()
+
+    def reschedule(self, symbol, now=None):
+        """优先级变化后重新排期，新的到期时间在新间隔内随机分布"""
+        with self.lock:
+            if symbol not in self.versions:
+                return
+            now = time.time() if now is None else now
+            self._push(symbol, now + random.uniform(0, self.interval_func(symbol)))
+            self._compact()
+
+    def sync(self, symbols, now=None):
+        """使调度的代码集合与给定集合一致"""
+        symbols = set(symbols)
+        for symbol in [s for s in self.versions if s not in symbols]:
+            self.remove(symbol)
+        for symbol in symbols:
+            self.add(symbol, now)
+
+    def pop_due(self, now=None):
+        """取出所有已到期的代码，并按各自的间隔加抖动重新排期"""
+        now = time.time() if now is None else now
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, version, symbol = heapq.heappop(self.heap)
+                if self.versions.get(symbol) != version:
+                    continue
+                due.append(symbol)
+                interval = self.interval_func(symbol)
+                self._push(symbol, now + interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+        return due
+
+    def next_due(self):
+        """返回最早的到期时间，没有代码时返回 None"""
+        with self.lock:
+            while self.heap and self.versions.get(self.heap[0][2]) != self.heap[0][1]:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+
+# --- 变化检测 ---
+
+# 参与变化检测的数值字段，每个字段对应掩码中的一位
+DELTA_FIELDS = ("Price", "Change", "extPrice", "extChange")
+
+
+class ChangeTracker:
+    """
+    保存上一次刷新的数值字段，用于找出发生变化的行
+    每个代码占用一个固定槽位，数值存放在紧凑的 array('d') 中，
+    每次比较只需 O(n) 次浮点比较，不做字典之间的比较
+    """
+    def __init__(self):
+        self.slots = {}
+        self.values = array('d')
+
+    @staticmethod
+    def _to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+
+    def update(self, symbol, stock_info):
+        """
+        记录一个代码的最新数值，返回 (掩码, 价格方向)
+        掩码的每一位表示 DELTA_FIELDS 中对应字段是否变化；首次出现的代码返回 None
+        """
+        width = len(DELTA_FIELDS)
+        slot = self.slots.get(symbol)
+        if slot is None:
+            self.slots[symbol] = len(self.values) // width
+            self.values.extend(self._to_float(stock_info.get(f)) for f in DELTA_FIELDS)
+            return None
+
+        base = slot * width
+        values = self.values
+        mask = 0
+        direction = 0
+        for i, field in enumerate(DELTA_FIELDS):
+            new = self._to_float(stock_info.get(field))
+            old = values[base + i]
+            if new != old and not (new != new and old != old):  # NaN 视为相等
+                mask |= 1 << i
+                if i == 0 and new == new and old == old:
+                    direction = 1 if new > old else -1
+                values[base + i] = new
+        return mask, direction
+
+    def diff(self, stock_data):
+        """
+        比较一次完整快照，返回 {symbol: (掩码, 价格方向)}，只包含变化或新出现的代码
+        新出现的代码对应的值为 None
+        """
+        changes = {}
+        for stock_info in stock_data:
+            symbol = stock_info.get('Symbol')
+            result = self.update(symbol, stock_info)
+            if result is None or result[0]:
+                changes[symbol] = result
+        return changes
+
+    @staticmethod
+    def changed_fields(mask):
+        """将掩码转换为字段名列表"""
+        return [field for i, field in enumerate(DELTA_FIELDS) if mask & (1 << i)]
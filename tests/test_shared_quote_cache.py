@@ -0,0 +1,138 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stock_common
+from stock_common import SharedQuoteCache, encode_truncated, SHARED_CACHE_PROBES, SHARED_CACHE_SEQ
+
+
+def make_quote(symbol, price, **extra):
+    quote = {"Symbol": symbol, "Name": "名称" + symbol, "Price": price, "Change": price / 10,
+             "Percent": "1.50%", "Status": "OPEN", "Region": "SH", "Source": "tencent"}
+    quote.update(extra)
+    return quote
+
+
+class SharedQuoteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "quote_cache.bin")
+        self.cache = SharedQuoteCache(self.path, slots=SHARED_CACHE_PROBES)
+
+    def tearDown(self):
+        self.cache.mm.close()
+        self.cache.write_lock.file.close()
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.cache.put_many([make_quote("SH600000", 10.5, Volume=123456789, ExchangeTime=1760000000,
+                                        extPrice=10.6, extChange=0.1, extPercent="0.95%")])
+        quote = self.cache.get("SH600000", 60)
+        self.assertEqual(quote["Price"], 10.5)
+        self.assertEqual(quote["Percent"], "1.50%")
+        self.assertEqual(quote["Volume"], 123456789)
+        self.assertEqual(quote["ExchangeTime"], 1760000000)
+        self.assertEqual(quote["extPercent"], "0.95%")
+        self.assertEqual((quote["Name"], quote["Status"], quote["Region"], quote["Source"]),
+                         ("名称SH600000", "OPEN", "SH", "tencent"))
+
+    def test_missing_optional_fields(self):
+        self.cache.put_many([make_quote("SZ000001", 9.0)])
+        quote = self.cache.get("SZ000001", 60)
+        for field in ("Volume", "ExchangeTime", "extPrice"):
+            self.assertNotIn(field, quote)
+
+    def test_visible_to_another_mapping(self):
+        self.cache.put_many([make_quote("HK00700", 400.0, Volume=5)])
+        other = SharedQuoteCache(self.path, slots=SHARED_CACHE_PROBES)
+        try:
+            self.assertEqual(other.get("HK00700", 60)["Volume"], 5)
+        finally:
+            other.mm.close()
+            other.write_lock.file.close()
+
+    def test_rejects_incompatible_layout(self):
+        with self.assertRaises(ValueError):
+            SharedQuoteCache(self.path, slots=SHARED_CACHE_PROBES * 2)
+
+    def test_expired(self):
+        self.cache.put_many([make_quote("SH600000", 10.5)])
+        self.assertIsNone(self.cache.get("SH600000", -1))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_quote_without_price_is_skipped(self):
+        self.cache.put_many([make_quote("SH600000", 10.5, Price=None)])
+        self.assertEqual(self.cache.writes, 0)
+        self.assertIsNone(self.cache.get("SH600000", 60))
+
+    def test_name_truncated_on_character_boundary(self):
+        name = "中" * 20  # 60 字节，槽位只有 48 字节
+        self.cache.put_many([make_quote("SH600000", 10.5, Name=name)])
+        self.assertEqual(self.cache.get("SH600000", 60)["Name"], "中" * 16)
+        self.assertEqual(encode_truncated("a中", 2), b"a")
+        self.assertEqual(encode_truncated("ab", 2), b"ab")
+
+    def test_reader_waits_for_writer(self):
+        self.cache.put_many([make_quote("SH600000", 10.5)])
+        offset = next(offset for offset in self.cache._probe(b"SH600000")
+                      if self.cache.mm[offset + 4:offset + 12] == b"SH600000")
+        seq = SHARED_CACHE_SEQ.unpack_from(self.cache.mm, offset)[0]
+        self.assertEqual(seq % 2, 0)
+        # 写入方进行到一半：序列号为奇数，读取方放弃而不是返回半写的数据
+        SHARED_CACHE_SEQ.pack_into(self.cache.mm, offset, seq + 1)
+        self.assertIsNone(self.cache.get("SH600000", 60))
+        SHARED_CACHE_SEQ.pack_into(self.cache.mm, offset, seq + 2)
+        self.cache.put_many([make_quote("SH600000", 11.0)])
+        self.assertEqual(self.cache.get("SH600000", 60)["Price"], 11.0)
+
+    def test_concurrent_reads_are_consistent(self):
+        stop = threading.Event()
+
+        def write():
+            price = 1.0
+            while not stop.is_set():
+                price += 1
+                self.cache.put_many([make_quote("SH600000", price, Volume=int(price) * 100)])
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            reads = 0
+            for _ in range(20000):
+                quote = self.cache.get("SH600000", 60)
+                if quote is None:
+                    continue
+                reads += 1
+                self.assertAlmostEqual(quote["Change"], quote["Price"] / 10)
+                self.assertEqual(quote["Volume"], int(quote["Price"]) * 100)
+        finally:
+            stop.set()
+            writer.join()
+        self.assertGreater(reads, 0)
+
+    def test_full_probe_range_evicts_oldest(self):
+        symbols = [f"SH{600000 + i}" for i in range(SHARED_CACHE_PROBES + 1)]
+        clock = iter(range(1000, 2000))
+        with mock.patch.object(stock_common.time, "time", lambda: next(clock)):
+            for symbol in symbols:
+                self.cache.put_many([make_quote(symbol, 10.0)])
+            found = [symbol for symbol in symbols if self.cache.get(symbol, 10 ** 6) is not None]
+        # 表中只有 SHARED_CACHE_PROBES 个槽位，最后一个代码覆盖了最早写入的代码
+        self.assertEqual(found, symbols[1:])
+
+    def test_rewrite_reuses_slot(self):
+        for price in (1.0, 2.0, 3.0):
+            self.cache.put_many([make_quote("SH600000", price)])
+        used = sum(1 for offset in self.cache._probe(b"x") if self.cache.mm[offset + 4:offset + 20].strip(b"\0"))
+        self.assertEqual(used, 1)
+        self.assertEqual(self.cache.get("SH600000", 60)["Price"], 3.0)
+
+
+if __name__ == "__main__":
+    unittest.main()